@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+
+"""
+Copyright (C) 2016 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json, os, resource, sys, time, traceback
+
+import build
+from tools import compress, distance_pair, makesprites
+
+# Each compressor is described by a name, a mode and a pair of functions that
+# compress and decompress a string, returning strings or bytearrays.
+
+def block_compressor(adaptive):
+
+    c = compress.Compressor()
+    return (lambda data: c.compress(data, adaptive = adaptive), c.uncompress)
+
+def distance_pair_compressor(window = "output", method = "hash",
+                             parse = "greedy", merge = False):
+    
+    def compress_data(data):
+        data = bytearray(data)
+        if merge:
+            data = distance_pair.merge_buffer(data)
+        return bytearray(distance_pair.compress(data, window, method, parse))
+    
+    def decompress_data(data):
+        data = distance_pair.decompress(data, window)
+        if merge:
+            data = distance_pair.unmerge_buffer(data)
+        return data
+    
+    return compress_data, decompress_data
+
+compressors = [
+    ("compress", "blocks of 256 bytes", block_compressor(False)),
+    ("compress", "adaptive blocks", block_compressor(True)),
+    ("distance_pair", "greedy", distance_pair_compressor()),
+    ("distance_pair", "greedy scan", distance_pair_compressor(method = "scan")),
+    ("distance_pair", "optimal", distance_pair_compressor(parse = "optimal")),
+    ("distance_pair", "compressed window", distance_pair_compressor(window = "compressed")),
+    ("distance_pair", "greedy merged", distance_pair_compressor(merge = True)),
+    ]
+
+def read_assets(level_file):
+
+    """Returns a list of (name, data) pairs containing the game assets that
+    make up the benchmark corpus. The level data is taken from a tape image
+    built for the Electron, so that it is encoded for the address it is loaded
+    at in that image.
+    """
+    # The output of the functions used to read the assets is not useful here.
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    
+    try:
+        result = build.build("electron", "tape", level_file, backend = "python")
+        levels = result.state["levels"]["level data"]
+        sprites = makesprites.read_tile_data(makesprites.read_tiles(build.tiles))
+        panel, offsets = makesprites.read_sprites(["images/panel.png"])
+        title = makesprites.read_sprite(makesprites.read_png("images/multirom.png"))
+    finally:
+        sys.stdout = stdout
+    
+    return [("levels", levels), ("sprites", sprites), ("panel", panel),
+            ("title", title)]
+
+def peak_memory():
+
+    # The maximum resident set size is reported in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def time_calls(function, data, repeat):
+
+    # Return the result of the last call and the shortest time taken.
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        result = function(data)
+        times.append(time.time() - start)
+    
+    return result, min(times)
+
+def measure(compress_data, decompress_data, data, repeat):
+
+    """Compresses and decompresses the data in a child process, returning a
+    dictionary containing the results. Running each measurement in its own
+    process allows the growth in peak memory use to be recorded for it alone.
+    Raises RuntimeError if the measurement fails.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    
+    if pid == 0:
+        # Always leave the child process here, reporting any exception to the
+        # parent, so that it never returns into the caller's code.
+        status = 1
+        try:
+            os.close(read_fd)
+            try:
+                # The child starts with the memory of the parent, so only the
+                # growth in its peak memory use is reported.
+                baseline = peak_memory()
+                compressed, compress_seconds = time_calls(
+                    compress_data, data, repeat)
+                decompressed, decompress_seconds = time_calls(
+                    decompress_data, compressed, repeat)
+                
+                message = {
+                    "output size": len(compressed),
+                    "compression seconds": compress_seconds,
+                    "decompression seconds": decompress_seconds,
+                    "peak memory growth (KB)": peak_memory() - baseline,
+                    "round trip": str(bytearray(decompressed)) == data
+                    }
+                status = 0
+            except:
+                message = {"error": traceback.format_exc()}
+            
+            os.write(write_fd, json.dumps(message))
+            os.close(write_fd)
+        finally:
+            os._exit(status)
+    
+    os.close(write_fd)
+    
+    text = ""
+    while True:
+        s = os.read(read_fd, 4096)
+        if not s:
+            break
+        text += s
+    
+    os.close(read_fd)
+    
+    pid, status = os.waitpid(pid, 0)
+    if not text:
+        raise RuntimeError("Measurement process failed with status %i." % status)
+    
+    result = json.loads(text)
+    if "error" in result:
+        raise RuntimeError("Measurement failed:\n%s" % result["error"])
+    
+    return result
+
+def throughput(size, seconds):
+
+    if seconds > 0:
+        return size / (seconds * 1048576)
+    else:
+        return None
+
+def run(level_file, repeat):
+
+    results = []
+    
+    for asset, data in read_assets(level_file):
+    
+        for name, mode, (compress_data, decompress_data) in compressors:
+        
+            result = measure(compress_data, decompress_data, data, repeat)
+            
+            result["asset"] = asset
+            result["compressor"] = name
+            result["mode"] = mode
+            result["input size"] = len(data)
+            result["ratio"] = result["output size"] / float(len(data))
+            # Both rates are given in terms of the uncompressed data.
+            result["compression (MB/s)"] = throughput(
+                len(data), result["compression seconds"])
+            result["decompression (MB/s)"] = throughput(
+                len(data), result["decompression seconds"])
+            
+            results.append(result)
+    
+    return results
+
+def key(result):
+
+    return (result["asset"], result["compressor"], result["mode"])
+
+def print_results(results, previous = None):
+
+    if previous is not None:
+        previous = dict(map(lambda result: (key(result), result), previous))
+    
+    print "%-8s %-14s %-20s %6s %6s %6s %9s %9s %8s %5s" % (
+        "Asset", "Compressor", "Mode", "Input", "Output", "Ratio", "Comp MB/s",
+        "Dec MB/s", "Peak +KB", "OK")
+    
+    for result in results:
+    
+        rates = []
+        for name in "compression (MB/s)", "decompression (MB/s)":
+            if result[name] is None:
+                rates.append("-")
+            else:
+                rates.append("%.3f" % result[name])
+        
+        print "%-8s %-14s %-20s %6i %6i %6.3f %9s %9s %8i %5s" % (
+            (result["asset"], result["compressor"], result["mode"],
+             result["input size"], result["output size"], result["ratio"]) +
+            tuple(rates) + (result["peak memory growth (KB)"],
+                            result["round trip"])),
+        
+        if previous is not None and key(result) in previous:
+            old = previous[key(result)]
+            changes = []
+            for name in "compression seconds", "decompression seconds":
+                changes.append(100 * (result[name] - old[name]) / max(old[name], 1e-9))
+            
+            print "(%+i bytes, %+.0f%% compression time, %+.0f%% decompression time)" % (
+                (result["output size"] - old["output size"],) + tuple(changes))
+        else:
+            print
+
+
+if __name__ == "__main__":
+
+    args = sys.argv[:]
+    
+    repeat = 3
+    previous = None
+    
+    if "--repeat" in args:
+        i = args.index("--repeat")
+        repeat = int(args[i + 1])
+        del args[i:i + 2]
+    
+    if "--compare" in args:
+        i = args.index("--compare")
+        previous = json.load(open(args[i + 1]))["results"]
+        del args[i:i + 2]
+    
+    if not 2 <= len(args) <= 3:
+    
+        sys.stderr.write("Usage: %s [--repeat <count>] [--compare <previous JSON file>] <JSON file> [level file]\n" % sys.argv[0])
+        sys.exit(1)
+    
+    out_file = args[1]
+    
+    if len(args) == 3:
+        level_file = args[2]
+    else:
+        level_file = "levels/default.txt"
+    
+    results = run(level_file, repeat)
+    print_results(results, previous)
+    
+    json.dump({"version": build.version, "level file": level_file,
+               "repeat": repeat, "results": results},
+              open(out_file, "w"), indent = 4, sort_keys = True)
+    
+    failed = filter(lambda result: not result["round trip"], results)
+    if failed:
+        sys.stderr.write("%i round trip checks failed.\n" % len(failed))
+        sys.exit(1)
+    
+    sys.exit()
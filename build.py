@@ -17,18 +17,216 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import os, shutil, stat, struct, sys
+import cPickle, glob, inspect, os, shutil, struct, subprocess, sys, tempfile, time
 import UEFfile
+from distutils.spawn import find_executable
 
-from tools import distance_pair, makeadf, makedfs, makelevels, makesprites
+from tools import assembler, buildcache, buildprofile, distance_pair, makeadf, makedfs, makelevels, \
+                  makesprites, memorylayout, sizereport
 
 # Define the version of the game rather than of this script.
 version = "1.0.4"
 
-def system(command):
+# The directory containing the game sources.
+source_dir = os.path.dirname(os.path.abspath(__file__))
 
-    if os.system(command):
-        sys.exit(1)
+# Files written by the build in its working directory. These are not linked
+# into the working directory so that concurrent builds cannot share them.
+generated_files = ["bank_routines.oph", "config.oph", "constants.oph",
+                   "loader-constants.oph", "loader-unpack.oph", "screen.oph",
+                   "seek.oph", "temp.oph", "OUTPUT"]
+
+machines = ("electron", "bbc")
+formats = ("tape", "adfs", "dfs", "rom")
+backends = ("ophis", "python")
+checkpoint_intervals = (None, 2, 4, 8, 16, 32, 64, 128, 256)
+
+# The files that the build reads, other than the level file. The image from an
+# earlier build is only updated for a new level file if none of these files
+# have changed since that build.
+source_patterns = ["*.oph", "routines/*.oph", "images/*.png", "resources/*",
+                   "title.txt", "COPYING", "build.py", "UEFfile.py",
+                   "tools/*.py"]
+
+# The stages of a build in the order they are run, each with the results of
+# other stages that it uses. The levels stage produces the size of the level
+# data, the values derived from it that the game code uses, and the data
+# itself. Each of the other stages produces a single result with its own name.
+build_stages = [
+    ("routines", []),
+    ("levels", []),
+    ("sprites", []),
+    ("layout", ["routines", "level size", "sprites"]),
+    ("code", ["routines", "layout", "level size", "level values", "sprites"]),
+    ("loader", ["routines", "layout", "level size", "code", "sprites"]),
+    ("markers", ["loader", "code", "level data", "sprites"]),
+    ("image", ["routines", "level data", "sprites", "code", "loader", "markers"])
+    ]
+
+stage_results = {"levels": ["level size", "level values", "level data"]}
+
+class BuildError(Exception):
+    pass
+
+class BuildResult:
+
+    """Describes the result of a build: the contents of the image file, the
+    memory map used, a dictionary mapping the names of the files or sections
+    in the image to their sizes, a dictionary mapping build stages to the time
+    in seconds spent on them, a list of lines reporting on the build, a list of
+    dictionaries describing the regions of memory used, and a list of (name,
+    value) pairs for the constants defined for the game. The state is a
+    dictionary containing the results of the build stages that are needed to
+    update the image when only the level file changes. The profiler is set by
+    the build function and records the events that occurred in the build.
+    """
+    def __init__(self, data, memory_map, sizes, timings, report, regions,
+                 symbols, state = None):
+    
+        self.data = data
+        self.memory_map = memory_map
+        self.sizes = sizes
+        self.timings = timings
+        self.report = report
+        self.regions = regions
+        self.symbols = symbols
+        self.state = state
+        self.profiler = None
+
+def source_path(path):
+
+    return os.path.join(source_dir, path)
+
+def stale_stages(changed):
+
+    # Return the stages that use any of the changed results, either directly
+    # or through the results of other stages that use them.
+    changed = set(changed)
+    stale = []
+    
+    for stage, inputs in build_stages:
+    
+        if changed.intersection(inputs):
+            stale.append(stage)
+            changed.update(stage_results.get(stage, [stage]))
+    
+    return stale
+
+def sources_key(cache, level_file):
+
+    # Return a key for the contents of the files read by the build other than
+    # the level file.
+    level_file = os.path.abspath(level_file)
+    parts = []
+    
+    for pattern in source_patterns:
+        for path in sorted(glob.glob(source_path(pattern))):
+            if os.path.abspath(path) != level_file:
+                parts += [path, buildcache.read_file(path)]
+    
+    return cache.key(*parts)
+
+def write_file(path, data):
+
+    # Write the data to a temporary file and rename it so that programs
+    # reading the file, such as emulators, never see it partially written.
+    temp_path = path + ".%i.tmp" % os.getpid()
+    f = open(temp_path, "wb")
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    
+    os.rename(temp_path, path)
+
+def watched_files(level_files):
+
+    paths = []
+    for pattern in source_patterns:
+        paths += glob.glob(source_path(pattern))
+    
+    return map(os.path.abspath, paths + level_files)
+
+def file_times(paths):
+
+    times = {}
+    for path in paths:
+        try:
+            info = os.stat(path)
+            times[path] = (info.st_mtime, info.st_size)
+        except OSError:
+            times[path] = None
+    
+    return times
+
+def make_work_directory():
+
+    # Create a directory containing links to the sources so that the build can
+    # write its temporary files without affecting the source directory or
+    # other builds.
+    work_dir = tempfile.mkdtemp(prefix = "castleraider-")
+    
+    for name in os.listdir(source_dir):
+        if name not in generated_files and not name.startswith("."):
+            os.symlink(source_path(name), os.path.join(work_dir, name))
+    
+    return work_dir
+
+def assembler_details(backend):
+
+    # Identify the assembler by the path and modification time of its
+    # executable, or by the source of the built-in assembler, so that cached
+    # code is not reused after it is updated.
+    if backend == "python":
+        return "python " + buildcache.read_file(inspect.getsourcefile(assembler))
+    
+    path = find_executable("ophis")
+    if path is None:
+        raise BuildError("Failed to find the ophis assembler.")
+    
+    return "ophis %s %i" % (path, os.stat(path).st_mtime)
+
+def assemble(source, cache, work_dir, profiler, backend = "ophis"):
+
+    # Assemble the source file in the working directory, returning the code.
+    # The output of an earlier build is reused if the source file and the
+    # files it includes are unchanged.
+    event = profiler.start(source, "assembler", backend = backend)
+    try:
+        key = cache.key(assembler_details(backend),
+                        *buildcache.assembler_sources(source, work_dir))
+        data = cache.get(key)
+        event.args["cached"] = data is not None
+        
+        if data is None and backend == "python":
+            try:
+                data = assembler.assemble(source, work_dir)[0]
+            except assembler.AssemblerError, exception:
+                raise BuildError("Failed to assemble %s:\n%s" % (source, exception))
+            
+            cache.put(key, data)
+        
+        elif data is None:
+            output = os.path.join(work_dir, "OUTPUT")
+            profiler.start("ophis " + source, "subprocess")
+            try:
+                process = subprocess.Popen(["ophis", source, "-o", output],
+                                           cwd = work_dir, stdout = subprocess.PIPE,
+                                           stderr = subprocess.STDOUT)
+                messages = process.communicate()[0]
+            finally:
+                profiler.stop()
+            
+            if process.returncode != 0:
+                raise BuildError("Failed to assemble %s:\n%s" % (source, messages))
+            
+            data = open(output, "rb").read()
+            os.remove(output)
+            cache.put(key, data)
+    finally:
+        profiler.stop()
+    
+    return data
 
 def read_basic(path):
 
@@ -50,6 +248,121 @@ def address_length_end(address, data):
     end_high = end >> 8
     return address_low, address_high, length_low, length_high, end_low, end_high
 
+def tape_details(name, address, data, baud = 1200):
+
+    # Return the number of tape blocks needed to store the file and an estimate
+    # of the time in seconds needed to load it, including the carrier tone
+    # written before each block.
+    
+    chunks = UEFfile.UEFfile().create_chunks(name, address, address, data)
+    blocks = 0
+    seconds = 0.0
+    
+    for chunk_id, chunk_data in chunks:
+    
+        if chunk_id == 0x100:
+            # Each byte is stored with a start bit and a stop bit.
+            seconds += len(chunk_data) * 10.0 / baud
+            blocks += 1
+        elif chunk_id == 0x110:
+            # Carrier tone is measured in cycles at twice the baud rate.
+            cycles = ord(chunk_data[0]) | (ord(chunk_data[1]) << 8)
+            seconds += cycles / (2.0 * baud)
+    
+    return blocks, seconds
+
+def create_markers(marker_info):
+
+    # Return a table of bytes sampled from each of the files described by the
+    # (address, data) pairs given, with their addresses, preceded by the number
+    # of entries.
+    markers = ""
+    n = 0
+    
+    for address, data in marker_info:
+    
+        ptr = 64
+        while ptr < len(data):
+        
+            low = (address + ptr) & 0xff
+            high = (address + ptr) >> 8
+            markers += chr(low) + chr(high) + data[ptr]
+            ptr += 128
+            n += 1
+    
+    return chr(n) + markers
+
+def create_image(format, files, work_dir):
+
+    # Return a tape or disk image containing the files given as (name, load
+    # address, execution address, data) tuples.
+    if format == "tape":
+    
+        u = UEFfile.UEFfile(creator = 'build.py for Castle Raider ' + version)
+        u.minor = 6
+        u.target_machine = "Electron"
+        
+        u.import_files(0, files, gap=True)
+        
+        # Append instructions and short title chunks to the file.
+        #README = open("README.txt").read()
+        #COPYING = open("COPYING").read()
+        #u.chunks += [(0x1, README + "\n\n" + COPYING), (0x9, "Castle Raider " + version)]
+        
+        # Write the new UEF file to the working directory and read it back.
+        uef_file = os.path.join(work_dir, "OUTPUT")
+        try:
+            u.write(uef_file, write_emulator_info = False)
+        except UEFfile.UEFfile_error:
+            raise BuildError("Couldn't write the new executable to %s." % uef_file)
+        
+        image = open(uef_file, "rb").read()
+    
+    elif format == "adfs":
+    
+        disk = makeadf.Disk("M")
+        disk.new()
+        
+        catalogue = disk.catalogue()
+        catalogue.boot_option = 3
+        
+        disk_files = []
+        for name, load, exec_, data in files:
+            disk_files.append(makeadf.File(name, data, load, exec_, len(data)))
+        
+        COPYING = open(source_path("COPYING")).read().replace("\n", "\r\n")
+        disk_files.append(makeadf.File("COPYING", COPYING, 0x0000, 0x0000, len(COPYING)))
+        
+        dir_address = catalogue.sector_size * 2
+        catalogue.write("$", "CastleRaider", disk_files, dir_address, dir_address)
+        catalogue.write_free_space()
+        
+        disk.file.seek(0, 0)
+        image = disk.file.read()
+    
+    elif format == "dfs":
+    
+        disk = makedfs.Disk()
+        disk.new()
+        
+        catalogue = disk.catalogue()
+        catalogue.boot_option = 3
+        
+        disk_files = []
+        
+        for name, load, exec_, data in files:
+            disk_files.append(makedfs.File("$." + name, data, load, exec_, len(data)))
+        
+        COPYING = open(source_path("COPYING")).read().replace("\n", "\r\n")
+        disk_files.append(makedfs.File("$.COPYING", COPYING, 0x0000, 0x0000, len(COPYING)))
+        
+        catalogue.write("CastleRaider", disk_files)
+        
+        disk.file.seek(0, 0)
+        image = disk.file.read()
+    
+    return image
+
 def encode_text(lines):
 
     # Store the text reversed to reduce the number of instructions needed to
@@ -86,6 +399,21 @@ def encode_data(bytes):
     
     return "\n".join(data)
 
+def create_level(levels_address, level_file, maximum_number_of_special_tiles,
+                 maximum_number_of_portals, checkpoint_interval):
+    
+    # Return the level extent with the level data since it is stored in the
+    # makelevels module and would not be set if the result came from the cache.
+    try:
+        level_data, monster_row_address, finishing_offset = makelevels.create_level(
+            levels_address, level_file, maximum_number_of_special_tiles,
+            maximum_number_of_portals, checkpoint_interval)
+    except makelevels.LevelError, exception:
+        raise BuildError("Failed to create the level data from %s:\n%s" % (
+            level_file, exception))
+    
+    return level_data, monster_row_address, finishing_offset, makelevels.level_extent
+
 tiles = map(lambda tile: makelevels.tile_ref[tile], makelevels.tile_order)
 
 char_sprites = ["images/g-left1.png", "images/g-left2.png",
@@ -114,13 +442,85 @@ misc_routines = [
     "next_cell_screen",
     ]
 
-def encode_in_game_data_and_routines(in_game_data_address):
+def assemble_routines_separately(routine_address, labels, details, cache,
+                                 work_dir, profiler, log, backend):
+    
+    # Assemble each routine on its own, using the size of each one to find the
+    # address of the next. Returns the code for all the routines and a list
+    # of their addresses.
+    code = ""
+    addresses = []
+    labels = labels % details
+    
+    for name in misc_routines:
+    
+        routine = open(source_path(os.path.join("routines", name + ".oph"))).read()
+        log("Assembling %s at $%x" % (name, routine_address))
+        
+        # Substitute the routine address into the code if necessary and include
+        # aliases so that the routine can call any previously defined routines.
+        details["routine_address"] = routine_address
+        routine = (routine % details) + "\n" + labels
+        
+        open(os.path.join(work_dir, "temp.oph"), "w").write(routine)
+        routine_code = assemble("temp.oph", cache, work_dir, profiler, backend)
+        
+        code += routine_code
+        addresses.append(routine_address)
+        labels += ".alias " + name + (" $%0x\n" % routine_address)
+        
+        # Update the routine address.
+        routine_address += len(routine_code)
+    
+    return code, addresses
+
+def assemble_routines_together(routine_address, labels, details, cache,
+                               work_dir, profiler, log, backend):
+    
+    # Assemble all the routines in a single pass, placing a label before each
+    # of them so that the assembler resolves the calls between them. The
+    # addresses of the labels are stored in a table after the routines, which
+    # is removed from the output once it has been read. Returns the code for
+    # all the routines and a list of their addresses.
+    source = ".org $%x\n" % routine_address
+    source += labels % details
+    
+    for name in misc_routines:
+        routine = open(source_path(os.path.join("routines", name + ".oph"))).read()
+        source += "\n" + name + ":\n" + (routine % details) + "\n"
+    
+    source += "\n"
+    for name in misc_routines:
+        source += ".word " + name + "\n"
+    
+    open(os.path.join(work_dir, "temp.oph"), "w").write(source)
+    code = assemble("temp.oph", cache, work_dir, profiler, backend)
+    
+    table_length = 2 * len(misc_routines)
+    if len(code) < table_length:
+        raise BuildError("Failed to read the addresses of the routines.")
+    
+    addresses = list(struct.unpack("<%iH" % len(misc_routines), code[-table_length:]))
+    code = code[:-table_length]
+    
+    if addresses[0] != routine_address:
+        raise BuildError("Routines were assembled at $%x instead of $%x." % (
+            addresses[0], routine_address))
+    
+    for name, address in zip(misc_routines, addresses):
+        log("Assembling %s at $%x" % (name, address))
+    
+    return code, addresses
+
+def encode_in_game_data_and_routines(in_game_data_address, cache, work_dir,
+                                     profiler, log, batch = True,
+                                     backend = "ophis"):
 
     # Encode the in-game title data.
     data = ""
     
     title_rows = 0
-    for line in open("title.txt").readlines():
+    for line in open(source_path("title.txt")).readlines():
     
         line = line.rstrip("\n")
         
@@ -178,33 +578,24 @@ def encode_in_game_data_and_routines(in_game_data_address):
         "in_game_game_over_text_length": in_game_game_over_text_length,
         }
     
-    routine_address = in_game_title_routines_address
+    if batch:
+        code, addresses = assemble_routines_together(
+            in_game_title_routines_address, labels, details, cache, work_dir,
+            profiler, log, backend)
+    else:
+        code, addresses = assemble_routines_separately(
+            in_game_title_routines_address, labels, details, cache, work_dir,
+            profiler, log, backend)
     
-    for name in misc_routines:
+    # Include the routines in the title data file.
+    data += code
+    routine_address = in_game_title_routines_address + len(code)
+    
+    for name, address in zip(misc_routines, addresses):
     
-        routine = open(os.path.join("routines", name + ".oph")).read()
-        print "Assembling", name, "at $%x" % routine_address
-        
-        # Substitute the routine address into the code if necessary and include
-        # aliases so that the routine can call any previously defined routines.
-        details["routine_address"] = routine_address
-        routine = (routine % details) + "\n" + (labels % details)
-        
-        open("temp.oph", "w").write(routine)
-        system("ophis temp.oph -o TEMP")
-        
-        # Include the routine in the title data file.
-        data += open("TEMP").read()
-        
         # Add the run-time address to the constants.
-        labels += ".alias " + name + (" $%0x\n" % routine_address)
-        details[name] = routine_address
-        
-        # Update the routine address.
-        routine_address += os.stat("TEMP")[stat.ST_SIZE]
-        
-        os.remove("temp.oph")
-        os.remove("TEMP")
+        labels += ".alias " + name + (" $%0x\n" % address)
+        details[name] = address
     
     # Store the address of the end of the working area.
     details["working_end"] = routine_address
@@ -272,46 +663,191 @@ def add_hidden_data(panel, start):
     
     return "".join(map(chr, panel)), offsets
 
+def rebuild_levels(state, inputs, level_file, cache, work_dir, profiler):
 
-if __name__ == "__main__":
-
-    args = sys.argv[:]
+    # Update the image described by the state of an earlier build for the
+    # given level file, returning a BuildResult, or None if the other inputs to
+    # the build have changed or stages other than those creating the loader
+    # markers and the image need to be run again.
+    if state["inputs"] != inputs:
+        return None
+    
+    # The load addresses of compressed files depend on their contents.
+    if state["compressed files"]:
+        return None
+    
+    profiler.start("levels")
+    levels_address = state["levels address"]
+    level_data, monster_row_address, finishing_offset, level_extent = cache.call(
+        create_level, (levels_address, level_file) + state["level limits"],
+        [level_file], [makelevels])
+    profiler.stop()
+    
+    levels_results = {"level size": len(level_data),
+                      "level values": (monster_row_address, finishing_offset,
+                                       level_extent),
+                      "level data": level_data}
+    
+    changed = filter(lambda name: levels_results[name] != state["levels"][name],
+                     stage_results["levels"])
+    stale = stale_stages(changed)
+    if set(stale) - set(["markers", "image"]):
+        return None
+    
+    image = state["image"]
+    files = state.get("files")
+    
+    if "markers" in stale and files is not None:
+    
+        profiler.start("markers")
+        marker_info = [(levels_address, level_data)] + state["marker info"][1:]
+        loader_code = state["loader"] + create_markers(marker_info) + \
+                      state["title data"]
+        profiler.stop()
+        
+        new_files = {"LEVELS": level_data, "LOADER": loader_code}
+        files = map(lambda (name, load, exec_, data):
+                        (name, load, exec_, new_files.get(name, data)), files)
     
-    menu = "-m" in args
-    if menu:
-        args.remove("-m")
-
-    if not 4 <= len(args) <= 5:
+    if "image" in stale:
     
-        sys.stderr.write("Usage: %s -e|-b -t|-a|-d|-r <new UEF, ADF, SSD or ROM file> [level file]\n" % sys.argv[0])
-        sys.exit(1)
+        profiler.start("image")
+        
+        if files is None:
+            # Replace the level data in the ROM, padding it to fill its region.
+            start = levels_address - state["code start"]
+            end = start + state["levels space"]
+            image = image[:start] + level_data + \
+                    "\x00" * (end - start - len(level_data)) + image[end:]
+        else:
+            image = create_image(state["format"], files, work_dir)
+        
+        profiler.stop()
     
-    machine_type = args[1]
-    if machine_type not in ("-e", "-b"):
-        sys.stderr.write("Please specify a valid machine type.\n")
-        sys.exit(1)
+    timings = profiler.totals()
+    ran = filter(lambda stage: stage in timings,
+                 map(lambda (stage, inputs): stage, build_stages))
+    report = state["report"] + [
+        "", "Only the level file changed: ran %s" % ", ".join(ran)]
     
-    make_tape_image = args[2] == "-t"
-    make_adfs_image = args[2] == "-a"
-    make_dfs_image = args[2] == "-d"
-    make_rom_image = args[2] == "-r"
-    out_file = args[3]
+    state = state.copy()
+    state.update({"levels": levels_results, "image": image, "files": files})
     
-    if len(args) == 4:
-        level_file = "levels/default.txt"
-    else:
-        level_file = args[4]
+    return BuildResult(image, state["memory map"], state["sizes"], timings,
+                       report, state["regions"], state["symbols"], state)
+
+def build(machine, format, level_file = None, menu = False, out = None,
+          compress_files = False, use_cache = True, batch_routines = True,
+          backend = "ophis", profile = False, checkpoint_interval = None):
+
+    """Builds the game for the given machine ("electron" or "bbc") in the given
+    format ("tape", "adfs", "dfs" or "rom"), using the level file given or the
+    default level, and returns a BuildResult object. If out is given, the image
+    is also written to the file with that path. If batch_routines is False,
+    each of the in-game routines is assembled separately instead of in a single
+    pass. The backend is either "ophis" to use the Ophis assembler or "python"
+    to use the assembler in the tools package. If the build cache is used and
+    only the level file has changed since the last build of the same target,
+    only the stages that depend on the level data are run again. The time
+    spent in each stage and assembler run is recorded by the profiler of the
+    result. If profile is True, the Python functions called are also profiled.
+    If checkpoint_interval is given, it must be a power of 2 from 2 to 256 and
+    a checkpoint table is added to the level data, recording the state of the
+    scrolling routines at every multiple of that number of columns, which the
+    game uses to jump to portal destinations and restart positions without
+    scrolling all the way there. Checkpoints are only supported in ROM images.
+    Raises BuildError if the game cannot be built.
+    """
+    if machine not in machines:
+        raise ValueError("Unknown machine type: %s" % machine)
+    if format not in formats:
+        raise ValueError("Unknown image format: %s" % format)
+    if backend not in backends:
+        raise ValueError("Unknown assembler: %s" % backend)
+    if checkpoint_interval not in checkpoint_intervals:
+        raise ValueError("Invalid checkpoint interval: %s" % checkpoint_interval)
+    
+    if compress_files and format == "rom":
+        raise BuildError("Compressed files are only supported in tape and disk images.")
+    if checkpoint_interval and format != "rom":
+        raise BuildError("Checkpoints are only supported in ROM images.")
+    
+    if level_file is None:
+        level_file = source_path("levels/default.txt")
+    
+    # Reuse the results of stages from earlier builds if their inputs are
+    # unchanged.
+    cache = buildcache.BuildCache(source_path(".build-cache"), enabled = use_cache)
+    
+    # The state of the last build of the same target is kept in the cache so
+    # that its image can be updated if only the level file has changed.
+    target = (machine, format, menu, compress_files, batch_routines, backend,
+              checkpoint_interval)
+    state_key = cache.key("build state", repr(target))
+    
+    profiler = buildprofile.Profiler(profile)
+    profiler.start("build", "build", machine = machine, format = format)
+    
+    # Generated files are written to a temporary directory that is removed
+    # when the build finishes.
+    work_dir = make_work_directory()
+    try:
+        profiler.start("sources", "build")
+        inputs = cache.key(assembler_details(backend),
+                           sources_key(cache, level_file))
+        profiler.stop()
+        
+        result = None
+        data = cache.get(state_key)
+        if data is not None:
+            result = rebuild_levels(cPickle.loads(data), inputs, level_file,
+                                    cache, work_dir, profiler)
+        
+        if result is None:
+            result = build_image(machine, format, level_file, menu,
+                                 compress_files, cache, work_dir, profiler,
+                                 batch_routines, backend, checkpoint_interval)
+            result.state["inputs"] = inputs
+    finally:
+        shutil.rmtree(work_dir)
+        profiler.finish()
+    
+    result.profiler = profiler
+    cache.put(state_key, cPickle.dumps(result.state, 2))
+    
+    if out is not None:
+        write_file(out, result.data)
+        result.report += ["", "Written " + out]
+    
+    # Remove old entries from the build cache.
+    if cache.enabled:
+        result.report += ["", "Build cache: %i hits, %i misses" % (cache.hits, cache.misses)]
+        cache.evict()
+    
+    return result
+
+def build_image(machine, format, level_file, menu, compress_files, cache,
+                work_dir, profiler, batch_routines = True, backend = "ophis",
+                checkpoint_interval = None):
+
+    make_tape_image = format == "tape"
+    make_adfs_image = format == "adfs"
+    make_dfs_image = format == "dfs"
+    make_rom_image = format == "rom"
     
     make_loader = not make_rom_image
     
+    report = []
+    log = report.append
+    
     # Memory maps
+    # The addresses of the level data, sprites and, for the ROM, the panel and
+    # in-game routines are found by laying out memory once their sizes are
+    # known.
     memory_map = {
         "working area": 0xb00,
         "palette start": 0xcfb,
         "code start": 0x0e00,
-        "data start": 0x2162,
-        "tile sprites": 0x2aa0 + 0xc0 + 0x20,
-        "character and object sprites": 0x2de0 + 0xc0 + 0x20,
         "bank 1 (panel)": 0x3000,
         "panel address": 0x3000,
         "(loader code)": 0x3500,
@@ -329,27 +865,13 @@ if __name__ == "__main__":
         memory_map["sound buffer"] = 0x1000
         memory_map["player sprites"] = 0x1100
         
-        rom_code_start = 0x8000
-        rom_data_start = 0x9600
-        if menu: rom_data_start += 0x1000
-        rom_tile_sprites = rom_data_start + memory_map["tile sprites"] - memory_map["data start"]
-        rom_char_sprites = rom_tile_sprites + memory_map["character and object sprites"] - memory_map["tile sprites"]
-        rom_char_sprites_length = 0x30c0 - memory_map["character and object sprites"]
-        
-        memory_map["code start"] = rom_code_start
-        memory_map["data start"] = rom_data_start
-        memory_map["tile sprites"] = rom_tile_sprites
-        memory_map["character and object sprites"] = rom_char_sprites
-        memory_map["panel address"] = rom_char_sprites + rom_char_sprites_length
-        memory_map["title data address"] = memory_map["panel address"] + 0x500
+        memory_map["code start"] = 0x8000
     
     code_start = memory_map["code start"]
     
     maximum_number_of_special_tiles = 16
     maximum_number_of_portals = 16
     
-    data_start = memory_map["data start"]
-    
     # Global variables
     
     # Use the Econet workspace for the player variables.
@@ -402,13 +924,18 @@ if __name__ == "__main__":
     # Initial displacements for the rows.
     initial_row_offsets           = row_indices + 0x10
     
+    profiler.start("routines")
+    
     if make_rom_image:
-        # Store the in-game text data and other routines above the working data.
-        # The generated file is loaded in the game loader.
-        title_data_address = memory_map["title data address"]
-        
+        # Store the in-game text data and other routines in the ROM after the
+        # panel. Their address depends on the layout of the ROM, so encode them
+        # at a provisional address to find their size, then encode them again
+        # once the layout is known.
         in_game_data_labels, in_game_data_details, title_data_routines = \
-            encode_in_game_data_and_routines(title_data_address)
+            encode_in_game_data_and_routines(memory_map["code start"], cache,
+                                             work_dir, profiler,
+                                             lambda text: None, batch_routines,
+                                             backend)
         
         working_end = initial_row_offsets + 0x10
     else:
@@ -417,10 +944,112 @@ if __name__ == "__main__":
         title_data_address = initial_row_offsets + 0x10
         
         in_game_data_labels, in_game_data_details, title_data_routines = \
-            encode_in_game_data_and_routines(title_data_address)
+            encode_in_game_data_and_routines(title_data_address, cache,
+                                             work_dir, profiler, log,
+                                             batch_routines, backend)
         
         working_end = in_game_data_details["working_end"]
     
+    profiler.stop()
+    
+    # Create the level data at a provisional address to find its size.
+    profiler.start("levels")
+    level_args = (level_file, maximum_number_of_special_tiles,
+                  maximum_number_of_portals, checkpoint_interval)
+    level_data = cache.call(create_level, (0,) + level_args, [level_file],
+                            [makelevels])[0]
+    profiler.stop()
+    
+    # Read the sprites and panel, obtaining the offsets of the sprites from the
+    # start of the data. These are converted to addresses once the layout of
+    # memory is known.
+    profiler.start("sprites")
+    
+    tile_paths = map(source_path, tiles)
+    tile_sprites = cache.call(makesprites.read_tiles, (tile_paths,), tile_paths)
+    sprite_data = makesprites.read_tile_data(tile_sprites)
+    all_tiles = len(tiles)
+    
+    # Place the monster and character sprite data after the tile data.
+    monster_sprite_paths = map(source_path, monster_sprites)
+    monster_sprites_data, monster_sprites_addresses = \
+        cache.call(makesprites.read_sprites,
+                   (monster_sprite_paths, 0), monster_sprite_paths)
+    char_data = monster_sprites_data
+    
+    monster_sprites_data, monster_sprites_shifted_addresses = \
+        cache.call(makesprites.read_shifted_sprites,
+                   (monster_sprite_paths, len(char_data)), monster_sprite_paths)
+    char_data += monster_sprites_data
+    
+    life_sprite_paths = map(source_path, life_sprites)
+    life_sprites_data, life_sprites_addresses = \
+        cache.call(makesprites.read_sprites,
+                   (life_sprite_paths, len(char_data)), life_sprite_paths)
+    char_data += life_sprites_data
+    
+    char_sprite_paths = map(source_path, char_sprites)
+    player_data, player_sprite_offsets = \
+        cache.call(makesprites.read_sprites,
+                   (char_sprite_paths, len(char_data)), char_sprite_paths)
+    char_data += player_data
+    
+    panel_paths = [source_path("images/panel.png")]
+    panel, offsets = cache.call(makesprites.read_sprites, (panel_paths,),
+                                panel_paths)
+    #panel, hidden_offsets = add_hidden_data(panel, (3 * 0x140) + 0x10)
+    
+    title_path = source_path("images/title.png")
+    title_data = cache.call(makesprites.read_title, (title_path,), [title_path])
+    profiler.stop()
+    
+    # Lay out the code and permanent data. The code is placed at a fixed
+    # address and receives all the free space because its size is only known
+    # after it has been assembled using the addresses of the data.
+    profiler.start("layout")
+    
+    if make_rom_image:
+        layout = memorylayout.Layout(0x8000, 0xc000)
+        layout.add("CODE", address = memory_map["code start"])
+        layout.add("LEVELS", len(level_data))
+        layout.add("SPRITES", len(sprite_data) + len(char_data))
+        layout.add("PANEL", len(panel))
+        layout.add("ROUTINE", len(title_data_routines))
+    else:
+        layout = memorylayout.Layout(memory_map["code start"], 0x8000)
+        layout.add("CODE", address = memory_map["code start"])
+        layout.add("LEVELS", len(level_data))
+        # Allow the end of the sprite data to overlap where the panel data will
+        # be loaded because we will discard one set of character sprites when
+        # the user chooses a character.
+        layout.add("SPRITES", len(sprite_data) + len(char_data),
+                   overlap = len(player_data) / 2)
+        layout.add("bank 1 (panel)", 0x2800, address = memory_map["bank 1 (panel)"])
+        layout.add("bank 2", 0x2800, address = memory_map["bank 2"])
+    
+    try:
+        addresses = layout.solve()
+    except memorylayout.LayoutError, exception:
+        raise BuildError(str(exception))
+    
+    memory_map["data start"] = addresses["LEVELS"]
+    memory_map["tile sprites"] = addresses["SPRITES"]
+    memory_map["character and object sprites"] = addresses["SPRITES"] + len(sprite_data)
+    
+    if make_rom_image:
+        memory_map["panel address"] = addresses["PANEL"]
+        memory_map["title data address"] = addresses["ROUTINE"]
+        
+        title_data_address = memory_map["title data address"]
+        in_game_data_labels, in_game_data_details, title_data_routines = \
+            encode_in_game_data_and_routines(title_data_address, cache,
+                                             work_dir, profiler, log,
+                                             batch_routines, backend)
+    
+    data_start = memory_map["data start"]
+    
+    profiler.stop()
+    
     # Permanent data
     
     # Level data
@@ -447,19 +1076,21 @@ if __name__ == "__main__":
     level_data_low                = level_data & 0xff
     level_data_high               = level_data >> 8
     
-    # Create the level data.
+    # Create the level data at its final address.
+    profiler.start("levels")
     levels_address = level_data_start
-    level_data, monster_row_address, finishing_offset = makelevels.create_level(
-        levels_address, level_file, maximum_number_of_special_tiles, maximum_number_of_portals)
+    level_data, monster_row_address, finishing_offset, level_extent = cache.call(
+        create_level, (levels_address,) + level_args, [level_file], [makelevels])
+    profiler.stop()
     
-    level_extent = makelevels.level_extent
+    levels_results = {"level size": len(level_data),
+                      "level values": (monster_row_address, finishing_offset,
+                                       level_extent),
+                      "level data": level_data}
     
     files = []
     
     sprite_area_address = memory_map["tile sprites"]
-    tile_sprites = makesprites.read_tiles(tiles)
-    sprite_data = makesprites.read_tile_data(tile_sprites)
-    all_tiles = len(tiles)
     
     left_sprites = sprite_area_address + (all_tiles * 8)
     left_sprites_low = left_sprites & 0xff
@@ -471,30 +1102,14 @@ if __name__ == "__main__":
     right_sprites_low = right_sprites & 0xff
     right_sprites_high = right_sprites >> 8
     
-    # Place the monster and character sprite data after the tile data.
-    # Allow the end of the data to overlap where the panel data will be loaded
-    # because we will discard one set of character sprites when the user
-    # chooses a character.
     char_area_address = right_sprites + (all_tiles * 8)
     
-    monster_sprites_address = char_area_address
-    monster_sprites_data, monster_sprites_addresses = \
-        makesprites.read_sprites(monster_sprites, monster_sprites_address)
-    char_data = monster_sprites_data
-    
-    monster_sprites_shifted_address = char_area_address + len(char_data)
-    monster_sprites_data, monster_sprites_shifted_addresses = \
-        makesprites.read_shifted_sprites(monster_sprites, monster_sprites_shifted_address)
-    char_data += monster_sprites_data
-    
-    life_sprites_address = char_area_address + len(char_data)
-    life_sprites_data, life_sprites_addresses = \
-        makesprites.read_sprites(life_sprites, life_sprites_address)
-    char_data += life_sprites_data
-    
-    player_data, player_sprite_offsets = \
-        makesprites.read_sprites(char_sprites, char_area_address + len(char_data))
-    char_data += player_data
+    relocate = lambda offsets: map(lambda offset: char_area_address + offset, offsets)
+    monster_sprites_addresses = relocate(monster_sprites_addresses)
+    monster_sprites_shifted_addresses = relocate(monster_sprites_shifted_addresses)
+    life_sprites_addresses = relocate(life_sprites_addresses)
+    player_sprite_offsets = relocate(player_sprite_offsets)
+    life_sprites_address = life_sprites_addresses[0]
     
     if make_rom_image:
         # For the ROM version, we copy the selected character sprites into RAM.
@@ -511,8 +1126,6 @@ if __name__ == "__main__":
         player_sprite_offsets = player_sprite_offsets[:4] + player_sprite_offsets
     
     panel_address = memory_map["panel address"]
-    panel, offsets = makesprites.read_sprites(["images/panel.png"], panel_address)
-    #panel, hidden_offsets = add_hidden_data(panel, (3 * 0x140) + 0x10)
     
     top_panel_objects_bank1 = 0x31d8
     top_panel_objects_bank1_low = top_panel_objects_bank1 & 0xff
@@ -528,8 +1141,6 @@ if __name__ == "__main__":
     top_panel_lives_bank2_low = top_panel_lives_bank2 & 0xff
     top_panel_lives_bank2_high = top_panel_lives_bank2 >> 8
     
-    title_data = makesprites.read_title("images/title.png")
-    
     # Create the contents of a file containing constant values.
     
     constants_oph = (
@@ -646,6 +1257,31 @@ if __name__ == "__main__":
             level_extent, level_extent & 0xff, level_extent >> 8) + (
             monster_row_address & 0xff, monster_row_address >> 8))
     
+    if checkpoint_interval:
+    
+        # The checkpoint table is at the end of the level data. Its address is
+        # reduced by one so that it can be indexed by checkpoint number.
+        checkpoints_address = levels_address + len(level_data) - \
+            makelevels.checkpoints_size(level_extent, checkpoint_interval) - 1
+        
+        constants_oph += (
+            ".alias checkpoint_shift                %i\n"
+            ".alias checkpoint_mask                 $%02x\n"
+            ".alias checkpoint_count                %i\n"
+            ".alias checkpoints_low                 $%02x\n"
+            ".alias checkpoints_high                $%02x\n"
+            "\n"
+            ) % (len(bin(checkpoint_interval)) - 3,
+                 (0x100 - checkpoint_interval) & 0xff,
+                 makelevels.checkpoint_count(level_extent, checkpoint_interval),
+                 checkpoints_address & 0xff, checkpoints_address >> 8)
+        
+        seek_oph = '.include "checkpoints.oph"\n'
+    else:
+        seek_oph = (
+            "; There are no checkpoints, so scroll from the current position.\n"
+            )
+    
     constants_oph += (
         ".alias special_tile_numbers_low        $%02x\n"
         ".alias special_tile_numbers_high       $%02x\n"
@@ -826,21 +1462,25 @@ if __name__ == "__main__":
     
     # Assemble the main game code and loader code.
     
-    open("constants.oph", "w").write(constants_oph)
-    open("screen.oph", "w").write(screen_oph)
+    profiler.start("code")
+    open(os.path.join(work_dir, "constants.oph"), "w").write(constants_oph)
+    open(os.path.join(work_dir, "screen.oph"), "w").write(screen_oph)
+    open(os.path.join(work_dir, "seek.oph"), "w").write(seek_oph)
     
     retro_loader = None
     
-    if machine_type == "-e":
-        shutil.copy2("electron.oph", "bank_routines.oph")
+    if machine == "electron":
+        shutil.copy2(source_path("electron.oph"),
+                     os.path.join(work_dir, "bank_routines.oph"))
         if make_adfs_image:
             retro_loader = "loader_E3A"
         elif make_dfs_image:
             retro_loader = "loader_E5D"
         elif make_tape_image:
             retro_loader = "loader_E5D"
-    elif machine_type == "-b":
-        shutil.copy2("bbc.oph", "bank_routines.oph")
+    elif machine == "bbc":
+        shutil.copy2(source_path("bbc.oph"),
+                     os.path.join(work_dir, "bank_routines.oph"))
         if make_adfs_image:
             retro_loader = "loader_C3A"
         elif make_dfs_image:
@@ -852,57 +1492,73 @@ if __name__ == "__main__":
         # Write the configuration file for the ROM code assembly.
         if menu:
             # Convert the PNG to screen data and compress it with the palette data.
-            title_sprite = makesprites.read_sprite(makesprites.read_png("images/multirom.png"))
-            data_list = "".join(map(chr, distance_pair.compress(map(ord, title_sprite))))
+            multirom_path = source_path("images/multirom.png")
+            title_sprite = makesprites.read_sprite(cache.call(
+                makesprites.read_png, (multirom_path,), [multirom_path]))
+            title_values = map(ord, title_sprite)
+            compressed_title = distance_pair.compress(title_values, parse = "optimal")
+            greedy_size = len(distance_pair.compress(title_values))
+            log("%i bytes (%04x) of compressed title data (%i bytes saved by optimal parsing)" % (
+                len(compressed_title), len(compressed_title), greedy_size - len(compressed_title)))
+            data_list = "".join(map(chr, compressed_title))
             
             title_dest_addr = 0x4400
             title_dest_end = title_dest_addr + len(title_sprite)
             
-            f = open("config.oph", "w")
+            f = open(os.path.join(work_dir, "config.oph"), "w")
             f.write(
                 ".alias config_start_code menu_code\n"
                 ".alias menu_title_dest_address $%x\n"
                 ".alias menu_title_dest_end $%x\n\n"
+                "%s\n"
                 '.include "menu.oph"\n\n'
-                "menu_title_data:\n%s\n" % (title_dest_addr, title_dest_end, encode_data(data_list))
+                "menu_title_data:\n%s\n" % (title_dest_addr, title_dest_end,
+                    distance_pair.default_format.aliases(), encode_data(data_list))
                 )
             f.close()
         else:
-            open("config.oph", "w").write(
+            open(os.path.join(work_dir, "config.oph"), "w").write(
                 ".alias config_start_code castle_code\n"
                 )
 
-        system("ophis romcode.oph -o CODE")
+        code = assemble("romcode.oph", cache, work_dir, profiler, backend)
     else:
-        system("ophis tdcode.oph -o CODE")
+        code = assemble("tdcode.oph", cache, work_dir, profiler, backend)
     
-    code = open("CODE").read()
-    os.remove("CODE")
     code_size = len(code)
+    profiler.stop()
     
     if make_loader:
     
+        profiler.start("loader")
         code_load_address = 0x5800 - len(code)
         loader_start = 0x3500
         
-        marker_info = [(levels_address, level_data),
-                       (panel_address, panel),
-                       (code_load_address, code)]
-        markers = ""
-        n = 0
+        # Define the files that the loader can decompress, along with their
+        # final addresses and contents.
+        unpacked_files = [("SPRITES", "sprites", sprite_area_address,
+                           sprite_data + char_data),
+                          ("LEVELS", "levels", levels_address, level_data),
+                          ("PANEL", "top_panel", panel_address, panel)]
         
-        for address, data in marker_info:
+        load_info = {}
         
-            ptr = 64
-            while ptr < len(data):
-            
-                low = (address + ptr) & 0xff
-                high = (address + ptr) >> 8
-                markers += chr(low) + chr(high) + data[ptr]
-                ptr += 128
-                n += 1
+        for name, label, address, data in unpacked_files:
+        
+            if compress_files:
+                # Compress the file and load it so that it ends at the start of
+                # screen memory. The loader decompresses it into place before
+                # the next file is loaded.
+                compressed = "".join(map(chr, distance_pair.compress(
+                    map(ord, data), parse = "optimal")))
+                load_info[name] = (0x5800 - len(compressed), compressed)
+            else:
+                load_info[name] = (address, data)
         
-        markers = chr(n) + markers
+        marker_info = [load_info["LEVELS"],
+                       load_info["PANEL"],
+                       (code_load_address, code)]
+        markers = create_markers(marker_info)
         
         extras_oph = constants_oph + (
             "; Additional definitions for the loader\n\n"
@@ -919,11 +1575,34 @@ if __name__ == "__main__":
             ) % ((code_start,) + address_length_end(code_load_address, code) + \
                  (len(markers),))
         
-        open("loader-constants.oph", "w").write(extras_oph)
+        # Define the addresses used to load the files that can be compressed.
+        suffixes = ("load_low", "load_high", "load_length_low",
+                    "load_length_high", "load_end_low", "load_end_high")
+        
+        for name, label, address, data in unpacked_files:
         
-        system("ophis loader.oph -o LOADER")
-        loader_code = open("LOADER").read() + markers + title_data
-        os.remove("LOADER")
+            values = address_length_end(*load_info[name])
+            for suffix, value in zip(suffixes, values):
+                extras_oph += ".alias %-32s $%02x\n" % (label + "_" + suffix, value)
+            extras_oph += "\n"
+        
+        if compress_files:
+            extras_oph += distance_pair.default_format.aliases() + "\n"
+            unpack_oph = '.include "unpack.oph"\n'
+        else:
+            unpack_oph = (
+                "; The files are not compressed, so there is nothing to unpack.\n"
+                "unpack_sprites:\n"
+                "unpack_levels:\n"
+                "unpack_panel:\n"
+                "    rts\n"
+                )
+        
+        open(os.path.join(work_dir, "loader-constants.oph"), "w").write(extras_oph)
+        open(os.path.join(work_dir, "loader-unpack.oph"), "w").write(unpack_oph)
+        
+        assembled_loader = assemble("loader.oph", cache, work_dir, profiler, backend)
+        loader_code = assembled_loader + markers + title_data
         
         files = []
         
@@ -933,9 +1612,9 @@ if __name__ == "__main__":
                 files.append(("!BOOT", 0, 0, boot_data))
             
             if retro_loader.endswith("D"):
-                files.append(("RETRO", 0x1900, 0x8023, open(os.path.join("resources", retro_loader), "rb").read()))
+                files.append(("RETRO", 0x1900, 0x8023, open(source_path(os.path.join("resources", retro_loader)), "rb").read()))
             else:
-                files.append(("RETRO", 0x1d00, 0x8023, open(os.path.join("resources", retro_loader), "rb").read()))
+                files.append(("RETRO", 0x1d00, 0x8023, open(source_path(os.path.join("resources", retro_loader)), "rb").read()))
         
         elif make_tape_image:
             bootloader_start = 0xe00
@@ -949,19 +1628,38 @@ if __name__ == "__main__":
         
         files += [("LOADER", loader_start, loader_start, loader_code),
                   ("ROUTINE", title_data_address, title_data_address,
-                               title_data_routines),
-                  ("SPRITES", sprite_area_address, sprite_area_address,
-                              sprite_data + char_data),
-                  ("LEVELS", levels_address, levels_address, level_data),
-                  ("PANEL", panel_address, panel_address, panel),
-                  ("CODE", code_load_address, code_load_address, code)]
+                               title_data_routines)]
+        
+        for name, label, address, data in unpacked_files:
+            load_address, file_data = load_info[name]
+            files.append((name, load_address, load_address, file_data))
+        
+        files.append(("CODE", code_load_address, code_load_address, code))
         
         loader_size = len(loader_code)
-        print
-        print "%i bytes (%04x) of loader code" % (loader_size, loader_size)
+        log("")
+        log("%i bytes (%04x) of loader code" % (loader_size, loader_size))
         
-        print "%i bytes (%04x) of code" % (code_size, code_size)
-        print
+        if compress_files:
+        
+            log("")
+            for name, label, address, data in unpacked_files:
+            
+                load_address, compressed = load_info[name]
+                if load_address < loader_start + loader_size:
+                    raise BuildError("Compressed %s overlaps the loader by %i bytes." % (
+                        name, loader_start + loader_size - load_address))
+                
+                blocks, seconds = tape_details(name, address, data)
+                new_blocks, new_seconds = tape_details(name, load_address, compressed)
+                log("%-7s compressed from %i to %i bytes at %04x "
+                    "(%i tape blocks saved, %.1fs instead of %.1fs at 1200 baud)" % (
+                    name, len(data), len(compressed), load_address,
+                    blocks - new_blocks, new_seconds, seconds))
+        
+        log("%i bytes (%04x) of code" % (code_size, code_size))
+        log("")
+        profiler.stop()
     
     # Calculate the amount of space used for the loader and pre-relocated main
     # game code.
@@ -969,154 +1667,320 @@ if __name__ == "__main__":
     if make_loader:
     
         loader_finish = loader_start + loader_size
-        print "LOADER runs from %04x to %04x" % (loader_start, loader_finish)
+        log("LOADER runs from %04x to %04x" % (loader_start, loader_finish))
         
         code_load_finish = code_load_address + code_size
-        print "CODE runs from %04x to %04x" % (code_load_address, code_load_finish)
-        print
+        log("CODE runs from %04x to %04x" % (code_load_address, code_load_finish))
+        log("")
     
     # Calculate the amount of working space used.
     
     working_free = memory_map["palette start"] - working_end
-    print "Working data area runs from %04x to %04x" % (memory_map["working area"], working_end),
     if working_free < 0:
-        print
-        sys.stderr.write("Working data area overruns following data by %i bytes.\n" % -working_free)
-        sys.exit(1)
-    else:
-        print "(%i bytes free)" % working_free
-    print
+        raise BuildError("Working data area overruns following data by %i bytes." % -working_free)
+    
+    log("Working data area runs from %04x to %04x (%i bytes free)" % (
+        memory_map["working area"], working_end, working_free))
+    log("")
     
     # Calculate the amount of memory used for each file.
     
+    try:
+        layout.check("CODE", code_size)
+    except memorylayout.LayoutError, exception:
+        raise BuildError(str(exception))
+    
     code_finish = code_start + code_size
-    print "CODE    runs from %04x to %04x" % (code_start, code_finish),
-    if code_finish > data_start:
-        print
-        sys.stderr.write("CODE overruns following data by %i bytes.\n" % (code_finish - data_start))
-        sys.exit(1)
-    else:
-        code_padding = (data_start - code_finish)
-        print "(%i bytes free)" % code_padding
-        code += "\x00" * code_padding
+    code_padding = (data_start - code_finish)
+    log("CODE    runs from %04x to %04x (%i bytes free)" % (
+        code_start, code_finish, code_padding))
+    code += "\x00" * code_padding
     
     levels_finish = levels_address + len(level_data)
-    print "LEVELS  runs from %04x to %04x" % (levels_address, levels_finish),
     if levels_finish > sprite_area_address:
-        print
-        sys.stderr.write("LEVELS overruns following data by %i bytes.\n" % (levels_finish - sprite_area_address))
-        sys.exit(1)
-    else:
-        levels_padding = (sprite_area_address - levels_finish)
-        print "(%i bytes free)" % levels_padding
-        level_data += "\x00" * levels_padding
+        raise BuildError("LEVELS overruns following data by %i bytes." % (levels_finish - sprite_area_address))
+    
+    levels_padding = (sprite_area_address - levels_finish)
+    log("LEVELS  runs from %04x to %04x (%i bytes free)" % (
+        levels_address, levels_finish, levels_padding))
+    level_data += "\x00" * levels_padding
     
     char_area_finish = sprite_area_address + len(sprite_data) + len(char_data)
-    print "SPRITES runs from %04x to %04x" % (sprite_area_address, char_area_finish)
-    #if char_area_finish > panel_address:
-    #    sys.stderr.write("SPRITES overruns following data by %i bytes.\n" % (char_area_finish - panel_address))
-    #    sys.exit(1)
+    log("SPRITES runs from %04x to %04x" % (sprite_area_address, char_area_finish))
+    log("")
     
-    if make_tape_image:
+    report += layout.report({"CODE": code_size})
     
-        u = UEFfile.UEFfile(creator = 'build.py for Castle Raider ' + version)
-        u.minor = 6
-        u.target_machine = "Electron"
-        
-        u.import_files(0, files, gap=True)
-        
-        # Append instructions and short title chunks to the file.
-        #README = open("README.txt").read()
-        #COPYING = open("COPYING").read()
-        #u.chunks += [(0x1, README + "\n\n" + COPYING), (0x9, "Castle Raider " + version)]
-        
-        # Write the new UEF file.
-        try:
-            u.write(out_file, write_emulator_info = False)
-        except UEFfile.UEFfile_error:
-            sys.stderr.write("Couldn't write the new executable to %s.\n" % out_file)
-            sys.exit(1)
-        
-        print
-        print "Written", out_file
+    profiler.start("image")
     
-    elif make_adfs_image:
+    if make_rom_image:
     
-        disk = makeadf.Disk("M")
-        disk.new()
-        
-        catalogue = disk.catalogue()
-        catalogue.boot_option = 3
-        
-        disk_files = []
-        for name, load, exec_, data in files:
-            disk_files.append(makeadf.File(name, data, load, exec_, len(data)))
-        
-        COPYING = open("COPYING").read().replace("\n", "\r\n")
-        disk_files.append(makeadf.File("COPYING", COPYING, 0x0000, 0x0000, len(COPYING)))
+        rom_data = (
+            code + level_data + sprite_data + char_data + panel + \
+            title_data_routines
+            )
         
-        dir_address = catalogue.sector_size * 2
-        catalogue.write("$", "CastleRaider", disk_files, dir_address, dir_address)
-        catalogue.write_free_space()
+        # The free space in the ROM follows the code.
+        log("ROM     runs from %x to %x (%i bytes free)" % (
+            memory_map["code start"],
+            memory_map["code start"] + len(rom_data),
+            code_padding))
         
-        disk.file.seek(0, 0)
-        disk_data = disk.file.read()
-        open(out_file, "w").write(disk_data)
+        if len(rom_data) < 16384:
+            rom_data += "\x00" * (16384 - len(rom_data))
         
-        print
-        print "Written", out_file
+        image = rom_data
     
-    elif make_dfs_image:
+    else:
+        image = create_image(format, files, work_dir)
     
-        disk = makedfs.Disk()
-        disk.new()
+    profiler.stop()
+    
+    if make_loader:
+        sizes = dict(map(lambda (name, load, exec_, data): (name, len(data)), files))
+    else:
+        sizes = {"CODE": code_size,
+                 "LEVELS": levels_finish - levels_address,
+                 "SPRITES": len(sprite_data) + len(char_data),
+                 "PANEL": len(panel),
+                 "ROUTINE": len(title_data_routines)}
+    
+    regions = layout.describe({"CODE": code_size})
+    regions.append({"name": "working area", "start": memory_map["working area"],
+                    "end": working_end,
+                    "size": working_end - memory_map["working area"],
+                    "free": working_free,
+                    "space": memory_map["palette start"] - memory_map["working area"]})
+    
+    symbols = sizereport.parse_aliases(constants_oph)
+    
+    # Record the results needed to update the image for a new level file.
+    state = {"format": format, "compressed files": compress_files,
+             "level limits": level_args[1:], "levels address": levels_address,
+             "levels space": sprite_area_address - levels_address,
+             "code start": code_start, "levels": levels_results,
+             "image": image, "memory map": memory_map, "sizes": sizes,
+             "regions": regions, "symbols": symbols, "report": report[:]}
+    
+    if make_loader:
+        state.update({"files": files, "loader": assembled_loader,
+                      "marker info": marker_info, "title data": title_data})
+    
+    return BuildResult(image, memory_map, sizes, profiler.totals(), report,
+                       regions, symbols, state)
+
+
+def watch(targets, interval = 0.2, delay = 0.3):
+
+    """Builds each of the targets, given as dictionaries of arguments to the
+    build function, then builds them again whenever the files they use
+    change, checking the files every interval seconds. Changes are collected
+    until no files have changed for the given delay in seconds. A change to a
+    level file only causes the targets using it to be built again. Returns
+    when one of the Python modules used by the build changes because the
+    running build cannot use the new code.
+    """
+    level_files = map(lambda target: os.path.abspath(
+        target.get("level_file") or source_path("levels/default.txt")), targets)
+    
+    changed_targets = targets
+    times = file_times(watched_files(level_files))
+    
+    while True:
+    
+        for target in changed_targets:
         
-        catalogue = disk.catalogue()
-        catalogue.boot_option = 3
+            start = time.time()
+            try:
+                result = build(**target)
+            except BuildError, exception:
+                print str(exception)
+                continue
+            
+            stages = filter(lambda line: line.startswith("Only the level file"),
+                            result.report)
+            print " ".join(["Built %s in %.2fs." % (target.get("out"),
+                                                   time.time() - start)] + stages)
         
-        disk_files = []
+        print "Waiting for changes..."
         
-        for name, load, exec_, data in files:
-            disk_files.append(makedfs.File("$." + name, data, load, exec_, len(data)))
+        # Wait for files to change, then wait until they stop changing.
+        while True:
         
-        COPYING = open("COPYING").read().replace("\n", "\r\n")
-        disk_files.append(makedfs.File("$.COPYING", COPYING, 0x0000, 0x0000, len(COPYING)))
+            time.sleep(interval)
+            new_times = file_times(watched_files(level_files))
+            if new_times != times:
+                break
         
-        catalogue.write("CastleRaider", disk_files)
+        while True:
         
-        disk.file.seek(0, 0)
-        disk_data = disk.file.read()
-        open(out_file, "w").write(disk_data)
+            time.sleep(delay)
+            latest_times = file_times(watched_files(level_files))
+            if latest_times == new_times:
+                break
+            new_times = latest_times
         
-        print
-        print "Written", out_file
-    
-    elif make_rom_image:
-    
-        rom_data = (
-            code + level_data + sprite_data + char_data + panel + \
-            title_data_routines
-            )
+        changed = filter(lambda path: times.get(path) != new_times.get(path),
+                         set(times.keys() + new_times.keys()))
+        times = new_times
         
-        print "ROM     runs from %x to %x (%i bytes free)" % (
-            memory_map["code start"],
-            memory_map["code start"] + len(rom_data),
-            0x4000 - len(rom_data))
+        if filter(lambda path: path.endswith(".py"), changed):
+            return
         
-        if len(rom_data) < 16384:
-            rom_data += "\x00" * (16384 - len(rom_data))
+        # Only build the targets that use a changed level file unless other
+        # files have also changed.
+        if set(changed).issubset(level_files):
+            changed_targets = filter(lambda (target, path): path in changed,
+                                     zip(targets, level_files))
+            changed_targets = map(lambda (target, path): target, changed_targets)
+        else:
+            changed_targets = targets
+
+def main(args):
+
+    menu = "-m" in args
+    if menu:
+        args.remove("-m")
+    
+    compress_files = "-c" in args
+    if compress_files:
+        args.remove("-c")
+    
+    use_cache = "--no-cache" not in args
+    if not use_cache:
+        args.remove("--no-cache")
+    
+    batch_routines = "--separate-routines" not in args
+    if not batch_routines:
+        args.remove("--separate-routines")
+    
+    watch_files = "--watch" in args
+    if watch_files:
+        args.remove("--watch")
+    
+    # Options for reporting on the use of memory and checking it against a
+    # budget, and for recording where the time is spent in the build.
+    options = {}
+    for option in ("--report", "--html", "--budget", "--baseline", "--assembler",
+                   "--trace", "--profile", "--checkpoints"):
+        if option in args:
+            i = args.index(option)
+            options[option] = args[i + 1:i + 2]
+            del args[i:i + 2]
+    
+    if not 4 <= len(args) <= 5 or [] in options.values():
+    
+        sys.stderr.write("Usage: %s [-c] [--no-cache] [--separate-routines] [--watch] "
+            "[--assembler ophis|python] [--checkpoints <interval>] [--report <JSON file>] [--html <HTML file>] [--budget <budget file> "
+            "[--baseline <previous JSON report>]] [--trace <JSON file>] [--profile <stats file>] -e|-b -t|-a|-d|-r "
+            "<new UEF, ADF, SSD or ROM file> [level file]\n" % args[0])
+        return 1
+    
+    if watch_files and set(options.keys()) - set(["--assembler", "--checkpoints"]):
+        sys.stderr.write("The report, budget and profiling options cannot be used with --watch.\n")
+        return 1
+    
+    machine_types = {"-e": "electron", "-b": "bbc"}
+    image_formats = {"-t": "tape", "-a": "adfs", "-d": "dfs", "-r": "rom"}
+    
+    if args[1] not in machine_types:
+        sys.stderr.write("Please specify a valid machine type.\n")
+        return 1
+    
+    if args[2] not in image_formats:
+        sys.stderr.write("Please specify a valid image format.\n")
+        return 1
+    
+    backend = options.get("--assembler", ["ophis"])[0]
+    if backend not in backends:
+        sys.stderr.write("Please specify a valid assembler: %s\n" % ", ".join(backends))
+        return 1
+    
+    if "--checkpoints" in options:
+        try:
+            checkpoint_interval = int(options["--checkpoints"][0])
+        except ValueError:
+            checkpoint_interval = 0
         
-        open(out_file, "w").write(rom_data)
+        if checkpoint_interval not in checkpoint_intervals:
+            sys.stderr.write("Please specify a checkpoint interval that is a power of 2 from 2 to 256.\n")
+            return 1
+    else:
+        checkpoint_interval = None
+    
+    if len(args) == 5:
+        level_file = args[4]
+    else:
+        level_file = None
+    
+    if watch_files:
+    
+        # Build the image whenever its sources change, starting the script
+        # again if the build scripts themselves change.
+        target = {"machine": machine_types[args[1]],
+                  "format": image_formats[args[2]], "level_file": level_file,
+                  "menu": menu, "out": args[3],
+                  "compress_files": compress_files, "use_cache": use_cache,
+                  "batch_routines": batch_routines, "backend": backend,
+                  "checkpoint_interval": checkpoint_interval}
+        try:
+            watch([target])
+        except KeyboardInterrupt:
+            return 0
         
+        print "The build scripts have changed. Restarting."
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+    
+    try:
+        result = build(machine_types[args[1]], image_formats[args[2]],
+                       level_file, menu, args[3], compress_files, use_cache,
+                       batch_routines, backend, "--profile" in options,
+                       checkpoint_interval)
+    except BuildError, exception:
+        sys.stderr.write(str(exception) + "\n")
+        return 1
+    
+    print "\n".join(result.report)
+    
+    if "--trace" in options or "--profile" in options:
         print
-        print "Written", out_file
+        print "\n".join(result.profiler.summary())
     
-    # Remove temporary files.
-    os.remove("bank_routines.oph")
-    #os.remove("constants.oph")
-    if make_loader:
-        os.remove("loader-constants.oph")
-    os.remove("screen.oph")
+    if "--trace" in options:
+        result.profiler.write_trace(options["--trace"][0])
+    if "--profile" in options:
+        result.profiler.write_python_profile(options["--profile"][0])
     
-    # Exit
-    sys.exit()
+    report = sizereport.create_report(result, {
+        "version": version, "machine": machine_types[args[1]],
+        "format": image_formats[args[2]], "level file": level_file,
+        "menu": menu, "compressed files": compress_files})
+    
+    if "--report" in options:
+        sizereport.write_json(report, options["--report"][0])
+    if "--html" in options:
+        sizereport.write_html(report, options["--html"][0])
+    
+    if "--budget" in options:
+    
+        try:
+            budget = sizereport.read_budget(options["--budget"][0])
+            if "--baseline" in options:
+                baseline = sizereport.read_json(options["--baseline"][0])
+            else:
+                baseline = None
+            messages = sizereport.check_budget(report, budget, baseline)
+        except (sizereport.BudgetError, IOError, ValueError), exception:
+            sys.stderr.write(str(exception) + "\n")
+            return 1
+        
+        if messages:
+            sys.stderr.write("\n".join(["The build exceeds its size budget:"] + messages) + "\n")
+            return 1
+    
+    return 0
+
+
+if __name__ == "__main__":
+
+    sys.exit(main(sys.argv[:]))
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+"""
+Copyright (C) 2016 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os, sys
+
+import build, make_release
+from tools import assembler
+
+# The py65 package provides the 6502 emulator used to run the loader.
+try:
+    from py65.devices.mpu6502 import MPU
+except ImportError:
+    MPU = None
+
+# Builds each tape and disk target with compressed files, then loads each
+# compressed file into an emulated 6502 and runs the loader routine that
+# decompresses it, in the order that the loader uses them. The data in memory
+# is then compared with the files in the image built without compression.
+
+unpack_routines = [("SPRITES", "unpack_sprites"), ("LEVELS", "unpack_levels"),
+                   ("PANEL", "unpack_panel")]
+
+# Routines return to this address, where the emulator stops.
+return_address = 0xff00
+
+def build_target(machine, format, compress_files):
+
+    # Build the target with the assembler in the tools package, recording the
+    # symbols defined by the loader, and return a dictionary mapping the names
+    # of the files in the image to their load addresses and contents.
+    symbols = {}
+    assemble = assembler.assemble
+    
+    def record(path, directory = os.curdir):
+        code, defined = assemble(path, directory)
+        if path == "loader.oph":
+            symbols.update(defined)
+        return code, defined
+    
+    # The modules used to read the sprites and levels print information.
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    assembler.assemble = record
+    try:
+        result = build.build(machine, format, compress_files = compress_files,
+                             use_cache = False, backend = "python")
+    finally:
+        assembler.assemble = assemble
+        sys.stdout = stdout
+    
+    files = dict(map(lambda (name, load, exec_, data): (name, (load, data)),
+                     result.state["files"]))
+    return files, symbols
+
+def call(mpu, address, limit = 50000000):
+
+    # Call the routine at the given address, returning when it returns.
+    mpu.memory[0x1ff] = (return_address - 1) >> 8
+    mpu.memory[0x1fe] = (return_address - 1) & 0xff
+    mpu.sp = 0xfd
+    mpu.pc = address
+    
+    steps = 0
+    while mpu.pc != return_address:
+        mpu.step()
+        steps += 1
+        if steps > limit:
+            raise build.BuildError("Routine at $%04x did not return." % address)
+
+def check(machine, format):
+
+    compressed_files, symbols = build_target(machine, format, True)
+    files, unused = build_target(machine, format, False)
+    
+    mpu = MPU()
+    mpu.memory = [0] * 0x10000
+    
+    load, data = compressed_files["LOADER"]
+    mpu.memory[load:load + len(data)] = map(ord, data)
+    
+    # Load and decompress each file in turn, as the loader does, checking the
+    # files unpacked so far after each one. The end of one file may be
+    # overlapped by a later one, as the sprites are by the panel, so only the
+    # bytes that later files do not cover are compared.
+    unpacked = []
+    
+    for name, routine in unpack_routines:
+    
+        load, data = compressed_files[name]
+        mpu.memory[load:load + len(data)] = map(ord, data)
+        call(mpu, symbols[routine])
+        
+        unpacked.append(name)
+        
+        for i, earlier in enumerate(unpacked):
+        
+            address, data = files[earlier]
+            covered = set()
+            for later in unpacked[i + 1:]:
+                later_address, later_data = files[later]
+                covered.update(range(later_address, later_address + len(later_data)))
+            
+            for offset in range(len(data)):
+                value = mpu.memory[address + offset]
+                if address + offset not in covered and value != ord(data[offset]):
+                    return "%s differs at offset %i after %s ($%02x instead of $%02x)" % (
+                        earlier, offset, routine, value, ord(data[offset]))
+    
+    return None
+
+
+if __name__ == "__main__":
+
+    if MPU is None:
+        sys.stderr.write("The py65 package is needed to run the loader code.\n")
+        sys.exit(1)
+    
+    failed = 0
+    
+    for name, machine, format, file_name in make_release.targets:
+    
+        # Only the loaders for tape and disk images decompress files.
+        if format == "rom":
+            continue
+        
+        try:
+            difference = check(machine, format)
+        except build.BuildError, exception:
+            difference = str(exception)
+        
+        if difference is None:
+            print "%-20s unpacked correctly" % name
+        else:
+            print "%-20s %s" % (name, difference)
+            failed += 1
+    
+    if failed:
+        sys.exit(1)
+    
+    sys.exit()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""
+Copyright (C) 2016 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import gzip, os, StringIO, sys
+
+import build, make_release
+
+# Builds each release target with Ophis and with the assembler in the tools
+# package, checking that the images are identical.
+
+def image_contents(data):
+
+    # UEF files are compressed with gzip, which records the time that the
+    # file was written, so compare their uncompressed contents.
+    if data.startswith("\x1f\x8b"):
+        return gzip.GzipFile(fileobj = StringIO.StringIO(data)).read()
+    
+    return data
+
+def compare(machine, format):
+
+    images = []
+    
+    for backend in build.backends:
+    
+        # The modules used to read the sprites and levels print information.
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            result = build.build(machine, format, backend = backend)
+        finally:
+            sys.stdout = stdout
+        
+        images.append(image_contents(result.data))
+    
+    ophis_image, python_image = images
+    
+    if ophis_image == python_image:
+        return None
+    
+    for i in range(min(len(ophis_image), len(python_image))):
+        if ophis_image[i] != python_image[i]:
+            return "images differ at offset %i" % i
+    
+    return "images have different lengths (%i and %i bytes)" % (
+        len(ophis_image), len(python_image))
+
+
+if __name__ == "__main__":
+
+    failed = 0
+    
+    for name, machine, format, file_name in make_release.targets:
+    
+        try:
+            difference = compare(machine, format)
+        except build.BuildError, exception:
+            difference = str(exception)
+        
+        if difference is None:
+            print "%-20s identical" % name
+        else:
+            print "%-20s %s" % (name, difference)
+            failed += 1
+    
+    if failed:
+        sys.exit(1)
+    
+    sys.exit()
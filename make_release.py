@@ -17,40 +17,130 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import os, shutil, sys
+import multiprocessing, os, shutil, sys, time
+
+import build
+
+# Each target is described by a name, the machine and image format passed to
+# the build function and the name of the file to create.
+targets = [
+    # Make cassette, ADFS, DFS and ROM versions for the Electron.
+    ("Electron cassette", "electron", "tape", "CastleRaider-%s-Electron.uef"),
+    ("Electron ADFS", "electron", "adfs", "CastleRaider-%s-Electron.adf"),
+    ("Electron DFS", "electron", "dfs", "CastleRaider-%s-Electron.ssd"),
+    ("Electron ROM", "electron", "rom", "CastleRaider-%s-Electron.rom"),
+    # Make cassette, DFS and ROM versions for the BBC Micro.
+    ("BBC cassette", "bbc", "tape", "CastleRaider-%s-BBC.uef"),
+    ("BBC DFS", "bbc", "dfs", "CastleRaider-%s-BBC.ssd"),
+    ("BBC ROM", "bbc", "rom", "CastleRaider-%s-BBC.rom"),
+    # Make the ADFS version for the Master Compact.
+    ("Compact ADFS", "bbc", "adfs", "CastleRaider-%s-Compact.adf"),
+    ]
 
 def system(command):
 
     if os.system(command):
         sys.exit(1)
 
+def build_target(details):
+
+    # Build a target, writing the build report to a log file. Each build uses
+    # its own working directory, so builds in different processes do not
+    # interfere with each other. Return the details of the build.
+    name, machine, format, out_file, log_file = details
+    
+    start = time.time()
+    log = open(log_file, "w")
+    
+    # The modules used to read the sprites and levels print information, so
+    # include that in the log as well.
+    stdout = sys.stdout
+    sys.stdout = log
+    
+    try:
+        try:
+            result = build.build(machine, format, out = out_file)
+            log.write("\n".join(result.report) + "\n")
+            status = 0
+        except build.BuildError, exception:
+            log.write(str(exception) + "\n")
+            status = 1
+    finally:
+        sys.stdout = stdout
+        log.close()
+    
+    return name, out_file, log_file, status, time.time() - start
+
+def build_targets(details, jobs):
+
+    # Build the targets concurrently, stopping at the first failure.
+    pool = multiprocessing.Pool(jobs)
+    results = []
+    
+    for result in pool.imap_unordered(build_target, details):
+    
+        name, out_file, log_file, status, seconds = result
+        results.append(result)
+        
+        if status != 0:
+            pool.terminate()
+            pool.join()
+            sys.stderr.write("Failed to build %s (see %s):\n\n" % (name, log_file))
+            sys.stderr.write(open(log_file).read())
+            sys.exit(1)
+        
+        print "Built", name
+    
+    pool.close()
+    pool.join()
+    
+    return results
+
+def print_summary(results):
+
+    print
+    print "%-20s %-36s %8s %8s" % ("Target", "File", "Bytes", "Seconds")
+    
+    # Show the results in the order the targets are defined.
+    names = map(lambda target: target[0], targets)
+    results = sorted(results, key = lambda result: names.index(result[0]))
+    
+    for name, out_file, log_file, status, seconds in results:
+        print "%-20s %-36s %8i %8.1f" % (
+            name, os.path.split(out_file)[1], os.stat(out_file).st_size, seconds)
+    print
+
 if __name__ == "__main__":
 
-    if len(sys.argv) != 2:
-        sys.stderr.write("Usage: %s <version>\n" % sys.argv[0])
+    args = sys.argv[:]
+    jobs = multiprocessing.cpu_count()
+    
+    if "-j" in args:
+        i = args.index("-j")
+        jobs = int(args[i + 1])
+        del args[i:i + 2]
+    
+    if len(args) != 2:
+        sys.stderr.write("Usage: %s [-j <jobs>] <version>\n" % sys.argv[0])
         sys.exit(1)
     
-    version = sys.argv[1]
+    version = args[1]
     release_dir = os.path.join("releases", "CastleRaider-%s" % version)
+    log_dir = os.path.join("releases", "CastleRaider-%s-logs" % version)
     
-    if not os.path.exists(release_dir):
-        os.mkdir(release_dir)
+    for path in release_dir, log_dir:
+        if not os.path.exists(path):
+            os.makedirs(path)
     
-    build_py = os.path.join(os.curdir, "build.py")
+    details = []
+    for name, machine, format, file_name in targets:
     
-    # Make cassette, ADFS, DFS and ROM versions for the Electron.
-    system(build_py + " -e -t " + os.path.join(release_dir, "CastleRaider-%s-Electron.uef" % version))
-    system(build_py + " -e -a " + os.path.join(release_dir, "CastleRaider-%s-Electron.adf" % version))
-    system(build_py + " -e -d " + os.path.join(release_dir, "CastleRaider-%s-Electron.ssd" % version))
-    system(build_py + " -e -r " + os.path.join(release_dir, "CastleRaider-%s-Electron.rom" % version))
+        out_file = os.path.abspath(os.path.join(release_dir, file_name % version))
+        log_file = os.path.abspath(os.path.join(log_dir, name.replace(" ", "-") + ".log"))
+        details.append((name, machine, format, out_file, log_file))
     
-    # Make cassette, DFS and ROM versions for the BBC Micro.
-    system(build_py + " -b -t " + os.path.join(release_dir, "CastleRaider-%s-BBC.uef" % version))
-    system(build_py + " -b -d " + os.path.join(release_dir, "CastleRaider-%s-BBC.ssd" % version))
-    system(build_py + " -b -r " + os.path.join(release_dir, "CastleRaider-%s-BBC.rom" % version))
-
-    # Make the ADFS version for the Master Compact.
-    system(build_py + " -b -a " + os.path.join(release_dir, "CastleRaider-%s-Compact.adf" % version))
+    results = build_targets(details, jobs)
+    print_summary(results)
     
     # Copy the instructions and license files into the archive.
     shutil.copy2("README.txt", os.path.join(release_dir, "README.txt"))
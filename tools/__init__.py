@@ -1 +1 @@
-__all__ = ["compress", "diskutils", "makeadf", "makedfs", "makelevels", "makesprites"]
+__all__ = ["assembler", "buildcache", "buildprofile", "compress", "diskutils", "frequencies", "makeadf", "makedfs", "makelevels", "makesprites", "memorylayout", "sizereport"]
@@ -0,0 +1,615 @@
+"""
+Copyright (C) 2016 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os, re
+
+# A 6502 assembler for the subset of the Ophis syntax used by the game's
+# sources: labels, the .alias, .byte, .word, .org, .include, .macro, .macend
+# and .invoke directives, and expressions using numbers, labels, the < and >
+# operators, the arithmetic and bitwise operators and square brackets for
+# grouping. As in Ophis, instructions use zero page addressing when the value
+# of their operand is less than 256.
+
+class AssemblerError(Exception):
+
+    pass
+
+# Opcodes for each instruction, indexed by addressing mode.
+
+opcodes = {}
+
+def add_opcodes(modes, table):
+
+    for line in table.strip().split("\n"):
+        pieces = line.split()
+        opcodes[pieces[0]] = dict(filter(lambda (mode, value): value != "-",
+                                         zip(modes, pieces[1:])))
+
+add_opcodes(("imm", "zp", "zpx", "abs", "absx", "absy", "indx", "indy"), """
+adc 69 65 75 6d 7d 79 61 71
+and 29 25 35 2d 3d 39 21 31
+cmp c9 c5 d5 cd dd d9 c1 d1
+eor 49 45 55 4d 5d 59 41 51
+lda a9 a5 b5 ad bd b9 a1 b1
+ora 09 05 15 0d 1d 19 01 11
+sbc e9 e5 f5 ed fd f9 e1 f1
+sta -  85 95 8d 9d 99 81 91
+""")
+
+add_opcodes(("imp", "zp", "zpx", "abs", "absx"), """
+asl 0a 06 16 0e 1e
+lsr 4a 46 56 4e 5e
+rol 2a 26 36 2e 3e
+ror 6a 66 76 6e 7e
+dec -  c6 d6 ce de
+inc -  e6 f6 ee fe
+""")
+
+add_opcodes(("imm", "zp", "zpx", "zpy", "abs", "absx", "absy"), """
+ldx a2 a6 -  b6 ae -  be
+ldy a0 a4 b4 -  ac bc -
+stx -  86 -  96 8e -  -
+sty -  84 94 -  8c -  -
+cpx e0 e4 -  -  ec -  -
+cpy c0 c4 -  -  cc -  -
+bit -  24 -  -  2c -  -
+""")
+
+add_opcodes(("abs", "ind"), """
+jmp 4c 6c
+jsr 20 -
+""")
+
+add_opcodes(("rel",), """
+bcc 90
+bcs b0
+beq f0
+bmi 30
+bne d0
+bpl 10
+bvc 50
+bvs 70
+""")
+
+add_opcodes(("imp",), """
+brk 00
+clc 18
+cld d8
+cli 58
+clv b8
+dex ca
+dey 88
+inx e8
+iny c8
+nop ea
+pha 48
+php 08
+pla 68
+plp 28
+rti 40
+rts 60
+sec 38
+sed f8
+sei 78
+tax aa
+tay a8
+tsx ba
+txa 8a
+txs 9a
+tya 98
+""")
+
+for modes in opcodes.values():
+    for mode in modes:
+        modes[mode] = int(modes[mode], 16)
+
+# The size of an instruction in each addressing mode.
+mode_sizes = {"imp": 1, "imm": 2, "zp": 2, "zpx": 2, "zpy": 2, "abs": 3,
+              "absx": 3, "absy": 3, "ind": 3, "indx": 2, "indy": 2, "rel": 2}
+
+# The zero page modes that can be used instead of absolute modes.
+zero_page_modes = {"abs": "zp", "absx": "zpx", "absy": "zpy"}
+
+token_re = re.compile(r'\s*(?:(\$[0-9a-fA-F]+|%[01]+|[0-9]+)|([A-Za-z_][A-Za-z0-9_]*)|("[^"]*")|(.))')
+label_re = re.compile(r'\s*([A-Za-z_][A-Za-z0-9_]*):')
+
+# Expressions
+
+def tokenise(text, where):
+
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    
+    while position < len(text):
+    
+        match = token_re.match(text, position)
+        number, name, string, other = match.groups()
+        position = match.end()
+        
+        if number is not None:
+            if number.startswith("$"):
+                tokens.append(("number", int(number[1:], 16)))
+            elif number.startswith("%"):
+                tokens.append(("number", int(number[1:], 2)))
+            elif len(number) > 1 and number.startswith("0"):
+                tokens.append(("number", int(number, 8)))
+            else:
+                tokens.append(("number", int(number)))
+        elif name is not None:
+            tokens.append(("label", name))
+        elif string is not None:
+            tokens.append(("string", string[1:-1]))
+        elif other is not None and not other.isspace():
+            tokens.append(("op", other))
+    
+    return tokens
+
+class Parser:
+
+    def __init__(self, tokens, where):
+    
+        self.tokens = tokens
+        self.position = 0
+        self.where = where
+    
+    def peek(self):
+    
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+    
+    def accept(self, op):
+    
+        if self.peek() == ("op", op):
+            self.position += 1
+            return True
+        return False
+    
+    def expect(self, op):
+    
+        if not self.accept(op):
+            raise AssemblerError("%s: Expected '%s'." % (self.where, op))
+    
+    def at_end(self):
+    
+        return self.position == len(self.tokens)
+    
+    def expression(self):
+    
+        # Bitwise operators have the lowest precedence, followed by addition
+        # and subtraction, then multiplication and division.
+        return self.binary(("&", "|", "^"),
+                   lambda: self.binary(("+", "-"),
+                       lambda: self.binary(("*", "/"), self.atom)))
+    
+    def binary(self, operators, read):
+    
+        result = read()
+        while self.peek()[0] == "op" and self.peek()[1] in operators:
+            op = self.peek()[1]
+            self.position += 1
+            result = ("op", op, result, read())
+        
+        return result
+    
+    def atom(self):
+    
+        if self.accept("<"):
+            return ("low", self.atom())
+        if self.accept(">"):
+            return ("high", self.atom())
+        if self.accept("["):
+            result = self.expression()
+            self.expect("]")
+            return result
+        
+        kind, value = self.peek()
+        if kind in ("number", "label"):
+            self.position += 1
+            return (kind, value)
+        
+        raise AssemblerError("%s: Invalid expression." % self.where)
+
+def evaluate(expr, symbols):
+
+    """Returns the value of the expression using the symbols given, or None
+    if it refers to a symbol that is not yet defined.
+    """
+    kind = expr[0]
+    
+    if kind == "number":
+        return expr[1]
+    elif kind == "label":
+        return symbols.get(expr[1])
+    elif kind == "low" or kind == "high":
+        value = evaluate(expr[1], symbols)
+        if value is None:
+            return None
+        elif kind == "low":
+            return value & 0xff
+        else:
+            return (value >> 8) & 0xff
+    
+    op, left, right = expr[1:]
+    left = evaluate(left, symbols)
+    right = evaluate(right, symbols)
+    if left is None or right is None:
+        return None
+    
+    if op == "+": return left + right
+    elif op == "-": return left - right
+    elif op == "*": return left * right
+    elif op == "/": return left / right
+    elif op == "&": return left & right
+    elif op == "|": return left | right
+    else: return left ^ right
+
+# Statements
+
+class Statement:
+
+    def __init__(self, kind, where, *args):
+    
+        self.kind = kind
+        self.where = where
+        self.args = args
+        self.mode = None
+
+def strip_comment(line):
+
+    in_string = False
+    for i in range(len(line)):
+        if line[i] == '"':
+            in_string = not in_string
+        elif line[i] == ";" and not in_string:
+            return line[:i]
+    
+    return line
+
+class Assembler:
+
+    def __init__(self, directory = os.curdir):
+    
+        self.directory = directory
+    
+    def read_file(self, path):
+    
+        try:
+            return open(os.path.join(self.directory, path)).read()
+        except IOError:
+            raise AssemblerError("Failed to read %s." % path)
+    
+    def assemble(self, path):
+    
+        """Assembles the file with the given path, relative to the assembler's
+        directory, returning a string containing the code and a dictionary
+        mapping the names of labels and aliases to their values.
+        """
+        self.macros = {}
+        statements = self.parse(path, self.read_file(path))
+        
+        symbols = self.resolve(statements)
+        return self.generate(statements, symbols), symbols
+    
+    def parse(self, path, text):
+    
+        statements = []
+        lines = text.split("\n")
+        i = 0
+        
+        while i < len(lines):
+        
+            where = "%s:%i" % (path, i + 1)
+            line = strip_comment(lines[i])
+            i += 1
+            
+            match = label_re.match(line)
+            while match:
+                statements.append(Statement("label", where, match.group(1)))
+                line = line[match.end():]
+                match = label_re.match(line)
+            
+            pieces = line.split(None, 1)
+            if not pieces:
+                continue
+            
+            word = pieces[0]
+            tokens = tokenise(line[line.index(word) + len(word):], where)
+            
+            if word == ".macro":
+                if len(tokens) != 1 or tokens[0][0] != "label":
+                    raise AssemblerError("%s: Expected a macro name." % where)
+                
+                # Collect the lines of the macro, which are parsed each time
+                # the macro is invoked.
+                start = i
+                while i < len(lines) and strip_comment(lines[i]).split()[:1] != [".macend"]:
+                    i += 1
+                if i == len(lines):
+                    raise AssemblerError("%s: Macro has no .macend directive." % where)
+                
+                self.macros[tokens[0][1]] = (start, lines[start:i])
+                i += 1
+            
+            elif word == ".invoke":
+                if len(tokens) != 1 or tokens[0][0] != "label":
+                    raise AssemblerError("%s: Expected a macro name." % where)
+                if tokens[0][1] not in self.macros:
+                    raise AssemblerError("%s: Undefined macro %s." % (where, tokens[0][1]))
+                
+                start, body = self.macros[tokens[0][1]]
+                statements += self.parse(path, "\n" * start + "\n".join(body))
+            
+            elif word == ".include":
+                if len(tokens) != 1 or tokens[0][0] != "string":
+                    raise AssemblerError("%s: Expected a file name." % where)
+                
+                name = tokens[0][1]
+                statements += self.parse(name, self.read_file(name))
+            
+            elif word.startswith("."):
+                statements.append(self.parse_directive(word, tokens, where))
+            
+            else:
+                statements.append(self.parse_instruction(word, tokens, where))
+        
+        return statements
+    
+    def parse_directive(self, word, tokens, where):
+    
+        parser = Parser(tokens, where)
+        
+        if word == ".alias":
+            kind, name = parser.peek()
+            if kind != "label":
+                raise AssemblerError("%s: Expected an alias name." % where)
+            parser.position += 1
+            statement = Statement("alias", where, name, parser.expression())
+        
+        elif word == ".org":
+            statement = Statement("org", where, parser.expression())
+        
+        elif word in (".byte", ".word"):
+            values = []
+            while True:
+                if parser.peek()[0] == "string":
+                    if word == ".word":
+                        raise AssemblerError("%s: Strings cannot be used with .word." % where)
+                    values += map(lambda c: ("number", ord(c)), parser.peek()[1])
+                    parser.position += 1
+                else:
+                    values.append(parser.expression())
+                if not parser.accept(","):
+                    break
+            
+            statement = Statement(word[1:], where, values)
+        
+        else:
+            raise AssemblerError("%s: Unsupported directive %s." % (where, word))
+        
+        if not parser.at_end():
+            raise AssemblerError("%s: Unexpected text after %s directive." % (where, word))
+        
+        return statement
+    
+    def parse_instruction(self, word, tokens, where):
+    
+        mnemonic = word.lower()
+        if mnemonic not in opcodes:
+            raise AssemblerError("%s: Unknown instruction %s." % (where, word))
+        
+        modes = opcodes[mnemonic]
+        parser = Parser(tokens, where)
+        
+        if parser.at_end():
+            mode, expr = "imp", None
+        elif parser.accept("#"):
+            mode, expr = "imm", parser.expression()
+        elif parser.accept("("):
+            expr = parser.expression()
+            if parser.accept(","):
+                if parser.peek() != ("label", "x") and parser.peek() != ("label", "X"):
+                    raise AssemblerError("%s: Expected (address,x)." % where)
+                parser.position += 1
+                parser.expect(")")
+                mode = "indx"
+            else:
+                parser.expect(")")
+                if parser.accept(","):
+                    if parser.peek() != ("label", "y") and parser.peek() != ("label", "Y"):
+                        raise AssemblerError("%s: Expected (address),y." % where)
+                    parser.position += 1
+                    mode = "indy"
+                else:
+                    mode = "ind"
+        else:
+            expr = parser.expression()
+            mode = "abs"
+            if parser.accept(","):
+                index = parser.peek()
+                if index[0] == "label" and index[1].lower() in ("x", "y"):
+                    parser.position += 1
+                    mode = "abs" + index[1].lower()
+                else:
+                    raise AssemblerError("%s: Expected an index register." % where)
+            
+            if "rel" in modes:
+                if mode != "abs":
+                    raise AssemblerError("%s: Branches cannot use index registers." % where)
+                mode = "rel"
+        
+        if not parser.at_end():
+            raise AssemblerError("%s: Unexpected text after instruction." % where)
+        
+        if mode not in modes and zero_page_modes.get(mode) not in modes:
+            raise AssemblerError("%s: Invalid addressing mode for %s." % (where, mnemonic))
+        
+        return Statement("instruction", where, mnemonic, mode, expr)
+    
+    def choose_mode(self, statement, symbols):
+    
+        mnemonic, mode, expr = statement.args
+        modes = opcodes[mnemonic]
+        
+        # Use zero page addressing if the operand is known to be in the zero
+        # page, or if the instruction has no absolute addressing mode.
+        if mode in zero_page_modes:
+            zp_mode = zero_page_modes[mode]
+            if zp_mode in modes:
+                value = evaluate(expr, symbols)
+                if mode not in modes or (value is not None and 0 <= value < 0x100):
+                    return zp_mode
+        
+        return mode
+    
+    def resolve(self, statements):
+    
+        # Assign addresses to labels, repeating until the sizes of all the
+        # instructions are stable. Instructions only ever change from absolute
+        # to zero page addressing, so this terminates.
+        symbols = {}
+        
+        while True:
+        
+            previous = dict(symbols)
+            changed = False
+            address = 0
+            defined = set()
+            
+            for statement in statements:
+            
+                kind = statement.kind
+                
+                if kind == "label" or kind == "alias":
+                    name = statement.args[0]
+                    if name in defined:
+                        raise AssemblerError("%s: Symbol %s is already defined." % (
+                            statement.where, name))
+                    defined.add(name)
+                    
+                    if kind == "label":
+                        symbols[name] = address
+                    else:
+                        value = evaluate(statement.args[1], symbols)
+                        if value is None:
+                            value = evaluate(statement.args[1], previous)
+                        if value is None:
+                            symbols.pop(name, None)
+                        else:
+                            symbols[name] = value
+                
+                elif kind == "org":
+                    value = evaluate(statement.args[0], symbols)
+                    if value is None:
+                        value = evaluate(statement.args[0], previous)
+                    if value is None:
+                        raise AssemblerError("%s: The address given to .org must be known." % statement.where)
+                    address = value
+                
+                elif kind == "byte":
+                    address += len(statement.args[0])
+                
+                elif kind == "word":
+                    address += 2 * len(statement.args[0])
+                
+                else:
+                    # Instructions that use zero page addressing keep using it.
+                    mode = self.choose_mode(statement, previous)
+                    if statement.mode in zero_page_modes.values():
+                        mode = statement.mode
+                    if mode != statement.mode:
+                        statement.mode = mode
+                        changed = True
+                    
+                    address += mode_sizes[mode]
+            
+            if not changed and symbols == previous:
+                return symbols
+    
+    def generate(self, statements, symbols):
+    
+        output = []
+        address = 0
+        
+        for statement in statements:
+        
+            kind = statement.kind
+            where = statement.where
+            
+            if kind == "org":
+                address = evaluate(statement.args[0], symbols)
+            
+            elif kind == "byte":
+                for expr in statement.args[0]:
+                    value = self.value(expr, symbols, where)
+                    if not -0x80 <= value < 0x100:
+                        raise AssemblerError("%s: Byte value %i is out of range." % (where, value))
+                    output.append(chr(value & 0xff))
+                address += len(statement.args[0])
+            
+            elif kind == "word":
+                for expr in statement.args[0]:
+                    value = self.value(expr, symbols, where)
+                    if not -0x8000 <= value < 0x10000:
+                        raise AssemblerError("%s: Word value %i is out of range." % (where, value))
+                    output.append(chr(value & 0xff) + chr((value >> 8) & 0xff))
+                address += 2 * len(statement.args[0])
+            
+            elif kind == "instruction":
+                mnemonic, mode, expr = statement.args
+                mode = statement.mode
+                output.append(chr(opcodes[mnemonic][mode]))
+                
+                if mode == "rel":
+                    offset = self.value(expr, symbols, where) - (address + 2)
+                    if not -0x80 <= offset < 0x80:
+                        raise AssemblerError("%s: Branch target is out of range by %i bytes." % (
+                            where, offset < 0 and -0x80 - offset or offset - 0x7f))
+                    output.append(chr(offset & 0xff))
+                
+                elif mode_sizes[mode] == 2 and mode != "imp":
+                    value = self.value(expr, symbols, where)
+                    if not 0 <= value < 0x100:
+                        raise AssemblerError("%s: Operand $%x is too large for %s." % (
+                            where, value, mnemonic))
+                    output.append(chr(value))
+                
+                elif mode_sizes[mode] == 3:
+                    value = self.value(expr, symbols, where)
+                    if not 0 <= value < 0x10000:
+                        raise AssemblerError("%s: Operand $%x is out of range." % (where, value))
+                    output.append(chr(value & 0xff) + chr(value >> 8))
+                
+                address += mode_sizes[mode]
+        
+        return "".join(output)
+    
+    def value(self, expr, symbols, where):
+    
+        value = evaluate(expr, symbols)
+        if value is None:
+            raise AssemblerError("%s: Undefined symbol in expression." % where)
+        return value
+
+def assemble(path, directory = os.curdir):
+
+    """Assembles the file with the given path, relative to the directory given,
+    returning the code and a dictionary containing the values of the symbols
+    it defines.
+    """
+    return Assembler(directory).assemble(path)
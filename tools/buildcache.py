@@ -0,0 +1,193 @@
+"""
+Copyright (C) 2016 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import cPickle, hashlib, inspect, os, re, time
+
+# Each entry in the cache is stored in a file whose name is a hash of the
+# inputs used to create it, so an entry never needs to be invalidated. Entries
+# that have not been used for a while are removed by the evict method.
+
+include_re = re.compile(r'^\s*\.(?:include|incbin|require)\s+"([^"]+)"', re.M)
+
+class BuildCache:
+
+    def __init__(self, directory = ".build-cache", max_size = 32 * 1024 * 1024,
+                 max_age = 30 * 24 * 60 * 60, enabled = True):
+        
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.enabled = enabled
+        
+        self.hits = 0
+        self.misses = 0
+        
+        if enabled and not os.path.exists(directory):
+            os.mkdir(directory)
+    
+    def key(self, *parts):
+    
+        """Returns a key for the given strings. Each part is preceded by its
+        length so that different sequences of parts produce different keys.
+        """
+        h = hashlib.sha1()
+        for part in parts:
+            h.update("%i:" % len(part))
+            h.update(part)
+        
+        return h.hexdigest()
+    
+    def get(self, key):
+    
+        """Returns the data stored for the given key, or None if the cache does
+        not contain it.
+        """
+        if not self.enabled:
+            return None
+        
+        path = os.path.join(self.directory, key)
+        try:
+            data = open(path, "rb").read()
+        except IOError:
+            self.misses += 1
+            return None
+        
+        # Update the modification time so that recently used entries are kept.
+        # Another build may have removed the entry since it was read.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        
+        self.hits += 1
+        return data
+    
+    def put(self, key, data):
+    
+        if not self.enabled:
+            return
+        
+        # Write to a temporary file and rename it so that other builds using
+        # the same cache never read a partially written entry.
+        path = os.path.join(self.directory, key)
+        temp_path = path + ".%i.tmp" % os.getpid()
+        f = open(temp_path, "wb")
+        f.write(data)
+        f.close()
+        os.rename(temp_path, path)
+    
+    def call(self, function, args, paths = (), modules = ()):
+    
+        """Calls the function with the given arguments, or returns the result
+        of an earlier call if the arguments, the contents of the files with the
+        given paths and the source code of the module containing the function
+        and of any other modules given are all unchanged. The result must be
+        something that can be pickled.
+        """
+        module_paths = [inspect.getsourcefile(function)]
+        module_paths += map(inspect.getsourcefile, modules)
+        
+        parts = ["call", function.__name__, repr(args)]
+        parts += map(read_file, module_paths) + map(read_file, paths)
+        
+        key = self.key(*parts)
+        data = self.get(key)
+        
+        if data is None:
+            result = function(*args)
+            self.put(key, cPickle.dumps(result, 2))
+            return result
+        
+        return cPickle.loads(data)
+    
+    def evict(self):
+    
+        """Removes entries that have not been used within the maximum age, then
+        removes the least recently used entries until the total size of the
+        cache is no larger than the maximum size.
+        """
+        if not self.enabled:
+            return
+        
+        now = time.time()
+        entries = []
+        
+        for name in os.listdir(self.directory):
+        
+            # Leave entries that are being written by other builds.
+            if name.endswith(".tmp"):
+                continue
+            
+            path = os.path.join(self.directory, name)
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            
+            if now - info.st_mtime > self.max_age:
+                remove_file(path)
+            else:
+                entries.append((info.st_mtime, info.st_size, path))
+        
+        entries.sort()
+        total = sum(map(lambda entry: entry[1], entries))
+        
+        for mtime, size, path in entries:
+        
+            if total <= self.max_size:
+                break
+            
+            remove_file(path)
+            total -= size
+
+def remove_file(path):
+
+    # Concurrent builds sharing the cache may remove the same entry.
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def read_file(path):
+
+    return open(path, "rb").read()
+
+def assembler_sources(path, directory = os.curdir):
+
+    """Returns a list containing the contents of the given assembly language
+    file and all the files it includes, in the order they are first included.
+    Paths are relative to the given directory, which is the directory that the
+    assembler is run in.
+    """
+    sources = []
+    paths = [path]
+    seen = set()
+    
+    while paths:
+    
+        path = paths.pop(0)
+        if path in seen:
+            continue
+        
+        seen.add(path)
+        text = read_file(os.path.join(directory, path))
+        sources += [path, text]
+        
+        # Ophis looks for included files relative to the current directory.
+        paths += include_re.findall(text)
+    
+    return sources
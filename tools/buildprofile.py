@@ -0,0 +1,225 @@
+"""
+Copyright (C) 2016 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import cProfile, json, os, time
+
+# The resource module is only available on Unix systems. Without it, the peak
+# memory used by the build is not recorded.
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# A profiler records events, each with a name, a category, a start time and a
+# duration, that describe the stages of a build and the work done in them.
+# Events can be nested. Each event also records the peak memory used by the
+# process, or by its child processes for events in the "subprocess" category,
+# at the end of the event. The events can be written as a trace file in the
+# Chrome trace event format for viewing in chrome://tracing or similar tools.
+
+class ProfilerError(Exception):
+
+    pass
+
+class Event:
+
+    def __init__(self, name, category, start, args):
+    
+        self.name = name
+        self.category = category
+        self.start = start
+        self.duration = None
+        self.depth = 0
+        self.args = args
+
+def peak_memory(category = "stage"):
+
+    # Return the maximum resident set size in kilobytes of this process, or
+    # of the largest of its child processes for subprocess events. Linux
+    # reports the size in kilobytes.
+    if resource is None:
+        return None
+    
+    if category == "subprocess":
+        who = resource.RUSAGE_CHILDREN
+    else:
+        who = resource.RUSAGE_SELF
+    
+    return resource.getrusage(who).ru_maxrss
+
+class Profiler:
+
+    def __init__(self, profile_python = False):
+    
+        """Creates a profiler. If profile_python is True, the Python functions
+        called during events are also profiled using cProfile, except while a
+        subprocess event is being recorded.
+        """
+        self.origin = time.time()
+        self.events = []
+        self.stack = []
+        
+        if profile_python:
+            self.python_profile = cProfile.Profile()
+        else:
+            self.python_profile = None
+    
+    def start(self, name, category = "stage", **args):
+    
+        """Starts an event with the given name and category, nested inside
+        any events that have not been stopped, and returns it. Any keyword
+        arguments are recorded with the event.
+        """
+        self._pause_python_profile()
+        
+        event = Event(name, category, time.time(), args)
+        event.depth = len(self.stack)
+        self.events.append(event)
+        self.stack.append(event)
+        
+        self._resume_python_profile()
+        return event
+    
+    def stop(self, **args):
+    
+        """Stops the most recently started event, recording any keyword
+        arguments with it, and returns its duration in seconds.
+        """
+        end = time.time()
+        self._pause_python_profile()
+        
+        if not self.stack:
+            raise ProfilerError("No event to stop.")
+        
+        event = self.stack.pop()
+        event.duration = end - event.start
+        event.args.update(args)
+        event.args["peak memory (KB)"] = peak_memory(event.category)
+        
+        self._resume_python_profile()
+        return event.duration
+    
+    def finish(self):
+    
+        """Stops any events that have not been stopped."""
+        while self.stack:
+            self.stop()
+    
+    def _pause_python_profile(self):
+    
+        if self.python_profile is not None and self._profiling():
+            self.python_profile.disable()
+    
+    def _resume_python_profile(self):
+    
+        if self.python_profile is not None and self._profiling():
+            self.python_profile.enable()
+    
+    def _profiling(self):
+    
+        # Python code is profiled while events are running, except in
+        # subprocess events.
+        return self.stack and self.stack[-1].category != "subprocess"
+    
+    def totals(self, category = "stage"):
+    
+        """Returns a dictionary mapping the names of the events in the given
+        category to the total time in seconds spent in them.
+        """
+        totals = {}
+        for event in self.events:
+            if event.category == category and event.duration is not None:
+                totals[event.name] = totals.get(event.name, 0) + event.duration
+        
+        return totals
+    
+    def summary(self):
+    
+        """Returns a list of lines describing the number of times each event
+        occurred, the total time spent in it and the largest peak memory
+        recorded at the end of it, in the order that the events first
+        occurred. Nested events are indented below the events containing
+        them.
+        """
+        rows = []
+        entries = {}
+        
+        for event in self.events:
+        
+            if event.duration is None:
+                continue
+            
+            key = (event.category, event.name, event.depth)
+            if key not in entries:
+                entries[key] = [0, 0.0, None]
+                rows.append(key)
+            
+            entry = entries[key]
+            entry[0] += 1
+            entry[1] += event.duration
+            entry[2] = max(entry[2], event.args.get("peak memory (KB)"))
+        
+        lines = ["%-40s %-10s %5s %10s %10s" % (
+            "Event", "Category", "Calls", "Time (ms)", "Peak (KB)")]
+        
+        for category, name, depth in rows:
+        
+            calls, duration, memory = entries[(category, name, depth)]
+            if memory is None:
+                memory = ""
+            lines.append("%-40s %-10s %5i %10.1f %10s" % (
+                ("  " * depth + name)[:40], category, calls,
+                duration * 1000, memory))
+        
+        return lines
+    
+    def trace(self):
+    
+        """Returns a dictionary containing the events in the Chrome trace event
+        format, with times in microseconds from the creation of the profiler.
+        """
+        pid = os.getpid()
+        events = []
+        
+        for event in self.events:
+        
+            if event.duration is None:
+                continue
+            
+            events.append({"name": event.name, "cat": event.category,
+                           "ph": "X", "pid": pid, "tid": 0,
+                           "ts": int((event.start - self.origin) * 1000000),
+                           "dur": int(event.duration * 1000000),
+                           "args": event.args})
+        
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+    
+    def write_trace(self, path):
+    
+        f = open(path, "w")
+        json.dump(self.trace(), f, indent = 1, sort_keys = True)
+        f.close()
+    
+    def write_python_profile(self, path):
+    
+        """Writes the statistics collected by cProfile to the file with the
+        given path in the format read by the pstats module.
+        """
+        if self.python_profile is None:
+            raise ProfilerError("Python functions were not profiled.")
+        
+        self.python_profile.dump_stats(path)
@@ -17,6 +17,8 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+from frequencies import histogram, most_common, offset_index
+
 class Compressor:
 
     def __init__(self):
@@ -25,145 +27,224 @@ class Compressor:
     
     def create_index(self, data):
     
-        index = {}
-        i = 0
-        for byte in data:
+        return offset_index(data)
+    
+    def compress(self, data, block_size = 256, adaptive = False):
+    
+        # If adaptive is True, the block size is ignored and the lengths of
+        # the blocks are chosen to minimise the size of the output.
         
-            index.setdefault(ord(byte), []).append(i)
-            i += 1
+        blocks = self.encode_blocks(data, block_size, adaptive)
+        output = bytearray(sum(map(len, blocks)))
+        self.write_blocks(output, 0, blocks)
         
-        return index
+        return str(output)
     
-    def compress(self, data, block_size = 256):
+    def compress_into(self, buf, data, offset = 0, block_size = 256,
+                      adaptive = False):
+    
+        # Write the compressed data into a bytearray or writable memoryview,
+        # such as a region of a ROM image, starting at the given offset.
+        # Return the number of bytes written.
+        
+        blocks = self.encode_blocks(data, block_size, adaptive)
+        size = sum(map(len, blocks))
+        
+        if offset + size > len(buf):
+            raise ValueError("Compressed data needs %i bytes but only %i are available." % (
+                size, len(buf) - offset))
+        
+        self.write_blocks(buf, offset, blocks)
+        return size
+    
+    def encode_blocks(self, data, block_size, adaptive):
     
-        output = ""
-        i = 0
         if not 1 <= block_size <= 256:
             block_size = 256
         
-        while i < len(data):
+        if adaptive:
+            lengths = self.find_block_lengths(data)
+        else:
+            lengths = [block_size] * ((len(data) + block_size - 1) / block_size)
         
-            # Take a maximum of 256 bytes at a time because we can't use
-            # offsets larger than a byte.
-            block = data[i:i + block_size]
-            index = self.create_index(block)
-            
-            # Find the most common byte and use it as the default byte.
-            items = map(lambda (value, offsets): (len(offsets), value),
-                        index.items())
-            items.sort()
-            number, default = items.pop()
-            
-            # Remove the default value from the index.
-            del index[default]
-            
-            # Count the remaining items.
-            remaining = len(index)
-            
-            # Calculate the total size the encoded data would have.
-            size = 4 + remaining + sum(map(lambda (n, v): n, items)) + 1
-            if size > len(block):
-            
-                # Just write the data uncompressed.
-                output += chr(0)
-                output += chr(len(block) - 1)
-                output += block
-                i += len(block)
-                continue
-            
-            # Write a value indicating that the data is compressed.
-            output += chr(1)
-            
-            # Write the default value and the number of bytes in the block
-            # minus 1.
-            output += chr(default) + chr(len(block) - 1)
-            
-            # Write the number of entries remaining in the index minus 1.
-            output += chr(remaining - 1)
-            
-            # Each item will be written as a value and an increasing sequence
-            # of offsets. Arrange the sequence of items so that each value
-            # following a sequence of offsets is lower than the last offset,
-            # implicitly marking the end of the sequence.
-            # We could instead write a series of descending sequences where
-            # their last values are sorted in ascending order.
-            
-            max_offsets = map(lambda (value, offsets): (max(offsets), value),
-                              index.items())
-            
-            max_offsets.sort()
-            max_offsets.reverse()
-            
-            # Write the values corresponding to the entries.
-            for maximum, value in max_offsets:
-                output += chr(value)
-            
-            # Start with the last item in the sequence and work backwards.
+        blocks = []
+        i = 0
+        for length in lengths:
+        
+            blocks.append(self.encode_block(data[i:i + length]))
+            i += length
+        
+        return blocks
+    
+    def write_blocks(self, buf, offset, blocks):
+    
+        # Copy each encoded block into its place in the buffer. The space in
+        # the buffer must already have been checked so that the slice
+        # assignments never change the size of a bytearray.
+        for block in blocks:
+        
+            buf[offset:offset + len(block)] = block
+            offset += len(block)
+    
+    def find_block_lengths(self, data):
+    
+        # Find the sequence of block lengths that gives the smallest output.
+        # The lowest total size of the blocks needed to encode the data up to
+        # each position is recorded, with the length of the last block, and
+        # blocks of up to 256 bytes are tried from each position whose total
+        # is known, working forwards through the data.
+        
+        n = len(data)
+        values = bytearray(data)
+        best = [0] + [None] * n
+        last = [0] * (n + 1)
+        
+        for start in range(n):
+        
+            counts = [0] * 256
+            distinct = 0
+            default_count = 0
             
-            for maximum, value in max_offsets:
+            end = start
+            while end < min(n, start + 256):
             
-                offsets = index[value]
+                value = values[end]
+                if counts[value] == 0:
+                    distinct += 1
+                counts[value] += 1
+                default_count = max(default_count, counts[value])
+                end += 1
                 
-                # Write the offsets.
-                for offset in offsets:
-                    output += chr(offset)
-            
-            # Write a terminating 0 value.
-            output += chr(0)
-            
-            i += len(block)
+                # Calculate the size of the block as encode_block would,
+                # storing blocks containing a single value uncompressed.
+                length = end - start
+                size = distinct + length - default_count + 4
+                if size > length or distinct == 1:
+                    size = 2 + length
+                total = best[start] + size
+                
+                if best[end] is None or total < best[end]:
+                    best[end] = total
+                    last[end] = length
+        
+        # Follow the lengths back from the end of the data.
+        lengths = []
+        end = n
+        while end > 0:
+            lengths.insert(0, last[end])
+            end -= last[end]
         
-        return output
+        return lengths
     
-    def uncompress(self, data):
+    def encode_block(self, block):
     
-        output = ""
+        # Return a bytearray containing the encoded block.
+        
+        # Blocks contain a maximum of 256 bytes because we can't use
+        # offsets larger than a byte.
+        index = self.create_index(block)
+        
+        # Find the most common byte and use it as the default byte.
+        counts = histogram(block)
+        default = most_common(counts)
+        
+        # Remove the default value from the index.
+        del index[default]
+        
+        # Count the remaining items.
+        remaining = len(index)
+        
+        # Calculate the total size the encoded data would have.
+        size = 4 + remaining + (len(block) - counts[default]) + 1
+        if size > len(block) or remaining == 0:
+        
+            # Just write the data uncompressed. Blocks containing a single
+            # value cannot be encoded because at least one entry is needed.
+            output = bytearray([0, len(block) - 1])
+            output += bytearray(block)
+            return output
+        
+        # Write a value indicating that the data is compressed, the default
+        # value, the number of bytes in the block minus 1 and the number of
+        # entries remaining in the index minus 1.
+        output = [1, default, len(block) - 1, remaining - 1]
+        
+        # Each item will be written as a value and an increasing sequence
+        # of offsets. Arrange the sequence of items so that each value
+        # following a sequence of offsets is lower than the last offset,
+        # implicitly marking the end of the sequence.
+        # We could instead write a series of descending sequences where
+        # their last values are sorted in ascending order.
+        
+        max_offsets = map(lambda (value, offsets): (max(offsets), value),
+                          index.items())
+        
+        max_offsets.sort()
+        max_offsets.reverse()
+        
+        # Write the values corresponding to the entries.
+        for maximum, value in max_offsets:
+            output.append(value)
+        
+        # Start with the last item in the sequence and work backwards.
+        
+        for maximum, value in max_offsets:
+        
+            # Write the offsets.
+            output += index[value]
+        
+        # Write a terminating 0 value.
+        output.append(0)
+        
+        return bytearray(output)
+    
+    def read_blocks(self, data):
+    
+        # Yield the uncompressed contents of each block in the data as a
+        # bytearray.
+        
+        values = bytearray(data)
         i = 0
         
-        while i < len(data):
+        while i < len(values):
         
             # Read the compression byte.
-            compression = ord(data[i])
+            compression = values[i]
             
             if compression == 0:
             
                 # Read the uncompressed data.
-                length = ord(data[i + 1]) + 1
-                output += data[i + 2:i + 2 + length]
+                length = values[i + 1] + 1
+                yield values[i + 2:i + 2 + length]
                 i += 2 + length
                 continue
             
             # Read the default value and length minus 1.
-            default, length = data[i + 1], ord(data[i + 2]) + 1
+            default, length = values[i + 1], values[i + 2] + 1
             
             # Create data for the block using the default value.
-            block = [default] * length
+            block = bytearray([default]) * length
             
             # Read the number of remaining entries minus 1.
-            remaining = ord(data[i + 3]) + 1
+            remaining = values[i + 3] + 1
             
             # Read the entries.
-            entries = []
             i += 4
-            j = 0
-            while j < remaining:
-            
-                entries.append(data[i])
-                i += 1
-                j += 1
+            entries = values[i:i + remaining]
+            i += remaining
             
             # Read the offsets for each value and apply the value to those
             # entries in the block.
             for entry in entries:
             
-                previous = ord(data[i])
+                previous = values[i]
                 block[previous] = entry
                 
                 i += 1
                 
                 while True:
                 
-                    offset = ord(data[i])
+                    offset = values[i]
                     if offset <= previous:
                         break
                     
@@ -174,24 +255,56 @@ class Compressor:
             # Skip the terminating 0 byte.
             i += 1
             
-            output += "".join(block)
+            yield block
+    
+    def uncompress(self, data):
+    
+        # The size of the output is not known until all the blocks have been
+        # read, so extend the bytearray with each block, which takes time
+        # proportional to the length of the output.
+        output = bytearray()
+        for block in self.read_blocks(data):
+            output += block
+        
+        return str(output)
+    
+    def uncompress_into(self, buf, data, offset = 0):
+    
+        # Write the uncompressed data into a bytearray or writable memoryview,
+        # such as a region of a ROM image, starting at the given offset.
+        # Return the number of bytes written.
+        
+        start = offset
+        
+        for block in self.read_blocks(data):
+        
+            if offset + len(block) > len(buf):
+                raise ValueError("Not enough space for the uncompressed data at offset %i." % offset)
+            
+            buf[offset:offset + len(block)] = block
+            offset += len(block)
         
-        return output
+        return offset - start
 
 
 if __name__ == "__main__":
 
     import sys
     if not 4 <= len(sys.argv) <= 5:
-        sys.stderr.write("Usage: %s -c|-d [block size] <input file> <output file>\n" % sys.argv[0])
+        sys.stderr.write("Usage: %s -c|-d [block size|adaptive] <input file> <output file>\n" % sys.argv[0])
         sys.exit(1)
     
     c = Compressor()
     method = sys.argv[1]
     
+    adaptive = False
     if len(sys.argv) == 4:
         size = 256
         i = 2
+    elif sys.argv[2] == "adaptive":
+        size = 256
+        adaptive = True
+        i = 3
     else:
         size = int(sys.argv[2])
         i = 3
@@ -199,7 +312,7 @@ if __name__ == "__main__":
     data = open(sys.argv[i]).read()
     
     if method == "-c":
-        open(sys.argv[i + 1], "w").write(c.compress(data, size))
+        open(sys.argv[i + 1], "w").write(c.compress(data, size, adaptive))
     elif method == "-d":
         open(sys.argv[i + 1], "w").write(c.uncompress(data))
     
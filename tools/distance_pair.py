@@ -1,44 +1,145 @@
 #!/usr/bin/env python
 
-import sys
+import binascii, sys
 
-def compress(data, window = "output"):
+from frequencies import histogram, least_common
 
+class Format:
+
+    # Describes a variant of the compressed data format. The window size and
+    # the number of bits used for the lengths in short and long references
+    # can be changed:
+    #
+    # special 0                 -> special
+    # special 0 l..l o..o       -> short: length (3 to 2 + 2**short_length_bits),
+    #                              offset (1 to 2**(7 - short_length_bits) - 1)
+    # special 1ooooooo h..hl..l -> long: offset (1 to window),
+    #                              length (4 to 3 + 2**long_length_bits)
+    #
+    # Windows of up to 128 bytes only use the second byte of a long reference
+    # for offset - 1. Larger windows, of up to 256 bytes, store its highest
+    # bit in the highest bit of the third byte, leaving at most 7 bits for the
+    # length. The default format uses a 128 byte window, 3 bits for the short
+    # lengths and 8 bits for the long lengths.
+    
+    def __init__(self, window = 128, short_length_bits = 3, long_length_bits = 8):
+    
+        if not 1 <= window <= 256:
+            raise ValueError("Window size must be between 1 and 256 bytes.")
+        if not 1 <= short_length_bits <= 6:
+            raise ValueError("Short references must use between 1 and 6 bits for lengths.")
+        if not 1 <= long_length_bits <= 8:
+            raise ValueError("Long references must use between 1 and 8 bits for lengths.")
+        if window > 128 and long_length_bits > 7:
+            raise ValueError("Windows larger than 128 bytes need a bit for the offset in long references.")
+        
+        self.window = window
+        self.short_length_bits = short_length_bits
+        self.long_length_bits = long_length_bits
+        
+        self.short_offset_bits = 7 - short_length_bits
+        self.short_offset_mask = (1 << self.short_offset_bits) - 1
+        self.short_length_mask = 0x7f & ~self.short_offset_mask
+        self.short_max_length = 2 + (1 << short_length_bits)
+        self.short_max_offset = min(window, self.short_offset_mask)
+        
+        self.long_length_mask = (1 << long_length_bits) - 1
+        if window > 128:
+            self.long_offset_high_mask = 0x80
+        else:
+            self.long_offset_high_mask = 0
+        self.long_max_length = 3 + (1 << long_length_bits)
+        
+        # The longest match worth finding.
+        self.max_length = max(self.short_max_length, self.long_max_length)
+    
+    def __repr__(self):
+        return "<Format window=%i short=%i long=%i>" % (
+            self.window, self.short_length_bits, self.long_length_bits)
+    
+    def is_short(self, length, offset):
+    
+        return length <= self.short_max_length and offset <= self.short_max_offset
+    
+    def encode(self, special, length, offset):
+    
+        # Return the bytes for a reference. The offset is stored in the short
+        # form to avoid encoding zero in the second byte, and offset - 1 and
+        # length - 4 are stored in the long form to allow larger values to be
+        # stored.
+        if self.is_short(length, offset):
+            return [special, ((length - 3) << self.short_offset_bits) | offset]
+        else:
+            offset -= 1
+            return [special, 0x80 | (offset & 0x7f),
+                    (offset & self.long_offset_high_mask) | (length - 4)]
+    
+    def decode_short(self, value):
+    
+        # Return the length and offset from the second byte of a short
+        # reference.
+        return (value >> self.short_offset_bits) + 3, value & self.short_offset_mask
+    
+    def decode_long(self, value, extra):
+    
+        # Return the length and offset from the second and third bytes of a
+        # long reference.
+        offset = ((value & 0x7f) | (extra & self.long_offset_high_mask)) + 1
+        return (extra & self.long_length_mask) + 4, offset
+    
+    def aliases(self):
+    
+        # Return the constants needed to assemble routines/dp_decode.oph for
+        # this format.
+        return (
+            ".alias dp_short_length_mask            $%02x\n"
+            ".alias dp_short_offset_bits            %i\n"
+            ".alias dp_short_offset_mask            $%02x\n"
+            ".alias dp_long_offset_high_mask        $%02x\n"
+            ".alias dp_long_length_mask             $%02x\n"
+            ) % (self.short_length_mask, self.short_offset_bits,
+                 self.short_offset_mask, self.long_offset_high_mask,
+                 self.long_length_mask)
+
+
+default_format = Format()
+
+
+def compress(data, window = "output", method = "hash", parse = "greedy",
+             format = default_format):
+
+    # The method used to find matches can be either "scan", which compares the
+    # upcoming input with every position in the window, or "hash", which only
+    # visits earlier positions that share the same three byte prefix. Both
+    # produce identical output.
+    #
+    # The parse can be either "greedy", which always encodes the longest match
+    # at each position, or "optimal", which finds the shortest encoding of the
+    # whole input. Only the "output" window can be parsed optimally.
+    
     special = find_least_used(data)
     
+    if parse == "optimal":
+        if window != "output":
+            raise ValueError("Optimal parsing requires the output window.")
+        return compress_optimal(data, special, format)
+    elif parse != "greedy":
+        raise ValueError("Unknown parse: %s" % parse)
+    
     output = [special]
     
+    if method == "hash":
+        chains = HashChains(data, output, window, format)
+    elif method != "scan":
+        raise ValueError("Unknown match finding method: %s" % method)
+    
     i = 0
     while i < len(data):
     
-        best = []
-        b = 0
-        
-        # Compare strings in the window with upcoming input, starting at the
-        # beginning of the window.
-        if window == "output":
-            k = max(0, i - 128)
-            end = i
+        if method == "hash":
+            length, b = chains.find(i)
         else:
-            k = max(0, len(output) - 128)
-            end = len(output)
-        
-        while k < end:
-        
-            if window == "output":
-                match = find_match(data, k, i)
-            else:
-                match = find_match_in_compressed(output, data, k, i)
-            
-            # Find better matches, replacing those of equal length with later
-            # ones as they are found.
-            if len(match) >= len(best):
-                best = match
-                b = k
-            
-            k += 1
-        
-        length = len(best)
+            length, b = scan_window(data, output, i, window, format)
         
         if length <= 2:
         
@@ -64,22 +165,22 @@ def compress(data, window = "output"):
             # special 0                 -> special
             # special 0llloooo          -> length (3-10), offset (1-15)
             # special 1ooooooo llllllll -> offset (1-128), length (4-259)
+            #
+            # The ranges of values shown are those for the default format.
             
             if window == "output":
                 offset = i - b
             else:
                 offset = len(output) - b
             
-            if length < 11 and offset < 16:
-                # Store non-zero offset to avoid potential encoding of zero
-                # in the second byte.
-                output += [special, ((length - 3) << 4) | offset]
+            if format.is_short(length, offset):
+                output += format.encode(special, length, offset)
                 i += length
             
             elif length > 3:
-                # Store offset - 1 and length - 4 to allow higher lengths
-                # to be stored.
-                output += [special, 0x80 | (offset - 1), length - 4]
+                # Shorten matches that are too long for a long reference.
+                length = min(length, format.long_max_length)
+                output += format.encode(special, length, offset)
                 i += length
             
             elif data[i] == special:
@@ -93,26 +194,254 @@ def compress(data, window = "output"):
     return output
 
 
-def find_least_used(data):
+def scan_window(data, output, i, window, format = default_format):
+
+    best = []
+    b = 0
+    
+    # Compare strings in the window with upcoming input, starting at the
+    # beginning of the window.
+    if window == "output":
+        k = max(0, i - format.window)
+        end = i
+    else:
+        k = max(0, len(output) - format.window)
+        end = len(output)
+    
+    while k < end:
+    
+        if window == "output":
+            match = find_match(data, k, i, format.max_length)
+        else:
+            match = find_match_in_compressed(output, data, k, i,
+                                             min(255, format.max_length))
+        
+        # Find better matches, replacing those of equal length with later
+        # ones as they are found.
+        if len(match) >= len(best):
+            best = match
+            b = k
+        
+        k += 1
+    
+    return len(best), b
+
+
+class HashChains:
 
-    freq = [0] * 256
+    # Records the positions in the window, either in the input data or the
+    # compressed output, in chains of positions that start with the same three
+    # bytes. Matches of fewer than three bytes are never encoded, so only the
+    # positions in the chain for the upcoming input need to be compared with
+    # it. The chains are ordered from the latest position to the earliest, so
+    # the first of the longest matches found is also the latest one, as in the
+    # scan_window function.
+    
+    def __init__(self, data, output, window, format = default_format):
+    
+        self.data = data
+        self.output = output
+        self.window = window
+        self.size = format.window
+        
+        if window == "output":
+            self.source = data
+            self.limit = format.max_length
+        else:
+            self.source = output
+            self.limit = min(255, format.max_length)
+        
+        self.heads = {}
+        self.previous = {}
+        self.inserted = 0
+    
+    def insert(self, end):
     
-    for b in data:
-        freq[b] += 1
+        # Add the positions before the end position that have three bytes
+        # available to their chains.
+        source = self.source
+        k = self.inserted
+        end = min(end, len(source) - 2)
+        
+        while k < end:
+        
+            key = (source[k], source[k + 1], source[k + 2])
+            self.previous[k] = self.heads.get(key)
+            self.heads[key] = k
+            k += 1
+        
+        self.inserted = max(k, self.inserted)
     
-    try:
-        # Try to find an unused byte value.
-        special = freq.index(0)
-    except ValueError:
-        # Find the least used byte value.
-        pairs = map(lambda i: (freq[i], i), range(len(freq)))
-        pairs.sort()
-        special = pairs.pop(0)[1]
+    def find(self, i):
     
-    return special
+        data = self.data
+        source = self.source
+        
+        if self.window == "output":
+            self.insert(i)
+            start = i - self.size
+            # Matches may overlap the upcoming input.
+            limit = min(self.limit, len(data) - i)
+        else:
+            self.insert(len(source))
+            start = len(source) - self.size
+            limit = min(self.limit, len(data) - i)
+        
+        if limit < 3:
+            return 0, 0
+        
+        best = 0
+        b = 0
+        k = self.heads.get((data[i], data[i + 1], data[i + 2]))
+        
+        while k is not None and k >= start:
+        
+            if self.window == "output":
+                n = limit
+            else:
+                # Matches cannot extend beyond the end of the output.
+                n = min(limit, len(source) - k)
+            
+            # Only compare the rest of the strings if this match could be
+            # longer than the best one so far.
+            if n > best and source[k + best] == data[i + best]:
+            
+                length = 3
+                while length < n and source[k + length] == data[i + length]:
+                    length += 1
+                
+                if length > best:
+                    best = length
+                    b = k
+                    if best == limit:
+                        break
+            
+            k = self.previous[k]
+        
+        return best, b
+    
+    def find_near(self, i, distance, limit):
+    
+        # Find the latest longest match in the output window, up to the given
+        # length, that starts fewer than the given distance before the
+        # upcoming input.
+        data = self.data
+        self.insert(i)
+        limit = min(limit, len(data) - i)
+        
+        if limit < 3:
+            return 0, 0
+        
+        best = 0
+        b = 0
+        k = self.heads.get((data[i], data[i + 1], data[i + 2]))
+        
+        while k is not None and i - k < distance:
+        
+            length = 3
+            while length < limit and data[k + length] == data[i + length]:
+                length += 1
+            
+            if length > best:
+                best = length
+                b = k
+                if best == limit:
+                    break
+            
+            k = self.previous[k]
+        
+        return best, b
 
 
-def find_match(data, k, i):
+def compress_optimal(data, special, format = default_format):
+
+    # Find the cheapest sequence of tokens for the input, working backwards
+    # from the end of the data so that the cost of encoding the rest of the
+    # input from each position is known when choosing a token at an earlier
+    # position. The tokens are those produced by the greedy parser:
+    #
+    # literal                   -> 1 byte (2 bytes for the special byte)
+    # special 0llloooo          -> 2 bytes, length (3-10), offset (1-15)
+    # special 1ooooooo llllllll -> 3 bytes, offset (1-128), length (4-259)
+    #
+    # A match of a given length at some offset also provides matches of all
+    # shorter lengths at that offset, so only the longest match in the window
+    # and the longest match within the range of short offsets need to be
+    # recorded. The ranges of values shown are those for the default format.
+    
+    n = len(data)
+    chains = HashChains(data, [], "output", format)
+    
+    far = []
+    near = []
+    for i in range(n):
+        far.append(chains.find(i))
+        near.append(chains.find_near(i, format.short_max_offset + 1,
+                                     format.short_max_length))
+    
+    cost = [0] * (n + 1)
+    choice = [None] * n
+    
+    i = n - 1
+    while i >= 0:
+    
+        if data[i] == special:
+            best = 2 + cost[i + 1]
+        else:
+            best = 1 + cost[i + 1]
+        token = None
+        
+        length, b = near[i]
+        if length >= 3:
+            costs = cost[i + 3:i + length + 1]
+            c = min(costs)
+            if 2 + c < best:
+                best = 2 + c
+                token = (3 + costs.index(c), i - b)
+        
+        length, b = far[i]
+        length = min(length, format.long_max_length)
+        if length >= 4:
+            costs = cost[i + 4:i + length + 1]
+            c = min(costs)
+            if 3 + c < best:
+                best = 3 + c
+                token = (4 + costs.index(c), i - b)
+        
+        cost[i] = best
+        choice[i] = token
+        i -= 1
+    
+    # Follow the choices from the start of the data to produce the output.
+    output = [special]
+    
+    i = 0
+    while i < n:
+    
+        token = choice[i]
+        
+        if token is None:
+            if data[i] == special:
+                output += [special, 0]
+            else:
+                output.append(data[i])
+            i += 1
+        
+        else:
+            length, offset = token
+            output += format.encode(special, length, offset)
+            i += length
+    
+    return output
+
+
+def find_least_used(data):
+
+    # Find an unused byte value or, failing that, the least used one.
+    return least_common(histogram(data))
+
+
+def find_match(data, k, i, limit = 259):
 
     # Compare the bytes in the window, starting at index k, with the bytes in
     # the upcoming data, starting at index i.
@@ -126,7 +455,7 @@ def find_match(data, k, i):
     match = []
     j = i
     
-    while len(match) < 259:
+    while len(match) < limit:
     
         if j == len(data) or data[k] != data[j]:
             return match
@@ -139,7 +468,7 @@ def find_match(data, k, i):
     return match
 
 
-def find_match_in_compressed(output, data, k, i):
+def find_match_in_compressed(output, data, k, i, limit = 255):
 
     # Compare the bytes in the compressed data, starting at index k, with the
     # bytes in the upcoming data, starting at index i.
@@ -153,7 +482,7 @@ def find_match_in_compressed(output, data, k, i):
     match = []
     j = i
     
-    while len(match) < 255 and k < len(output):
+    while len(match) < limit and k < len(output):
     
         if j == len(data) or output[k] != data[j]:
             return match
@@ -166,10 +495,10 @@ def find_match_in_compressed(output, data, k, i):
     return match
 
 
-def decompress(data, window = "output", stop_at = None):
+def decompress(data, window = "output", stop_at = None, format = default_format):
 
     special = data[0]
-    output = []
+    output = bytearray()
     
     i = 1
     while i < len(data):
@@ -189,12 +518,10 @@ def decompress(data, window = "output", stop_at = None):
                 j = i
                 
                 if offset & 0x80 == 0:
-                    count = (offset >> 4) + 3
-                    offset = offset & 0x0f
+                    count, offset = format.decode_short(offset)
                     i += 2
                 else:
-                    offset = (offset & 0x7f) + 1
-                    count = data[i + 2] + 4
+                    count, offset = format.decode_long(offset, data[i + 2])
                     i += 3
                 
                 if window == "compressed":
@@ -213,6 +540,197 @@ def decompress(data, window = "output", stop_at = None):
     return output
 
 
+class Decompressor:
+
+    # Decodes compressed data incrementally, only keeping the bytes that later
+    # tokens can refer to: the last window of output for the "output" window
+    # or the last window of compressed data for the "compressed" window. The source can be a string, bytearray or list of values, or a
+    # file object positioned at the start of the compressed data. The length
+    # of the compressed data and the size of the decompressed data can be
+    # given to decode data that is followed by other data.
+    #
+    # If an interval is given, a checkpoint is recorded at the first token
+    # boundary at or after each multiple of the interval in the output. Each
+    # checkpoint contains the output and input positions and the window needed
+    # to resume decoding from that token, and is used to seek backwards
+    # without decoding from the start of the data again.
+    
+    def __init__(self, source, window = "output", length = None, size = None,
+                 interval = None, format = default_format):
+    
+        if hasattr(source, "read"):
+            self.file = source
+            self.origin = source.tell()
+            self.buffer = bytearray()
+        else:
+            self.file = None
+            self.buffer = bytearray(source)
+        
+        self.window = window
+        self.window_size = format.window
+        self.format = format
+        self.length = length
+        self.size = size
+        self.interval = interval
+        
+        self.buffer_pos = 0
+        self.input_position = 0
+        self.output_position = 0
+        self.pending = bytearray()
+        
+        self.special = self._next_byte()
+        if window == "output":
+            self.history = bytearray()
+        else:
+            self.history = bytearray([self.special])
+        
+        self.checkpoints = [(0, self.input_position, bytearray(self.history))]
+    
+    def _restore(self, checkpoint):
+    
+        output_position, input_position, history = checkpoint
+        
+        self.output_position = output_position
+        self.input_position = input_position
+        self.history = bytearray(history)
+        self.pending = bytearray()
+        
+        if self.file is None:
+            self.buffer_pos = input_position
+        else:
+            self.file.seek(self.origin + input_position)
+            self.buffer = bytearray()
+            self.buffer_pos = 0
+    
+    def _at_end(self):
+    
+        if self.size is not None and self.output_position >= self.size:
+            return True
+        if self.length is not None and self.input_position >= self.length:
+            return True
+        
+        if self.buffer_pos == len(self.buffer) and self.file is not None:
+            self.buffer = bytearray(self.file.read(4096))
+            self.buffer_pos = 0
+        
+        return self.buffer_pos == len(self.buffer)
+    
+    def _next_byte(self):
+    
+        if self._at_end():
+            raise ValueError("Compressed data ends unexpectedly at %i." % self.input_position)
+        
+        b = self.buffer[self.buffer_pos]
+        self.buffer_pos += 1
+        self.input_position += 1
+        return b
+    
+    def _decode_token(self):
+    
+        # Record a checkpoint before decoding the token if it is the first
+        # one at or after the next multiple of the interval.
+        if self.interval is not None:
+            last = self.checkpoints[-1][0]
+            if self.output_position >= (last / self.interval + 1) * self.interval:
+                self.checkpoints.append((self.output_position,
+                    self.input_position, bytearray(self.history)))
+        
+        special = self.special
+        history = self.history
+        
+        b = self._next_byte()
+        token = [b]
+        
+        if b != special:
+            output = bytearray([b])
+        else:
+            offset = self._next_byte()
+            token.append(offset)
+            
+            if offset == 0:
+                output = bytearray([special])
+            
+            else:
+                if offset & 0x80 == 0:
+                    count, offset = self.format.decode_short(offset)
+                else:
+                    extra = self._next_byte()
+                    token.append(extra)
+                    count, offset = self.format.decode_long(offset, extra)
+                
+                start = len(history) - offset
+                
+                if self.window == "output":
+                    # Copy each byte into the window before the next one is
+                    # read in case the reference overlaps the new bytes.
+                    j = start
+                    while j < start + count:
+                        history.append(history[j])
+                        j += 1
+                    output = history[-count:]
+                else:
+                    output = history[start:start + count]
+        
+        if self.window == "compressed":
+            history += bytearray(token)
+        elif len(token) == 1 or token[1] == 0:
+            # Referenced bytes were copied into the window above.
+            history += output
+        
+        # Discard the bytes that can no longer be referred to.
+        if len(history) > 2 * self.window_size:
+            del history[:-self.window_size]
+        
+        self.output_position += len(output)
+        return output
+    
+    def read(self, size = -1):
+    
+        # Return a bytearray containing up to the given number of decoded
+        # bytes, or all the remaining bytes if the size is negative.
+        output = self.pending
+        
+        while (size < 0 or len(output) < size) and not self._at_end():
+            output += self._decode_token()
+        
+        if size < 0:
+            self.pending = bytearray()
+        else:
+            self.pending = output[size:]
+            output = output[:size]
+        
+        return output
+    
+    def chunks(self, size = 256):
+    
+        while True:
+            output = self.read(size)
+            if not output:
+                break
+            yield output
+    
+    def tell(self):
+    
+        return self.output_position - len(self.pending)
+    
+    def seek(self, position):
+    
+        # Find the latest checkpoint at or before the position and resume
+        # decoding from it, unless the current position is closer.
+        latest = self.checkpoints[0]
+        for checkpoint in self.checkpoints:
+            if checkpoint[0] > position:
+                break
+            latest = checkpoint
+        
+        if position < self.tell() or latest[0] > self.output_position:
+            self._restore(latest)
+        
+        self.read(position - self.tell())
+        
+        return self.tell()
+
+
 def merge(data):
 
     # Take the lowest 4 bits of each byte and pack them together, then take
@@ -260,6 +778,88 @@ def unmerge(data):
     return output
 
 
+def merge_buffer(data):
+
+    # Perform the same packing as the merge function on a string, bytearray or
+    # other buffer, returning a bytearray. Each nibble is a digit in the
+    # hexadecimal representation of the data, so the nibbles can be rearranged
+    # by slicing the string of digits instead of looping over the bytes.
+    #
+    # digits      H0 L0 H1 L1 | H2 L2 H3 L3 ...
+    # low nibbles L1 L0 | L3 L2 ...
+    # high nibbles         H0 H1 | H2 H3 ...
+    
+    data = bytearray(data)
+    pairs = len(data) / 2
+    digits = binascii.hexlify(data[:pairs * 2])
+    
+    low = bytearray(pairs * 2)
+    low[0::2] = digits[3::4]
+    low[1::2] = digits[1::4]
+    
+    high = bytearray(pairs * 2)
+    high[0::2] = digits[0::4]
+    high[1::2] = digits[2::4]
+    
+    output = bytearray(binascii.unhexlify(str(low + high)))
+    output += data[pairs * 2:]
+    return output
+
+
+def unmerge_buffer(data):
+
+    # Reverse the packing performed by merge_buffer, returning a bytearray.
+    
+    data = bytearray(data)
+    pairs = len(data) / 2
+    low = binascii.hexlify(data[:pairs])
+    high = binascii.hexlify(data[pairs:pairs * 2])
+    
+    digits = bytearray(pairs * 4)
+    digits[0::4] = high[0::2]
+    digits[1::4] = low[1::2]
+    digits[2::4] = high[1::2]
+    digits[3::4] = low[0::2]
+    
+    output = bytearray(binascii.unhexlify(str(digits)))
+    output += data[pairs * 2:]
+    return output
+
+
+def tune(data, window = "output", parse = "greedy",
+         windows = (16, 32, 64, 128, 256), short_length_bits = range(1, 7),
+         long_length_bits = range(1, 9)):
+
+    # Compress the data using every valid combination of the given format
+    # parameters, returning a list of (size, format) pairs with the smallest
+    # first. Where sizes are equal, the default format is preferred because
+    # it needs no changes to the decoder.
+    
+    results = []
+    
+    for size in windows:
+        for short_bits in short_length_bits:
+            for long_bits in long_length_bits:
+            
+                try:
+                    format = Format(size, short_bits, long_bits)
+                except ValueError:
+                    continue
+                
+                c = compress(data, window, parse = parse, format = format)
+                if decompress(c, window, format = format) != bytearray(data):
+                    raise ValueError("Data compressed incorrectly using %s." % repr(format))
+                
+                non_default = (size, short_bits, long_bits) != (
+                    default_format.window, default_format.short_length_bits,
+                    default_format.long_length_bits)
+                
+                results.append((len(c), non_default, format))
+    
+    results.sort(key = lambda (length, non_default, format): (length, non_default))
+    return map(lambda (length, non_default, format): (length, format), results)
+
+
 def hexdump(data):
 
     i = 0
@@ -287,34 +887,60 @@ if __name__ == "__main__":
     if do_merge:
         args.remove("--merge")
     
+    if "--scan" in args:
+        method = "scan"
+        args.remove("--scan")
+    else:
+        method = "hash"
+    
+    if "--optimal" in args:
+        parse = "optimal"
+        args.remove("--optimal")
+    else:
+        parse = "greedy"
+    
+    format = default_format
+    for arg in args:
+        if arg.startswith("--format="):
+            try:
+                format = Format(*map(int, arg[9:].split(",")))
+            except (TypeError, ValueError), exception:
+                sys.stderr.write("Invalid format: %s\n" % exception)
+                sys.exit(1)
+            args.remove(arg)
+            break
+    
     if len(args) != 4:
-        sys.stderr.write("Usage: %s --compress|--decompress [--output|--compressed] [--merge] <input file> <output file>\n" % sys.argv[0])
+        sys.stderr.write("Usage: %s --compress|--decompress|--tune [--output|--compressed] [--merge] [--scan] [--optimal] [--format=<window>,<short length bits>,<long length bits>] <input file> <output file>\n" % sys.argv[0])
+        sys.stderr.write("When tuning, the output file contains the constants needed to assemble the decoder.\n")
         sys.exit(1)
     
     command = args[1]
-    in_f = open(args[2])
-    out_f = open(args[3], "w")
+    in_f = open(args[2], "rb")
+    out_f = open(args[3], "wb")
     
-    data = map(ord, in_f.read())
+    data = bytearray(in_f.read())
     
     if command == "--compress":
     
         print "Input size:", len(data)
         if do_merge:
             original_data = data
-            data = merge(data)
+            data = merge_buffer(data)
         
-        c = compress(data, mode)
+        c = compress(data, mode, method, parse, format)
         print "Compressed:", len(c)
+        if parse == "optimal":
+            print "Saved:", len(compress(data, mode, method, format = format)) - len(c), "bytes compared with greedy parsing"
         try:
             out_f.write("".join(map(chr, c)))
         except ValueError:
             hexdump(c)
             raise
         
-        d = decompress(c, mode)
+        d = decompress(c, mode, format = format)
         if do_merge:
-            d = unmerge(d)
+            d = unmerge_buffer(d)
             data = original_data
         
         if data != d:
@@ -325,15 +951,37 @@ if __name__ == "__main__":
             print "Data at %i compressed incorrectly." % i
             hexdump(data[:i])
             print
-            c, d = decompress(c, mode, stop_at = i)
+            # Decode up to the incorrect byte to find the corresponding
+            # position in the compressed data.
+            decoder = Decompressor(c, mode, format = format)
+            decoder.read(i + 1)
+            c = c[:decoder.input_position]
             hexdump(c[:i + 3])
     
+    elif command == "--tune":
+    
+        print "Input size:", len(data)
+        if do_merge:
+            data = merge_buffer(data)
+        
+        results = tune(data, mode, parse)
+        
+        print "Window  Short bits  Long bits  Compressed"
+        for length, format in results[:10]:
+            print "%6i  %10i  %9i  %10i" % (format.window,
+                format.short_length_bits, format.long_length_bits, length)
+        
+        length, format = results[0]
+        print "Default format:", len(compress(data, mode, parse = parse))
+        
+        out_f.write(format.aliases())
+    
     else:
         print "Input size:", len(data)
-        d = decompress(data, mode)
+        d = decompress(data, mode, format = format)
         if do_merge:
-            d = unmerge(d)
+            d = unmerge_buffer(d)
         print "Decompressed:", len(d)
-        out_f.write("".join(map(chr, d)))
+        out_f.write(str(d))
     
     sys.exit()
@@ -0,0 +1,99 @@
+"""
+Copyright (C) 2016 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import array
+
+# The functions in this module accept strings, bytearrays and lists of byte
+# values. Without NumPy there is no built-in function that counts all the byte
+# values at once, so histogram counts them in a Python loop, indexing a list
+# of counts with the values of a bytearray. For long inputs it reads the data
+# as an array of 16-bit words instead, counting each pair of bytes in a table
+# with one Python operation, then sums the rows and columns of the table to
+# find the counts of the low and high bytes. Summing the table takes about as
+# long as counting 64K bytes, so shorter inputs are counted a byte at a time.
+
+pair_threshold = 65536
+
+def histogram(data):
+
+    """Returns a list containing the number of occurrences of each byte value
+    in the given data.
+    """
+    if len(data) < pair_threshold:
+    
+        counts = [0] * 256
+        
+        if not isinstance(data, bytearray):
+            data = bytearray(data)
+        
+        for value in data:
+            counts[value] += 1
+        
+        return counts
+    
+    if not isinstance(data, str):
+        data = str(bytearray(data))
+    
+    # Count the pairs of bytes, then add the last byte if the length is odd.
+    # The order of the bytes in each word does not matter because the counts
+    # of both bytes are added together.
+    length = len(data) & ~1
+    pairs = [0] * 65536
+    
+    for value in array.array("H", data[:length]):
+        pairs[value] += 1
+    
+    counts = map(lambda value: sum(pairs[value * 256:(value + 1) * 256]) +
+                               sum(pairs[value::256]), range(256))
+    
+    if length < len(data):
+        counts[ord(data[-1])] += 1
+    
+    return counts
+
+def offset_index(data):
+
+    """Returns a dictionary mapping each byte value in the given data to a list
+    of the offsets at which it occurs, in ascending order.
+    """
+    index = {}
+    
+    i = 0
+    for value in bytearray(data):
+    
+        if value in index:
+            index[value].append(i)
+        else:
+            index[value] = [i]
+        i += 1
+    
+    return index
+
+def most_common(counts):
+
+    """Returns the most common value in a list of counts, choosing the highest
+    value if more than one value occurs the same number of times.
+    """
+    highest = max(counts)
+    return len(counts) - 1 - counts[::-1].index(highest)
+
+def least_common(counts):
+
+    """Returns the least common value in a list of counts, choosing the lowest
+    value if more than one value occurs the same number of times.
+    """
+    return counts.index(min(counts))
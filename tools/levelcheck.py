@@ -0,0 +1,546 @@
+"""
+Copyright (C) 2016 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import re
+
+import makelevels
+
+# The checker follows the player's character through a level map, one frame
+# at a time, using the same rules as the game code in code.oph and
+# scrolling.oph. The character is two cells wide and three cells tall and
+# moves by half a cell in each frame. Positions are given in half cells from
+# the left edge of the level map and in cells from the top row of the map, so
+# the character's column is half of its position.
+#
+# Starting from each position where the character can stand, the checker
+# tries walking, jumping and entering portals, then follows the character
+# until it lands again. The frames of a jump or fall cannot be changed once
+# they have started because the game does not read the keys until the
+# character lands. Monsters are ignored.
+
+byte_table_re = re.compile(r"^(\w+):\s*\.byte\s+([0-9,\s]+)$", re.M)
+
+# The character starts at column 19 of the screen with its head in row 18 of
+# the screen. The level map starts at row 7 of the screen, and the character
+# is lost when its head reaches row 20 of the screen.
+extra_rows = 7
+start_position = 19 * 2
+start_row = 18 - extra_rows
+lost_row = 16 + extra_rows - 3 - extra_rows
+
+# The longest series of frames followed before the character is assumed to be
+# stuck.
+maximum_frames = 64
+
+# Kinds of tiles for the character.
+empty, solid, collectable, door = range(4)
+
+def read_byte_tables(path):
+
+    """Returns a dictionary mapping the labels of the tables of bytes in the
+    assembly language file with the given path to lists of their values.
+    """
+    tables = {}
+    for label, values in byte_table_re.findall(open(path).read()):
+        tables[label] = map(int, values.split(","))
+    
+    return tables
+
+class Checker:
+
+    def __init__(self, levels, special, portals, finish, tables):
+    
+        """Creates a checker for the levels, special tiles, portals and
+        finishing offset read from a level file, using the dictionary of
+        tables read from code.oph, which must contain the jump_steps_y,
+        jump_offsets_ys, fall_steps_y and fall_offsets_ys tables.
+        """
+        self.levels = levels
+        self.special = special
+        self.portals = portals
+        self.finish = finish
+        
+        self.jump_steps_y = tables["jump_steps_y"]
+        self.jump_offsets_ys = tables["jump_offsets_ys"]
+        self.fall_steps_y = tables["fall_steps_y"]
+        self.fall_offsets_ys = tables["fall_offsets_ys"]
+        
+        self.level_map = makelevels.create_level_map(
+            levels, makelevels.tile_numbers(), special, portals)
+        self.rows = self.level_map.rows
+        self.width = self.level_map.width
+        self.extent = self.width - 40
+        
+        # Record the kind of each tile code and the special tiles that are
+        # initially invisible. Tiles with codes that are not defined are
+        # invisible special tiles, and portals are never visible.
+        self.kinds = [empty] + [solid] * (makelevels.normal_tiles - 1)
+        self.kinds += [empty] * (256 - len(self.kinds))
+        self.initially_invisible = set(range(16, 128))
+        
+        for ch, (tile, index, flags) in special.items():
+        
+            if "visible" not in flags:
+                continue
+            
+            self.initially_invisible.discard(index)
+            if "collectable" in flags:
+                self.kinds[index] = collectable
+            elif "door" in flags:
+                self.kinds[index] = door
+            else:
+                self.kinds[index] = solid
+        
+        # Map portal codes to the positions of their destinations, or to None
+        # for destinations that are not in the level map.
+        self.destinations = {}
+        for ch, (index, dest, colour) in portals.items():
+        
+            if ch in special or dest not in portals:
+                continue
+            
+            locations = self.level_map.portal_locations.get(dest)
+            if locations:
+                location = makelevels.portal_location(locations)
+            else:
+                location = None
+            
+            self.destinations[index & 0x0f] = (dest, location)
+        
+        self.invisible = self.initially_invisible
+        self.touched = set()
+        self.door_closed = False
+    
+    def tile(self, column, row):
+    
+        # Return True if the tile at the given column and row blocks the
+        # character, recording any collectable objects that the character
+        # touches. There are no tiles above or below the level map.
+        if row < 0 or row >= 16:
+            return False
+        
+        code = self.rows[row][column]
+        if code in self.invisible:
+            return False
+        
+        kind = self.kinds[code]
+        if kind == collectable:
+            self.touched.add(code)
+            return False
+        elif kind == door:
+            # Doors are opened by collecting the corresponding keys.
+            if code ^ 1 in self.invisible:
+                return False
+            
+            self.door_closed = True
+            return True
+        else:
+            return kind == solid
+    
+    def check_beneath(self, state):
+    
+        # Update the falling counter of the character, returning False if
+        # the character is lost at the bottom of the screen.
+        position, row, half_row, jumping, falling, moving = state
+        
+        if not half_row:
+        
+            if row >= lost_row:
+                return False
+            
+            column = position >> 1
+            if self.tile(column, row + 3) or self.tile(column + 1, row + 3) or \
+               (position & 1 and self.tile(column + 2, row + 3)):
+                state[4] = 0
+                return True
+        
+        if not falling:
+            state[4] = 1
+        
+        return True
+    
+    def drop(self, state):
+    
+        falling = state[4]
+        state[1] += self.fall_steps_y[falling]
+        state[2] = self.fall_offsets_ys[falling]
+        
+        if falling < len(self.fall_steps_y) - 1:
+            state[4] = falling + 1
+    
+    def move(self, state, direction):
+    
+        # Move the character by half a cell in the given direction if the
+        # cells in front of it are empty, stepping up onto low obstacles when
+        # walking. The level cannot scroll beyond its ends.
+        position, row, half_row, jumping, falling, moving = state
+        column = position >> 1
+        
+        if not position & 1:
+        
+            if direction > 0:
+                ahead = column + 2
+                at_end = column - 19 == self.extent
+            else:
+                ahead = column - 1
+                at_end = column == 19
+            
+            occupied = 0
+            for r in range(row, row + 3 + (falling != 0)):
+                occupied = (occupied << 1) | self.tile(ahead, r)
+            
+            if occupied:
+            
+                if falling or jumping or occupied != 1:
+                    state[5] = 0
+                    return
+                
+                state[1] -= 1
+            
+            state[5] = direction
+            
+            if at_end:
+                # The character falls at the right end of the level, but not at
+                # the left end.
+                if falling and direction > 0:
+                    self.drop(state)
+                return
+        else:
+            state[5] = direction
+        
+        state[0] = position + direction
+        
+        if falling:
+            self.drop(state)
+    
+    def can_jump(self, state):
+    
+        position, row = state[:2]
+        column = position >> 1
+        
+        return not (self.tile(column, row - 1) or self.tile(column + 1, row - 1) or \
+                    (position & 1 and self.tile(column + 2, row - 1)))
+    
+    def jump(self, state):
+    
+        # Move the character up for the current frame of its jump, returning
+        # False if the character is lost at the end of the jump.
+        jumping = state[3]
+        
+        if self.jump_steps_y[jumping]:
+        
+            if not self.can_jump(state):
+                return self.stop_jumping(state)
+            
+            state[1] -= 1
+        
+        state[2] = self.jump_offsets_ys[jumping]
+        
+        if jumping + 1 >= len(self.jump_steps_y):
+            return self.stop_jumping(state)
+        
+        state[3] = jumping + 1
+        return True
+    
+    def stop_jumping(self, state):
+    
+        state[2] = state[3] = 0
+        return self.check_beneath(state)
+    
+    def follow(self, position, row, direction = 0, jump = False, standing = True):
+    
+        """Follows the character from the given position and row after it
+        starts moving in the given direction (-1 for left, 1 for right, 0 for
+        neither) and jumping if jump is True. If standing is False, the
+        character was placed there by a portal and no keys are read. Returns
+        a tuple containing the position and row where the character lands,
+        or None if it is lost or stuck, and True if the character passed the
+        finishing offset.
+        """
+        state = [position, row, 0, 0, 0, 0]
+        finished = False
+        
+        if standing:
+        
+            if direction:
+                self.move(state, direction)
+            
+            if jump and self.can_jump(state):
+                self.jump(state)
+        
+        for frame in range(maximum_frames):
+        
+            if not state[3]:
+            
+                if not self.check_beneath(state):
+                    return None, finished
+                
+                if not state[4]:
+                    return (state[0], state[1]), finished
+            
+            if state[4]:
+            
+                # The game only checks for the finish while falling when the
+                # character is not also moving horizontally.
+                if state[5]:
+                    self.move(state, state[5])
+                    continue
+                
+                self.drop(state)
+            
+            else:
+                if not self.jump(state):
+                    return None, finished
+                
+                if state[5]:
+                    self.move(state, state[5])
+            
+            if self.finished(state[0]):
+                finished = True
+        
+        return None, finished
+    
+    def finished(self, position):
+    
+        return self.finish and (position >> 1) - 19 == self.finish
+    
+    def portal(self, position, row):
+    
+        # Return the symbol and destination of the portal that the character
+        # is standing in front of, or None if there is no portal.
+        if not 0 <= row + 2 < 16:
+            return None
+        
+        code = self.rows[row + 2][position >> 1]
+        if code < 128:
+            return None
+        
+        return self.destinations.get(code & 0x0f)
+    
+    def explore(self, graph, finishing, pending):
+    
+        # Explore the positions that the character can reach from the pending
+        # positions, using the current set of invisible tiles. The graph maps
+        # each position where the character can stand to a list of (position,
+        # symbol) tuples for the positions it can reach from there, where the
+        # symbol is the destination portal or None. Positions that reach the
+        # finish are added to the finishing set. Returns a list of positions
+        # where closed doors blocked the character.
+        blocked = []
+        
+        while pending:
+        
+            here = pending.pop()
+            position, row = here
+            edges = graph.setdefault(here, [])
+            
+            if self.finished(position):
+                finishing.add(here)
+            
+            self.door_closed = False
+            
+            moves = []
+            for direction in (-1, 0, 1):
+                for jump in (False, True):
+                    if direction or jump:
+                        moves.append(self.follow(position, row, direction, jump) + (None,))
+            
+            portal = self.portal(position, row)
+            if portal:
+                symbol, location = portal
+                if location:
+                    x, y = location
+                else:
+                    # The game uses a destination at the start of the level
+                    # for portals without destinations.
+                    x, y = 19, 0
+                
+                moves.append(self.follow(x * 2, y - 2, standing = False) + (symbol,))
+            
+            if self.door_closed:
+                blocked.append(here)
+            
+            for there, finished, symbol in moves:
+            
+                if finished:
+                    finishing.add(here)
+                
+                if there is None:
+                    if symbol:
+                        edges.append((None, symbol))
+                    continue
+                
+                edges.append((there, symbol))
+                
+                if there not in graph:
+                    graph[there] = []
+                    pending.append(there)
+        
+        return blocked
+    
+    def check(self):
+    
+        """Returns a Report describing the places in the level that the
+        character can reach from the start.
+        
+        Collecting keys opens doors, so the positions where the character was
+        blocked by closed doors are explored again, with the doors for any
+        keys collected open, until no more objects are collected. The moves
+        found before the doors were opened are kept because the character can
+        make them before collecting the keys.
+        """
+        self.touched = set()
+        self.invisible = self.initially_invisible
+        
+        graph = {}
+        finishing = set()
+        
+        start, finished = self.follow(start_position, start_row, standing = False)
+        if start is None:
+            return Report(self, graph, finishing)
+        
+        graph[start] = []
+        if finished:
+            finishing.add(start)
+        
+        pending = [start]
+        
+        while pending:
+        
+            touched = set(self.touched)
+            blocked = self.explore(graph, finishing, pending)
+            
+            if self.touched == touched:
+                break
+            
+            self.invisible = self.initially_invisible | self.touched
+            pending = blocked
+        
+        return Report(self, graph, finishing)
+
+class Report:
+
+    def __init__(self, checker, graph, finishing):
+    
+        self.checker = checker
+        self.graph = graph
+        self.finishing = finishing
+        self.finish_reached = bool(finishing)
+        
+        # Treasure is collected in pairs of tiles, so touching either tile
+        # collects both.
+        collected = set(checker.touched)
+        for ch, (tile, index, flags) in checker.special.items():
+            if "treasure" in flags and index in checker.touched:
+                collected.add(index ^ 1)
+        
+        self.unreachable_objects = []
+        for ch, (tile, index, flags) in checker.special.items():
+            if checker.kinds[index] == collectable and index not in collected:
+                self.unreachable_objects.append((ch, self._locations(index)))
+        
+        self.unreachable_objects.sort()
+        
+        self.dead_end_portals = self._dead_end_portals()
+    
+    def _locations(self, code):
+    
+        locations = []
+        for row in range(16):
+            column = self.checker.rows[row].find(chr(code))
+            while column != -1:
+                locations.append((column, row))
+                column = self.checker.rows[row].find(chr(code), column + 1)
+        
+        return locations
+    
+    def _dead_end_portals(self):
+    
+        # Find the portals whose destinations do not lead to the finish or,
+        # if the finish cannot be reached, where the character is lost.
+        destinations = {}
+        for here, edges in self.graph.items():
+            for there, symbol in edges:
+                if symbol:
+                    destinations.setdefault(symbol, set()).add(there)
+        
+        if self.finish_reached:
+        
+            # Find the positions that lead to the finish by following the
+            # moves backwards from the positions that reach it.
+            previous = {}
+            for here, edges in self.graph.items():
+                for there, symbol in edges:
+                    previous.setdefault(there, []).append(here)
+            
+            leading = set(self.finishing)
+            pending = list(leading)
+            while pending:
+                for here in previous.get(pending.pop(), []):
+                    if here not in leading:
+                        leading.add(here)
+                        pending.append(here)
+        else:
+            leading = set(self.graph.keys())
+        
+        dead_ends = []
+        for symbol, positions in destinations.items():
+            if not positions & leading:
+                locations = self.checker.level_map.portal_locations.get(symbol)
+                if locations:
+                    dead_ends.append((symbol, makelevels.portal_location(locations)))
+                else:
+                    dead_ends.append((symbol, None))
+        
+        dead_ends.sort()
+        return dead_ends
+    
+    def level_name(self, column):
+    
+        """Returns the name of the level containing the given column of the
+        level map."""
+        for name, start, end in makelevels.level_ranges(self.checker.levels):
+            if start <= column < end:
+                return name
+        
+        return None
+    
+    def problems(self):
+    
+        """Returns a list of strings describing the problems found."""
+        problems = []
+        checker = self.checker
+        
+        if checker.finish and not self.finish_reached:
+            problems.append("The finish at column %i cannot be reached." % (
+                checker.finish + 19))
+        
+        for ch, locations in self.unreachable_objects:
+            for column, row in locations:
+                problems.append("Object %s at column %i, row %i (%s) cannot be collected." % (
+                    ch, column, row, self.level_name(column)))
+        
+        for symbol, location in self.dead_end_portals:
+            if location is None:
+                problems.append("Portals leading to %s lead nowhere because %s is not in the level." % (
+                    symbol, symbol))
+            else:
+                column, row = location
+                problems.append("Portals leading to %s at column %i, row %i (%s) lead to a dead end." % (
+                    symbol, column, row, self.level_name(column)))
+        
+        return problems
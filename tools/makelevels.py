@@ -17,6 +17,8 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import cPickle, hashlib, inspect, os, re
+
 class LevelError(Exception):
 
     pass
@@ -88,10 +90,188 @@ colours = {"black": 0, "red": 1, "green": 2, "yellow": 3, "blue": 4,
 
 starting_row = 7
 
+# Runs of identical tile codes in a row of a level map.
+span_re = re.compile(r"(.)\1*", re.S)
+
+# A level map holds the levels in a level file stitched together into 16 rows,
+# each stored as a bytearray of tile codes, with tables of the positions of
+# monsters and portals. Monsters are stored in a dictionary mapping columns to
+# (monster, y, axis) tuples, and the cells containing each portal in a
+# dictionary mapping portal symbols to lists of (x, y) tuples.
+
+class LevelMap:
+
+    def __init__(self, rows, monsters, portal_locations):
+    
+        self.rows = rows
+        self.width = len(rows[0])
+        self.monsters = monsters
+        self.portal_locations = portal_locations
+    
+    def spans(self, row):
+    
+        # Return a list of (tile code, length) tuples describing the runs of
+        # identical tile codes in the given row.
+        return map(lambda match: (ord(match.group(1)), match.end() - match.start()),
+                   span_re.finditer(str(self.rows[row])))
+
+def create_level_map(levels, tiles, special, portals):
+
+    # Return a LevelMap describing the levels, which are given as (name, rows)
+    # tuples, using the dictionaries of tiles, special tiles and portals to
+    # translate the symbols in the level map into tile codes.
+    
+    # Create a table for translating symbols into tile codes. Special tiles
+    # take precedence over portals, then monsters, then regular tiles.
+    codes = {}
+    
+    for ch, c in tiles.items():
+        codes[ch] = c
+    
+    monster_symbols = []
+    for ch in monster_tiles:
+        if ch not in special and ch not in portals:
+            # Use the blank tile in the level itself.
+            codes[ch] = tiles["."]
+            monster_symbols.append(ch)
+    
+    portal_symbols = []
+    broken_portals = []
+    for ch, (index, dest, colour) in portals.items():
+        if ch in special:
+            continue
+        elif dest not in portals:
+            # Portals leading to undefined portals cannot be used in the map.
+            broken_portals.append(ch)
+            continue
+        
+        # Portal tiles have values greater than or equal to 128.
+        dest_colour = portals[dest][2]
+        codes[ch] = (colours[dest_colour] << 4) | index
+        portal_symbols.append(ch)
+    
+    for ch, (n, index, flags) in special.items():
+        # Special tiles have values greater than or equal to 16.
+        codes[ch] = index
+    
+    table = map(chr, range(256))
+    for ch, c in codes.items():
+        table[ord(ch)] = chr(c)
+    
+    table = "".join(table)
+    symbols = "".join(codes.keys())
+    
+    monster_re = portal_re = None
+    if monster_symbols:
+        monster_re = re.compile("[%s]" % re.escape("".join(monster_symbols)))
+    if portal_symbols:
+        portal_re = re.compile("[%s]" % re.escape("".join(portal_symbols)))
+    
+    rows = []
+    monsters = {}
+    portal_locations = {}
+    
+    for l in range(16):
+    
+        # Stitch the levels together.
+        line = "".join(map(lambda (name, rows): rows[l], levels))
+        
+        for ch in broken_portals:
+            if ch in line:
+                raise LevelError, "Portal %s in row %i leads to an undefined portal." % (ch, l)
+        
+        unknown = line.translate(None, symbols)
+        if unknown:
+            raise LevelError, "Unknown symbol %s in row %i." % (repr(unknown[0]), l)
+        
+        rows.append(bytearray(line.translate(table)))
+        
+        # Record the position and type of each monster. A monster in a lower
+        # row replaces one in the same column in a higher row.
+        if monster_re:
+            for match in monster_re.finditer(line):
+                ch = match.group()
+                monsters[match.start()] = (monster_tiles[ch], l + starting_row,
+                                           monster_axes[ch])
+        
+        if portal_re:
+            for match in portal_re.finditer(line):
+                portal_locations.setdefault(match.group(), []).append((match.start(), l))
+    
+    return LevelMap(rows, monsters, portal_locations)
+
+# Parsed level files are cached in memory and in a sidecar file next to each
+# level file, keyed by a hash of the contents of the level file and of this
+# module. Each entry holds the pickled result of parse_level so that callers
+# always receive their own copy of the data.
+parsed_levels = {}
+
+def tile_numbers():
+
+    tiles = {}
+    for i in range(len(tile_order)):
+        key = tile_order[i]
+        tiles[key] = i
+    
+    return tiles
+
+def sidecar_path(path):
+
+    directory, name = os.path.split(path)
+    return os.path.join(directory, "." + name + ".parsed")
+
+def parse_level(path):
+
+    # Return the levels, special tiles, portals and finishing offset read from
+    # the level file, followed by the level data, monster data, portal
+    # locations and level extent derived from them. The file is only parsed
+    # if it has changed since it was last parsed.
+    text = open(path, "rb").read()
+    h = hashlib.sha1()
+    h.update(open(inspect.getsourcefile(parse_level), "rb").read())
+    h.update(text)
+    key = h.hexdigest()
+    
+    pickled = parsed_levels.get(key)
+    
+    if pickled is None:
+        try:
+            sidecar = open(sidecar_path(path), "rb").read()
+            if sidecar[:len(key)] == key:
+                pickled = sidecar[len(key):]
+        except IOError:
+            pass
+    
+    if pickled is None:
+        levels, special, portals, finish = read_level(text)
+        level_data, monster_data, portal_locations = create_level_data(
+            levels, tile_numbers(), special, portals)
+        
+        pickled = cPickle.dumps((levels, special, portals, finish, level_data,
+                                 monster_data, portal_locations, level_extent), 2)
+        
+        # Write the sidecar file atomically so that concurrent builds never
+        # read a partially written file, ignoring failures to write it.
+        temp_path = sidecar_path(path) + ".%i.tmp" % os.getpid()
+        try:
+            f = open(temp_path, "wb")
+            f.write(key + pickled)
+            f.close()
+            os.rename(temp_path, sidecar_path(path))
+        except (IOError, OSError):
+            pass
+    
+    parsed_levels[key] = pickled
+    return cPickle.loads(pickled)
+
 def load_level(path):
 
+    return parse_level(path)[:4]
+
+def read_level(text):
+
     # Sanitise the lines read from the file.
-    lines = map(lambda x: x.rstrip(), open(path).readlines())
+    lines = map(lambda x: x.rstrip(), text.split("\n"))
     lines = filter(lambda x: x, lines)
     
     # The special dictionary maps symbols used in the level map to tuples
@@ -136,69 +316,14 @@ def create_level_data(levels, tiles, special, portals):
 
     global level_extent
     
-    # Stitch the levels together.
-    level = []
+    level_map = create_level_map(levels, tiles, special, portals)
+    level_extent = level_map.width - 40
     
-    for i in range(16):
+    # Store the tile code and length of each span in each row.
+    data = map(level_map.spans, range(16))
     
-        level.append("".join(map(lambda (name, rows): rows[i], levels)))
-    
-    level_extent = len(level[0]) - 40
-    
-    data = []
-    monsters = {}
-    portal_locations = {}
-    l = 0
-    
-    for line in level:
-    
-        line_data = []
-        current = None
-        offset = 0
-        i = 0
-        while i < len(line):
-        
-            ch = line[i]
-            
-            if ch in special:
-                n, index, flags = special[ch]
-                # Special tiles have values greater than or equal to 16.
-                c = index
-            
-            elif ch in portals:
-                index, dest, colour = portals[ch]
-                dest_index, other_dest, dest_colour = portals[dest]
-                portal_locations.setdefault(ch, []).append((i, l))
-                
-                # Portal tiles have values greater than or equal to 128.
-                c = (colours[dest_colour] << 4) | index
-            
-            elif ch in monster_tiles:
-                # Record the monster's position and type.
-                monsters[i] = (monster_tiles[ch], l + starting_row, monster_axes[ch])
-                # Use the blank tile in the level itself.
-                c = tiles["."]
-            
-            else:
-                c = tiles[ch]
-            
-            if c != current:
-            
-                if current is not None:
-                
-                    # Store the tile offset and length of the tile span.
-                    line_data.append((current, i - offset))
-                
-                current = c
-                offset = i
-            
-            i += 1
-        
-        if i > offset:
-            line_data.append((current, i - offset))
-        
-        data.append(line_data)
-        l += 1
+    monsters = level_map.monsters
+    portal_locations = level_map.portal_locations
     
     monster_data = []
     previous_monster = 0
@@ -221,54 +346,600 @@ def create_level_data(levels, tiles, special, portals):
         previous_y = y
         previous_axis = axis
     
-    if monster_offset < len(level[0]):
-        monster_data.append((previous_monster, previous_y, len(level[0]) - monster_offset, previous_axis))
+    if monster_offset < level_map.width:
+        monster_data.append((previous_monster, previous_y, level_map.width - monster_offset, previous_axis))
+    
+    for portal, locations in portal_locations.items():
+        portal_locations[portal] = portal_location(locations)
     
+    return data, monster_data, portal_locations
+
+def portal_location(locations):
+
     # For portal locations that span multiple cells, find the lowest, middle
     # location of the portal.
+    xs = set()
+    ys = set()
+    for x, y in locations:
     
-    for portal, locations in portal_locations.items():
+        xs.add(x)
+        ys.add(y)
+    
+    xs = list(xs)
+    xs.sort()
+    ys = list(ys)
+    ys.sort()
+    
+    # For an even number of tiles, position the character one tile to the
+    # left of centre.
+    offset = 1 - (len(xs) % 2)
+    return (xs[len(xs)/2 - offset], ys[-1])
+
+# The encoded data for each row of the level map must be shorter than this
+# number of bytes.
+maximum_row_size = 512
+
+# Solid scenery tiles, which are drawn differently but behave identically in
+# the game, can replace each other when reducing the size of the level data.
+# The blank tile, special tiles and portals are never replaced.
+solid_tiles = range(1, normal_tiles)
+
+def encode_spans(spans):
+
+    # Return the encoded data for a list of (tile code, length) spans. Each
+    # span is split into pieces of at most 256 cells, each stored as a tile
+    # code followed by the length of the piece minus 1. (There are no zero
+    # length spans.) This is the smallest encoding of a row that the game can
+    # read, so the size of a row can only be reduced by changing its tiles.
+    data = []
     
-        xs = set()
-        ys = set()
-        for x, y in locations:
+    for tile, number in spans:
+    
+        while number > 256:
+            data.append(chr(tile) + chr(255))
+            number -= 256
         
-            xs.add(x)
-            ys.add(y)
+        if number > 0:
+            data.append(chr(tile) + chr(number - 1))
+    
+    return "".join(data)
+
+def span_size(number):
+
+    return 2 * ((number + 255) / 256)
+
+def level_ranges(levels):
+
+    # Return a list of (name, start, end) tuples describing the columns of the
+    # level map occupied by each of the levels.
+    ranges = []
+    start = 0
+    
+    for name, rows in levels:
+        end = start + len(rows[0])
+        ranges.append((name, start, end))
+        start = end
+    
+    return ranges
+
+def screen_ranges(width, screen_width = 40):
+
+    # Return a list of (name, start, end) tuples dividing the given number of
+    # columns into consecutive screens.
+    ranges = []
+    
+    for start in range(0, width, screen_width):
+        end = min(start + screen_width, width)
+        ranges.append(("%i-%i" % (start, end - 1), start, end))
+    
+    return ranges
+
+def range_sizes(spans, ranges):
+
+    # Return a list containing the number of bytes of encoded data for each of
+    # the column ranges in a row described by the given spans. Each piece of
+    # a span is counted in the range containing its first column.
+    sizes = [0] * len(ranges)
+    i = 0
+    x = 0
+    
+    for tile, number in spans:
+    
+        end = x + number
+        while x < end:
         
-        xs = list(xs)
-        xs.sort()
-        ys = list(ys)
-        ys.sort()
+            while i < len(ranges) - 1 and x >= ranges[i][2]:
+                i += 1
+            
+            sizes[i] += 2
+            x += 256
         
-        # For an even number of tiles, position the character one tile to the
-        # left of centre.
-        offset = 1 - (len(xs) % 2)
-        portal_locations[portal] = (xs[len(xs)/2 - offset], ys[-1])
+        x = end
     
-    return data, monster_data, portal_locations
+    return sizes
+
+def busiest_range(spans, ranges):
+
+    # Return the (name, start, end) tuple of the column range with the largest
+    # number of bytes of encoded data in a row, followed by that number.
+    sizes = range_sizes(spans, ranges)
+    size = max(sizes)
+    
+    return ranges[sizes.index(size)], size
+
+class Merge:
+
+    # A merge replaces a span of tiles in a row of the level map with a tile
+    # from a neighbouring span, saving the given number of bytes of encoded
+    # data at the cost of changing the appearance of the given number of
+    # cells. Merges of tiles that look the same change no cells.
+    
+    def __init__(self, row, column, length, old, new, saving, changed):
+    
+        self.row = row
+        self.column = column
+        self.length = length
+        self.old = old
+        self.new = new
+        self.saving = saving
+        self.changed = changed
+    
+    def __repr__(self):
+        return "<Merge row %i [%i,%i) %i -> %i saving %i changing %i>" % (
+            self.row, self.column, self.column + self.length, self.old,
+            self.new, self.saving, self.changed)
+
+def find_merges(level_map, row, equivalent = {}):
+
+    # Return a list of the merges that reduce the size of the given row of the
+    # level map. The equivalent dictionary maps solid tiles to representative
+    # tiles with the same appearance.
+    spans = level_map.spans(row)
+    merges = []
+    x = 0
+    
+    for i in range(len(spans)):
+    
+        old, number = spans[i]
+        
+        if old in solid_tiles:
+        
+            neighbours = set()
+            if i > 0:
+                neighbours.add(spans[i - 1][0])
+            if i < len(spans) - 1:
+                neighbours.add(spans[i + 1][0])
+            
+            for new in neighbours:
+            
+                if new not in solid_tiles:
+                    continue
+                
+                # Find the spans that would be joined by the new tile.
+                first = i
+                last = i
+                if i > 0 and spans[i - 1][0] == new:
+                    first -= 1
+                if i < len(spans) - 1 and spans[i + 1][0] == new:
+                    last += 1
+                
+                joined = spans[first:last + 1]
+                saving = sum(map(lambda (tile, number): span_size(number), joined)) - \
+                         span_size(sum(map(lambda (tile, number): number, joined)))
+                
+                if saving <= 0:
+                    continue
+                
+                if equivalent.get(old, old) == equivalent.get(new, new):
+                    changed = 0
+                else:
+                    changed = number
+                
+                merges.append(Merge(row, x, number, old, new, saving, changed))
+        
+        x += number
+    
+    return merges
+
+def apply_merge(level_map, merge):
+
+    level_map.rows[merge.row][merge.column:merge.column + merge.length] = \
+        chr(merge.new) * merge.length
+
+def fit_rows(level_map, budget = maximum_row_size - 1, equivalent = {}):
+
+    # Apply merges to the level map, returning a list of the merges applied.
+    # Merges that change no cells are applied to every row. Other merges are
+    # only applied to rows that would need more than the budgeted number of
+    # bytes, choosing the ones that change the fewest cells for each byte
+    # saved, until each row fits. Rows that cannot be made to fit are left as
+    # large as the available merges allow.
+    applied = []
+    
+    for row in range(16):
+    
+        while True:
+        
+            merges = find_merges(level_map, row, equivalent)
+            size = len(encode_spans(level_map.spans(row)))
+            
+            lossless = filter(lambda merge: merge.changed == 0, merges)
+            if lossless:
+                merge = lossless[0]
+            elif merges and size > budget:
+                merges.sort(key = lambda merge: (float(merge.changed) / merge.saving,
+                                                 merge.column))
+                merge = merges[0]
+            else:
+                break
+            
+            apply_merge(level_map, merge)
+            applied.append(merge)
+    
+    return applied
+
+def apply_merges(text, merges):
+
+    # Return the text of a level file with the tiles changed by the merges
+    # replaced by the symbols of their new tiles.
+    lines = text.split("\n")
+    levels = read_level(text)[0]
+    
+    # The level maps are at the end of the file, each occupying 17 non-empty
+    # lines including the name of the level.
+    indices = filter(lambda i: lines[i].rstrip(), range(len(lines)))
+    first = len(indices) - (17 * len(levels))
+    ranges = level_ranges(levels)
+    
+    for merge in merges:
+    
+        for x in range(merge.column, merge.column + merge.length):
+        
+            for l in range(len(ranges)):
+                name, start, end = ranges[l]
+                if start <= x < end:
+                    break
+            
+            i = indices[first + (17 * l) + 1 + merge.row]
+            line = lines[i]
+            x -= start
+            lines[i] = line[:x] + tile_order[merge.new] + line[x + 1:]
+    
+    return "\n".join(lines)
+
+# The game scrolls to a position in the level, such as the destination of a
+# portal, one column at a time. A checkpoint table records the state of the
+# scrolling routines at regular intervals so that the game can start from the
+# nearest checkpoint instead of scrolling from its current position.
+
+# The number of cycles taken by each path through the routines that scroll to
+# a position in the level, counted from the instructions in code.oph,
+# scrolling.oph, monsters.oph and checkpoints.oph without the extra cycles
+# taken when branches and indexed reads cross page boundaries. Creating a
+# monster takes the longest path through create_monster.
+scroll_cycles = {
+    # init_scrolling
+    "init": 433 + 53, "init monster span": 45, "init long span": 10,
+    "init edge": 19, "init end": 28,
+    # scroll_right and scroll_left, for each row and on returning
+    "right row": 18, "right row new span": 96,
+    "left row": 22, "left row new span": 122, "scroll end": 7,
+    # scroll_right_update_monsters
+    "right edge": 15, "right edge new span": 66, "right edge create": 14,
+    "left edge": 21, "left edge new span": 71, "left edge zero": 14,
+    # scroll_left_update_monsters
+    "right edge back": 16, "right edge previous span": 64,
+    "left edge back": 26, "left edge back create": 20,
+    "left edge previous span": 70,
+    # create_monster_right and create_monster_left
+    "create no monster": 72, "create monster": 308,
+    # jump_to_tracking_offset, for each column and on arriving
+    "step": 30, "step page": 4, "right same page": 20, "right other page": 13,
+    "left same page": 19, "left other page": 11, "arrive": 18,
+    # checkpoints.oph
+    "seek": 19, "seek shift": 12, "seek start": 21, "seek checkpoint": 26,
+    "seek row": 180, "seek monsters": 220}
+
+class Scroller:
+
+    # A scroller holds the same state as the game for the encoded rows and
+    # monster data, as set by init_scrolling and updated by the scroll_right,
+    # scroll_left, scroll_right_update_monsters and scroll_left_update_monsters
+    # routines, and counts the cycles they take. Each row has an index of the
+    # span after the current one, an offset counting down to the end of the
+    # current span and the maximum value of the offset. The monster data has a
+    # similar index and offsets for each edge of the screen.
+    
+    def __init__(self, rows, monster_row_data):
+    
+        self.rows = rows
+        self.monster_row_data = monster_row_data
+        self.row_indices = [0] * len(rows)
+        self.row_offsets = [0] * len(rows)
+        self.row_max_offsets = [0] * len(rows)
+        self.offset = 0
+        self.cycles = scroll_cycles["init"]
+        
+        # Find the first monster span that starts beyond the right edge of
+        # the screen, after the padding span.
+        self.monster_left_index = 0
+        self.monster_left_offset = 0
+        self.monster_left_max_offset = 0
+        self.monster_right_index = 2
+        column = 0
+        
+        while True:
+        
+            length = self.monster_length(self.monster_right_index - 1)
+            if length >= 40:
+                self.cycles += scroll_cycles["init long span"]
+                break
+            elif length + column + 1 >= 41:
+                self.cycles += scroll_cycles["init edge"]
+                break
+            
+            column += length + 1
+            self.monster_right_index += 1
+            self.cycles += scroll_cycles["init monster span"]
+        
+        length = self.monster_length(self.monster_right_index - 1)
+        self.monster_right_max_offset = length
+        self.monster_right_offset = (length - 39 + column) & 0xff
+        self.cycles += scroll_cycles["init end"]
+    
+    def row_length(self, row, index):
+    
+        # Return the length minus 1 of the span with the given index in a row.
+        # The game reads the row table before the first span, which only
+        # affects the state at the start of the level.
+        if index < 0:
+            return 0
+        
+        return ord(self.rows[row][2 * index + 1])
+    
+    def monster_length(self, index):
+    
+        # Return the length minus 1 of the monster span with the given index.
+        if 2 * index + 1 >= len(self.monster_row_data):
+            raise LevelError, "Scrolled beyond the end of the monster data."
+        elif index < 0:
+            return 0
+        
+        return ord(self.monster_row_data[2 * index + 1])
+    
+    def create_monster(self, index):
+    
+        if 0 <= 2 * index < len(self.monster_row_data) and \
+           ord(self.monster_row_data[2 * index]) != 0:
+            self.cycles += scroll_cycles["create monster"]
+        else:
+            self.cycles += scroll_cycles["create no monster"]
+    
+    def scroll_right(self):
+    
+        for r in range(len(self.rows)):
+        
+            if self.row_offsets[r] == 0:
+                length = self.row_length(r, self.row_indices[r])
+                self.row_offsets[r] = self.row_max_offsets[r] = length
+                self.row_indices[r] += 1
+                self.cycles += scroll_cycles["right row new span"]
+            else:
+                self.row_offsets[r] -= 1
+                self.cycles += scroll_cycles["right row"]
+        
+        self.cycles += scroll_cycles["scroll end"]
+        
+        self.monster_right_offset = (self.monster_right_offset - 1) & 0xff
+        if self.monster_right_offset == 0:
+            self.create_monster(self.monster_right_index)
+            self.cycles += scroll_cycles["right edge create"]
+        elif self.monster_right_offset == 255:
+            length = self.monster_length(self.monster_right_index)
+            self.monster_right_offset = self.monster_right_max_offset = length
+            self.monster_right_index += 1
+            self.cycles += scroll_cycles["right edge new span"]
+        else:
+            self.cycles += scroll_cycles["right edge"]
+        
+        self.monster_left_offset = (self.monster_left_offset - 1) & 0xff
+        if self.monster_left_offset == 0:
+            self.cycles += scroll_cycles["left edge zero"]
+        elif self.monster_left_offset == 255:
+            length = self.monster_length(self.monster_left_index)
+            self.monster_left_offset = self.monster_left_max_offset = length
+            self.monster_left_index += 1
+            self.cycles += scroll_cycles["left edge new span"]
+        else:
+            self.cycles += scroll_cycles["left edge"]
+        
+        self.offset += 1
+    
+    def scroll_left(self):
+    
+        for r in range(len(self.rows)):
+        
+            if self.row_offsets[r] == self.row_max_offsets[r]:
+                self.row_indices[r] -= 1
+                self.row_offsets[r] = 0
+                self.row_max_offsets[r] = self.row_length(r, self.row_indices[r] - 1)
+                self.cycles += scroll_cycles["left row new span"]
+            else:
+                self.row_offsets[r] += 1
+                self.cycles += scroll_cycles["left row"]
+        
+        self.cycles += scroll_cycles["scroll end"]
+        
+        if self.monster_right_offset == self.monster_right_max_offset:
+            self.monster_right_index -= 1
+            self.monster_right_offset = 0
+            self.monster_right_max_offset = self.monster_length(self.monster_right_index - 1)
+            self.cycles += scroll_cycles["right edge previous span"]
+        else:
+            self.monster_right_offset += 1
+            self.cycles += scroll_cycles["right edge back"]
+        
+        if self.monster_left_offset == self.monster_left_max_offset:
+            self.monster_left_index -= 1
+            self.monster_left_offset = 0
+            self.monster_left_max_offset = self.monster_length(self.monster_left_index - 1)
+            self.cycles += scroll_cycles["left edge previous span"]
+        elif self.monster_left_offset == 0:
+            self.monster_left_offset += 1
+            self.create_monster(self.monster_left_index)
+            self.cycles += scroll_cycles["left edge back create"]
+        else:
+            self.monster_left_offset += 1
+            self.cycles += scroll_cycles["left edge back"]
+        
+        self.offset -= 1
+    
+    def checkpoint(self):
+    
+        # Return the values stored in the checkpoint table for the current
+        # scroll offset, in the order of the arrays in the table.
+        values = []
+        for index, offset in zip(self.row_indices, self.row_offsets):
+            values += [index, offset]
+        
+        return values + [self.monster_left_index, self.monster_left_offset,
+                         self.monster_right_index, self.monster_right_offset]
+
+def checkpoint_count(level_extent, interval):
+
+    return level_extent / interval
+
+def checkpoints_size(level_extent, interval):
+
+    # Each checkpoint holds an index and offset for each of the 16 rows and
+    # for each edge of the screen in the monster data.
+    return checkpoint_count(level_extent, interval) * ((16 * 2) + 4)
+
+def create_checkpoints(rows, monster_row_data, level_extent, interval):
+
+    # Return a checkpoint table for the encoded rows and monster data, holding
+    # the state of the scrolling routines at each multiple of the interval up
+    # to the level extent. The interval must be a power of 2 no larger than
+    # 256. Each row index must fit in a byte, which is the case for rows that
+    # the game can read.
+    if interval < 2 or interval > 256 or interval & (interval - 1):
+        raise LevelError, "The checkpoint interval must be a power of 2 from 2 to 256."
+    
+    count = checkpoint_count(level_extent, interval)
+    if count > 255:
+        raise LevelError, "Too many checkpoints (%i) for an interval of %i columns." % (
+            count, interval)
+    
+    scroller = Scroller(rows, monster_row_data)
+    checkpoints = []
+    
+    for i in range(count):
+    
+        for column in range(interval):
+            scroller.scroll_right()
+        
+        values = scroller.checkpoint()
+        if max(values) > 255:
+            raise LevelError, "Row too long for a checkpoint at column %i." % scroller.offset
+        
+        checkpoints.append(values)
+    
+    # Store the values for each checkpoint in a series of arrays.
+    return "".join(map(lambda values: "".join(map(chr, values)), zip(*checkpoints)))
+
+def step_cycles(offset, target, cycles):
+
+    # Return the cycles taken by jump_to_tracking_offset to scroll one column
+    # from the offset towards the target, given the cycles taken by the
+    # scrolling routines.
+    if target > offset:
+        direction, next = "right", offset + 1
+    else:
+        direction, next = "left", offset - 1
+    
+    if offset >> 8 == target >> 8:
+        cycles += scroll_cycles[direction + " same page"]
+    else:
+        cycles += scroll_cycles[direction + " other page"]
+    
+    if next >> 8 != offset >> 8:
+        cycles += scroll_cycles["step page"]
+    
+    return cycles + scroll_cycles["step"]
+
+def seek_cycles(rows, monster_row_data, level_extent, interval = None):
+
+    # Return the largest number of cycles that jump_to_tracking_offset takes to
+    # reach a position in the level, either by scrolling from the start of the
+    # level to the end and back again or, if a checkpoint interval is given,
+    # by seeking to the nearest checkpoint and scrolling from there.
+    scroller = Scroller(rows, monster_row_data)
+    init_cycles = scroller.cycles
+    right = []
+    
+    for offset in range(level_extent):
+        cycles = scroller.cycles
+        scroller.scroll_right()
+        right.append(scroller.cycles - cycles)
+    
+    if interval is None:
+    
+        left = []
+        for offset in range(level_extent, 0, -1):
+            cycles = scroller.cycles
+            scroller.scroll_left()
+            left.append(step_cycles(offset, 0, scroller.cycles - cycles))
+        
+        forwards = sum(map(lambda offset: step_cycles(offset, level_extent, right[offset]),
+                           range(level_extent)))
+        
+        return max(forwards, sum(left)) + scroll_cycles["arrive"]
+    
+    shift = 0
+    while 1 << shift < interval:
+        shift += 1
+    
+    seek = scroll_cycles["seek"] + (scroll_cycles["seek shift"] * shift) - 1
+    checkpoint = seek + scroll_cycles["seek checkpoint"] + (scroll_cycles["seek row"] * 16) - 1 + \
+                 scroll_cycles["seek monsters"]
+    start = seek + scroll_cycles["seek start"] + init_cycles
+    
+    worst = 0
+    for target in range(level_extent + 1):
+    
+        first = target - (target % interval)
+        if first == 0:
+            cycles = start
+        else:
+            cycles = checkpoint
+        
+        for offset in range(first, target):
+            cycles += step_cycles(offset, target, right[offset])
+        
+        worst = max(worst, cycles + scroll_cycles["arrive"])
+    
+    return worst
 
 def create_level(levels_address, level_path, maximum_number_of_special_tiles,
-                 maximum_number_of_portals):
+                 maximum_number_of_portals, checkpoint_interval = None):
+    
+    global level_extent
     
-    levels, special, portals, finish = load_level(level_path)
+    # Read the level descriptions and the level data that can be encoded into
+    # a form the game can use.
+    levels, special, portals, finish, level_data, monster_data, \
+        portal_locations, level_extent = parse_level(level_path)
     
-    tiles = {}
-    for i in range(len(tile_order)):
-        key = tile_order[i]
-        tiles[key] = i
+    tiles = tile_numbers()
     
     special_tile_numbers_table_size = visibility_table_size = maximum_number_of_special_tiles
     
     portal_table_size = 3 * maximum_number_of_portals
     row_table_size = (16 * 2)
     
-    # Convert the level descriptions into level data that can be encoded into
-    # a form the game can use.
-    level_data, monster_data, portal_locations = create_level_data(levels, tiles, special, portals)
-    
     data = ""
     row_addresses = []
+    rows = []
     
     r = 0
     for row in level_data:
@@ -276,29 +947,20 @@ def create_level(levels_address, level_path, maximum_number_of_special_tiles,
         row_addresses.append(levels_address + special_tile_numbers_table_size + \
                              visibility_table_size + portal_table_size + \
                              row_table_size + len(data))
-        row_data = ""
+        row_data = encode_spans(row)
         
-        for tile, number in row:
-        
-            # Split the span into pieces if it is too large to be
-            # represented by a single byte. Each span length is reduced by 1
-            # to enable a larger range of values to be represented. (There
-            # are no zero length spans.)
-            while number > 256:
-            
-                row_data += chr(tile) + chr(255)
-                number -= 256
-            
-            if number > 0:
-                row_data += chr(tile) + chr(number - 1)
-        
-        if len(row_data) >= 512:
-            raise LevelError, "Level %i: Row %i too long or too detailed." % (l, r)
+        if len(row_data) >= maximum_row_size:
+            (name, start, end), size = busiest_range(
+                row, screen_ranges(level_extent + 40))
+            raise LevelError, "Row %i too long or too detailed (%i bytes). " \
+                "Columns %i to %i use the most space (%i bytes)." % (
+                r, len(row_data), start, end - 1, size)
         
         used = len(row_data)
         print "%2i: %3i |%s%s|" % (r, used, "#" * (used/8), " " * (64 - (used/8)))
         
         data += row_data
+        rows.append(row_data)
         r += 1
     
     print "%i bytes (%04x) of level data" % (len(data), len(data))
@@ -336,6 +998,22 @@ def create_level(levels_address, level_path, maximum_number_of_special_tiles,
     
     data += monster_row_data
     
+    # Append the checkpoint table, if required, so that the game can find it
+    # at the end of the level data.
+    if checkpoint_interval:
+    
+        checkpoints = create_checkpoints(rows, monster_row_data, level_extent,
+                                         checkpoint_interval)
+        print "%i bytes (%04x) of checkpoint data" % (len(checkpoints), len(checkpoints))
+        data += checkpoints
+        
+        # Report the longest time taken to reach a position in the level,
+        # estimated from the instructions executed, with and without the
+        # checkpoints.
+        print "Seeking takes at most %i cycles (%i without checkpoints)" % (
+            seek_cycles(rows, monster_row_data, level_extent, checkpoint_interval),
+            seek_cycles(rows, monster_row_data, level_extent))
+    
     # Create a table of special tile numbers and initial visibility values.
     
     special_visibility = dict(map(lambda (c, index, flags): (index, (c, flags)), special.values()))
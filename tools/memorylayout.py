@@ -0,0 +1,261 @@
+"""
+Copyright (C) 2016 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Regions are described in the order they occur in memory. Some have fixed
+# addresses, splitting the memory into segments, and the others are packed
+# into the segments they occupy. A region whose size is not known when the
+# layout is solved receives all the free space in its segment, so regions
+# before it are packed upwards from the start of the segment and regions after
+# it are packed downwards from the end.
+
+class LayoutError(Exception):
+
+    pass
+
+class Region:
+
+    def __init__(self, name, size = None, address = None, align = 1,
+                 overlap = 0):
+        
+        self.name = name
+        self.size = size
+        self.address = address
+        self.align = align
+        # The number of bytes at the end of the region that may be overwritten
+        # by the following region once the region has been loaded.
+        self.overlap = overlap
+        self.fixed = address is not None
+        
+        # The number of bytes available for the region, set by Layout.solve.
+        self.space = None
+
+def align_up(address, align):
+
+    return address + (-address % align)
+
+def align_down(address, align):
+
+    return address - (address % align)
+
+class Layout:
+
+    def __init__(self, start, end):
+    
+        self.start = start
+        self.end = end
+        self.regions = []
+    
+    def add(self, name, size = None, address = None, align = 1, overlap = 0):
+    
+        """Adds a region with the given name to the end of the layout. If the
+        size is None, the region receives the free space in its segment. If
+        an address is given, the region is placed at that address. The
+        address of the region is a multiple of align, and the following region
+        may overwrite the last overlap bytes of the region once it is loaded.
+        """
+        if address is not None and address % align != 0:
+            raise LayoutError("Address $%x of %s is not a multiple of %i." % (
+                address, name, align))
+        
+        self.regions.append(Region(name, size, address, align, overlap))
+    
+    def region(self, name):
+    
+        for region in self.regions:
+            if region.name == name:
+                return region
+        
+        raise KeyError(name)
+    
+    def segments(self):
+    
+        # Returns a list of (low, high, regions) tuples describing the space
+        # between regions with fixed addresses and the regions to be packed
+        # into it. A fixed region of unknown size is included at the start of
+        # the following segment because the free space follows it.
+        segments = []
+        low = self.start
+        current = []
+        
+        for region in self.regions:
+        
+            if not region.fixed:
+                current.append(region)
+                continue
+            
+            if region.address < low:
+                raise LayoutError("%s at $%x overlaps the preceding region by %i bytes." % (
+                    region.name, region.address, low - region.address))
+            
+            segments.append((low, region.address, current))
+            
+            if region.size is None:
+                low = region.address
+                current = [region]
+            else:
+                region.space = region.size
+                low = region.address + region.size
+                current = []
+        
+        segments.append((low, self.end, current))
+        return segments
+    
+    def solve(self):
+    
+        """Places the regions, returning a dictionary mapping the name of each
+        region to its address. Raises LayoutError if the regions do not fit.
+        """
+        for low, high, regions in self.segments():
+            self._pack(low, high, regions)
+        
+        return dict(map(lambda region: (region.name, region.address),
+                        self.regions))
+    
+    def _pack(self, low, high, regions):
+    
+        if not regions:
+            return
+        
+        unknown = filter(lambda region: region.size is None, regions)
+        if len(unknown) > 1:
+            raise LayoutError("Only one region between $%x and $%x can have an unknown size." % (
+                low, high))
+        
+        if unknown:
+            split = regions.index(unknown[0])
+        else:
+            split = len(regions) - 1
+        
+        # Pack the regions up to and including the split point upwards.
+        position = low
+        for region in regions[:split + 1]:
+        
+            if region.address is None:
+                region.address = align_up(position, region.align)
+            if region.size is not None:
+                position = region.address + region.size - region.overlap
+        
+        # Pack the remaining regions downwards from the end of the segment.
+        limit = high + regions[-1].overlap
+        
+        for i in range(len(regions) - 1, split, -1):
+        
+            region = regions[i]
+            region.address = align_down(limit - region.size, region.align)
+            region.space = limit - region.address
+            limit = region.address + regions[i - 1].overlap
+        
+        for i in range(split):
+            regions[i].space = regions[i + 1].address + regions[i].overlap - \
+                               regions[i].address
+        
+        # The region at the split point receives the free space.
+        region = regions[split]
+        region.space = limit - region.address
+        
+        deficit = (region.size or 0) - region.space
+        if deficit > 0:
+            names = map(lambda region: "%s (%i bytes)" % (region.name, region.size),
+                        filter(lambda region: region.size, regions))
+            raise LayoutError(
+                "The regions between $%x and $%x need %i more bytes than are "
+                "available. Shrink %s by a total of at least %i bytes." % (
+                low, high, deficit, join_names(names), deficit))
+    
+    def check(self, name, size):
+    
+        """Checks that the named region, whose size was unknown when the
+        layout was solved, has room for the given number of bytes. Raises
+        LayoutError describing the shortfall if it does not.
+        """
+        region = self.region(name)
+        excess = size - region.space
+        if excess <= 0:
+            return
+        
+        i = self.regions.index(region)
+        if i + 1 < len(self.regions):
+            overrun = self.regions[i + 1].name
+        else:
+            overrun = "the end of memory at $%x" % self.end
+        
+        message = "%s overruns %s by %i bytes. Shrink %s by %i bytes" % (
+            name, overrun, excess, name, excess)
+        
+        # The regions packed after this one could also be made smaller.
+        others = []
+        for other in self.regions[i + 1:]:
+            if other.fixed:
+                break
+            others.append(other.name)
+        
+        if others:
+            message += " or shrink %s by a total of %i bytes" % (
+                join_names(others), excess)
+        
+        raise LayoutError(message + ".")
+    
+    def describe(self, sizes = {}):
+    
+        """Returns a list of dictionaries describing the name, start, end, size
+        and free space of each region. The sizes of regions that were unknown
+        when the layout was solved can be given in the sizes dictionary.
+        Unknown values are given as None.
+        """
+        regions = []
+        
+        for region in self.regions:
+        
+            size = sizes.get(region.name, region.size)
+            if size is None:
+                end = free = None
+            else:
+                end = region.address + size
+                free = region.space - size
+            
+            regions.append({"name": region.name, "start": region.address,
+                            "end": end, "size": size, "free": free,
+                            "space": region.space})
+        
+        return regions
+    
+    def report(self, sizes = {}):
+    
+        """Returns a list of lines describing the layout. The sizes of regions
+        that were unknown when the layout was solved can be given in the sizes
+        dictionary.
+        """
+        lines = ["%-32s %-5s %-5s %6s %6s" % ("Region", "Start", "End", "Size", "Free")]
+        
+        for region in self.describe(sizes):
+        
+            if region["size"] is None:
+                lines.append("%-32s %04x  %4s  %6s %6i" % (
+                    region["name"], region["start"], "", "", region["space"]))
+            else:
+                lines.append("%-32s %04x  %04x  %6i %6i" % (
+                    region["name"], region["start"], region["end"],
+                    region["size"], region["free"]))
+        
+        return lines
+
+def join_names(names):
+
+    if len(names) == 1:
+        return names[0]
+    
+    return ", ".join(names[:-1]) + " or " + names[-1]
@@ -0,0 +1,279 @@
+"""
+Copyright (C) 2016 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import cgi, json, re
+
+# Reports describe the memory regions, files and constants of a build so that
+# the sizes of different builds can be compared. A budget file describes limits
+# on the sizes of regions and files, and on how much they may grow compared to
+# an earlier report, in the following form:
+#
+# {
+#     "regions": {"LEVELS": {"maximum size": 3072, "maximum growth": 128},
+#                 "CODE": {"minimum free": 256}},
+#     "files": {"SPRITES": {"maximum size": 1408}}
+# }
+
+alias_re = re.compile(r"^\s*\.alias\s+(\S+)\s+(\S+)", re.M)
+
+class BudgetError(Exception):
+
+    pass
+
+def parse_aliases(text):
+
+    """Returns a list of (name, value) pairs for the aliases defined in the
+    given assembly language source. Values that are not numbers are returned
+    as strings.
+    """
+    aliases = []
+    
+    for name, value in alias_re.findall(text):
+    
+        try:
+            if value.startswith("$"):
+                value = int(value[1:], 16)
+            else:
+                value = int(value)
+        except ValueError:
+            pass
+        
+        aliases.append((name, value))
+    
+    return aliases
+
+def create_report(result, details = {}):
+
+    """Returns a dictionary describing the regions, files and symbols of the
+    given BuildResult. Any details given are included in the report.
+    """
+    report = dict(details)
+    
+    report["regions"] = result.regions
+    report["files"] = map(lambda (name, size): {"name": name, "size": size},
+                          sorted(result.sizes.items()))
+    report["symbols"] = map(lambda (name, value): {"name": name, "value": value},
+                            result.symbols)
+    return report
+
+def write_json(report, path):
+
+    f = open(path, "w")
+    json.dump(report, f, indent = 4, sort_keys = True)
+    f.close()
+
+def read_json(path):
+
+    return json.load(open(path))
+
+def read_budget(path):
+
+    try:
+        budget = json.load(open(path))
+    except (IOError, ValueError), exception:
+        raise BudgetError("Failed to read the budget file %s: %s" % (path, exception))
+    
+    for section in budget.keys():
+        if section not in ("regions", "files"):
+            raise BudgetError("Unknown section in budget file: %s" % section)
+    
+    return budget
+
+def check_budget(report, budget, baseline = None):
+
+    """Checks the sizes in the report against the budget, and against the
+    sizes in the baseline report if one is given. Returns a list of messages
+    describing the limits that were exceeded. Raises BudgetError if the budget
+    refers to a region or file that is not in the report.
+    """
+    messages = []
+    
+    for section, kind in (("regions", "Region"), ("files", "File")):
+    
+        entries = dict(map(lambda entry: (entry["name"], entry),
+                           report.get(section, [])))
+        if baseline is not None:
+            previous = dict(map(lambda entry: (entry["name"], entry),
+                                baseline.get(section, [])))
+        else:
+            previous = {}
+        
+        for name, limits in sorted(budget.get(section, {}).items()):
+        
+            if name not in entries:
+                raise BudgetError("Unknown %s in budget file: %s" % (
+                    kind.lower(), name))
+            
+            entry = entries[name]
+            size = entry.get("size")
+            free = entry.get("free")
+            
+            if "maximum size" in limits and size > limits["maximum size"]:
+                messages.append("%s %s is %i bytes, %i bytes over its limit of %i bytes." % (
+                    kind, name, size, size - limits["maximum size"],
+                    limits["maximum size"]))
+            
+            if "minimum free" in limits and free is not None and \
+               free < limits["minimum free"]:
+                messages.append("%s %s has %i bytes free, %i bytes fewer than its limit of %i bytes." % (
+                    kind, name, free, limits["minimum free"] - free,
+                    limits["minimum free"]))
+            
+            if "maximum growth" in limits and name in previous and \
+               previous[name].get("size") is not None:
+                growth = size - previous[name]["size"]
+                if growth > limits["maximum growth"]:
+                    messages.append("%s %s grew by %i bytes, %i bytes more than its limit of %i bytes." % (
+                        kind, name, growth, growth - limits["maximum growth"],
+                        limits["maximum growth"]))
+    
+    return messages
+
+def squarify(items, x, y, width, height):
+
+    """Returns a list of (item, x, y, width, height) tuples that divide the
+    given rectangle between the items, which are (value, item) pairs sorted in
+    order of decreasing value, so that each rectangle is close to square.
+    """
+    rectangles = []
+    items = filter(lambda (value, item): value > 0, items)
+    total = float(sum(map(lambda (value, item): value, items)))
+    
+    while items:
+    
+        # Lay out a row of items along the shorter side of the rectangle,
+        # adding items while they make the row's rectangles more square.
+        side = min(width, height)
+        area = width * height
+        row = []
+        worst = None
+        
+        for value, item in items:
+        
+            candidate = row + [(value, item)]
+            row_area = sum(map(lambda (v, i): v, candidate)) / total * area
+            thickness = row_area / side
+            ratios = map(lambda (v, i): max((v / total * area) / thickness ** 2,
+                                            thickness ** 2 / (v / total * area)),
+                         candidate)
+            if worst is not None and max(ratios) > worst:
+                break
+            
+            row = candidate
+            worst = max(ratios)
+        
+        row_total = sum(map(lambda (v, i): v, row))
+        thickness = row_total / total * area / side
+        position = 0
+        
+        for value, item in row:
+        
+            length = value / float(row_total) * side
+            if width >= height:
+                rectangles.append((item, x, y + position, thickness, length))
+            else:
+                rectangles.append((item, x + position, y, length, thickness))
+            position += length
+        
+        if width >= height:
+            x += thickness
+            width -= thickness
+        else:
+            y += thickness
+            height -= thickness
+        
+        items = items[len(row):]
+        total -= row_total
+    
+    return rectangles
+
+def write_html(report, path, width = 960, height = 480):
+
+    """Writes an HTML page containing a treemap of the memory regions in the
+    report, with the used and free space in each region, followed by tables of
+    the files and symbols in the report.
+    """
+    regions = filter(lambda region: region["space"] > 0, report["regions"])
+    items = map(lambda region: (region["space"], region), regions)
+    items.sort(key = lambda (value, region): value, reverse = True)
+    
+    boxes = []
+    
+    for region, x, y, w, h in squarify(items, 0, 0, width, height):
+    
+        used = region["size"] or 0
+        free = region["space"] - used
+        parts = [(used, ("used", used)), (free, ("free", free))]
+        
+        for (kind, size), px, py, pw, ph in squarify(sorted(parts, reverse = True), x, y, w, h):
+        
+            if kind == "used":
+                label = "%s: %i bytes" % (region["name"], size)
+            else:
+                label = "%s: %i bytes free" % (region["name"], size)
+            
+            boxes.append(
+                '<div class="%s" style="left: %.1fpx; top: %.1fpx; width: %.1fpx; height: %.1fpx" '
+                'title="%s">%s</div>' % (kind, px, py, pw, ph,
+                cgi.escape(label, True), cgi.escape(label)))
+    
+    rows = []
+    for region in report["regions"]:
+        rows.append("<tr><td>%s</td><td>%04x</td><td>%s</td><td>%s</td><td>%s</td></tr>" % (
+            cgi.escape(region["name"]), region["start"],
+            region["end"] is None and "" or "%04x" % region["end"],
+            region["size"] is None and "" or region["size"],
+            region["free"] is None and region["space"] or region["free"]))
+    
+    files = map(lambda entry: "<tr><td>%s</td><td>%i</td></tr>" % (
+        cgi.escape(entry["name"]), entry["size"]), report["files"])
+    
+    symbols = []
+    for entry in report["symbols"]:
+        value = entry["value"]
+        if isinstance(value, int):
+            value = "$%x" % value
+        symbols.append("<tr><td>%s</td><td>%s</td></tr>" % (
+            cgi.escape(entry["name"]), cgi.escape(value)))
+    
+    title = "Memory usage"
+    if "machine" in report and "format" in report:
+        title += " for %s %s" % (report["machine"], report["format"])
+    
+    f = open(path, "w")
+    f.write(
+        "<!DOCTYPE html>\n"
+        "<html>\n<head>\n<meta charset=\"utf-8\">\n<title>%s</title>\n"
+        "<style>\n"
+        "body { font-family: sans-serif; }\n"
+        "#treemap { position: relative; width: %ipx; height: %ipx; }\n"
+        "#treemap div { position: absolute; box-sizing: border-box; overflow: hidden;\n"
+        "               border: 1px solid white; font-size: 11px; padding: 2px; }\n"
+        ".used { background: #4a7fb5; color: white; }\n"
+        ".free { background: #c8d8c0; }\n"
+        "td { padding: 0 1em 0 0; font-family: monospace; }\n"
+        "</style>\n</head>\n<body>\n"
+        "<h1>%s</h1>\n"
+        "<div id=\"treemap\">\n%s\n</div>\n"
+        "<h2>Regions</h2>\n<table>\n"
+        "<tr><th>Name</th><th>Start</th><th>End</th><th>Size</th><th>Free</th></tr>\n%s\n</table>\n"
+        "<h2>Files</h2>\n<table>\n<tr><th>Name</th><th>Size</th></tr>\n%s\n</table>\n"
+        "<h2>Symbols</h2>\n<table>\n<tr><th>Name</th><th>Value</th></tr>\n%s\n</table>\n"
+        "</body>\n</html>\n" % (cgi.escape(title), width, height, cgi.escape(title),
+            "\n".join(boxes), "\n".join(rows), "\n".join(files), "\n".join(symbols))
+        )
+    f.close()
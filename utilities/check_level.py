@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""
+Copyright (C) 2016 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os, sys
+
+from tools import levelcheck, makelevels
+
+# Checks that the finish and every collectable object in each level file can
+# be reached from the start and that no portal leads to a dead end, exiting
+# with a non-zero status if any problems are found.
+
+code_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         os.pardir, "code.oph")
+
+def check(level_file, tables):
+
+    text = open(level_file).read()
+    
+    try:
+        levels, special, portals, finish = makelevels.read_level(text)
+    except (IndexError, ValueError):
+        return ["Cannot read the level file."]
+    
+    try:
+        checker = levelcheck.Checker(levels, special, portals, finish, tables)
+    except makelevels.LevelError, exception:
+        return [str(exception)]
+    
+    report = checker.check()
+    print "%s: %i positions reachable." % (level_file, len(report.graph))
+    
+    return report.problems()
+
+
+if __name__ == "__main__":
+
+    args = sys.argv[1:]
+    
+    if "-h" in args or "--help" in args:
+        sys.stderr.write("Usage: %s [level file ...]\n" % sys.argv[0])
+        sys.exit(1)
+    
+    if not args:
+        args = ["levels/default.txt"]
+    
+    tables = levelcheck.read_byte_tables(code_path)
+    failed = False
+    
+    for level_file in args:
+    
+        problems = check(level_file, tables)
+        for problem in problems:
+            print "%s: %s" % (level_file, problem)
+        
+        if problems:
+            failed = True
+    
+    if failed:
+        sys.exit(1)
+    
+    sys.exit()
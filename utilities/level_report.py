@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+"""
+Copyright (C) 2016 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+
+from tools import makelevels, makesprites
+
+# Reports the number of bytes of level data used by each row of a level file
+# and by each level and screen in it, showing how close each row is to the
+# limit. If a budget is given, tiles are merged to make each row fit the
+# budget and the fixed level file can be written.
+
+def equivalent_tiles():
+
+    # Map each solid tile to the first solid tile with the same sprite.
+    equivalent = {}
+    sprites = {}
+    
+    for tile in makelevels.solid_tiles:
+    
+        sprite = repr(makesprites.read_png(makelevels.tile_ref[makelevels.tile_order[tile]]))
+        equivalent[tile] = sprites.setdefault(sprite, tile)
+    
+    return equivalent
+
+def bar(size):
+
+    used = size * 64 / makelevels.maximum_row_size
+    return "|%s%s|" % ("#" * used, " " * (64 - used))
+
+def report_rows(level_map, screens):
+
+    print "Row  Bytes  Free  Busiest screen"
+    
+    for row in range(16):
+    
+        spans = level_map.spans(row)
+        size = len(makelevels.encode_spans(spans))
+        (name, start, end), busiest = makelevels.busiest_range(spans, screens)
+        
+        print "%3i  %5i  %4i  %-9s %3i bytes %s" % (
+            row, size, makelevels.maximum_row_size - 1 - size, name, busiest,
+            bar(size))
+
+def report_levels(level_map, ranges):
+
+    print "Row  " + " ".join(map(lambda (name, start, end): "%10s" % name[:10], ranges))
+    
+    for row in range(16):
+    
+        sizes = makelevels.range_sizes(level_map.spans(row), ranges)
+        print "%3i  " % row + " ".join(map(lambda size: "%10i" % size, sizes))
+
+def changed_cells(original, row, equivalent):
+
+    # Return the number of cells in the row whose tiles look different to
+    # those in the original row. A cell changed by more than one merge is only
+    # counted once.
+    return len(filter(lambda (old, new): equivalent.get(old, old) != equivalent.get(new, new),
+                      zip(original, row)))
+
+def report_merges(level_map, original_rows, original_sizes, merges, equivalent):
+
+    for merge in merges:
+    
+        print "Row %2i columns %i-%i: %s -> %s saves %i bytes, changes %i cells" % (
+            merge.row, merge.column, merge.column + merge.length - 1,
+            makelevels.tile_order[merge.old], makelevels.tile_order[merge.new],
+            merge.saving, merge.changed)
+    
+    print
+    print "Row  Before  After  Changed cells"
+    
+    total_changed = 0
+    for row in range(16):
+    
+        size = len(makelevels.encode_spans(level_map.spans(row)))
+        changed = changed_cells(original_rows[row], level_map.rows[row],
+                                equivalent)
+        total_changed += changed
+        
+        print "%3i  %6i  %5i  %5i (%.1f%%)" % (
+            row, original_sizes[row], size, changed,
+            changed * 100.0 / level_map.width)
+    
+    print
+    print "Saved %i bytes by changing %i of %i cells (%.2f%%)." % (
+        sum(map(lambda merge: merge.saving, merges)), total_changed,
+        16 * level_map.width, total_changed * 100.0 / (16 * level_map.width))
+
+
+if __name__ == "__main__":
+
+    args = sys.argv[1:]
+    budget = None
+    output = None
+    
+    try:
+        while args and args[0].startswith("-"):
+        
+            option = args.pop(0)
+            if option == "--budget":
+                budget = int(args.pop(0))
+            elif option == "-o":
+                output = args.pop(0)
+            else:
+                raise ValueError
+        
+        if len(args) > 1 or (output and budget is None):
+            raise ValueError
+    
+    except (IndexError, ValueError):
+        sys.stderr.write("Usage: %s [--budget <bytes per row> [-o <fixed level file>]] [level file]\n" % sys.argv[0])
+        sys.exit(1)
+    
+    if args:
+        level_file = args[0]
+    else:
+        level_file = "levels/default.txt"
+    
+    text = open(level_file).read()
+    levels, special, portals, finish = makelevels.read_level(text)
+    
+    try:
+        level_map = makelevels.create_level_map(
+            levels, makelevels.tile_numbers(), special, portals)
+    except makelevels.LevelError, exception:
+        sys.stderr.write("%s\n" % exception)
+        sys.exit(1)
+    
+    screens = makelevels.screen_ranges(level_map.width)
+    
+    report_rows(level_map, screens)
+    print
+    report_levels(level_map, makelevels.level_ranges(levels))
+    
+    if budget is not None:
+    
+        original_rows = map(bytearray, level_map.rows)
+        original_sizes = map(lambda row: len(makelevels.encode_spans(level_map.spans(row))),
+                             range(16))
+        
+        equivalent = equivalent_tiles()
+        merges = makelevels.fit_rows(level_map, budget, equivalent)
+        print
+        
+        if merges:
+            report_merges(level_map, original_rows, original_sizes, merges,
+                          equivalent)
+        else:
+            print "No changes are needed to fit the budget."
+        
+        over = filter(lambda row: len(makelevels.encode_spans(level_map.spans(row))) > budget,
+                      range(16))
+        if over:
+            print "Rows %s still exceed the budget." % ", ".join(map(str, over))
+        
+        if output:
+            open(output, "w").write(makelevels.apply_merges(text, merges))
+    
+    sys.exit()